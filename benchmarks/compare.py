@@ -0,0 +1,83 @@
+"""
+Сравнение двух прогонов benchmarks/run.py (например, до и после коммита).
+
+Уровни сопоставляются по concurrency. Регрессией считается падение
+пропускной способности или рост p50/p95/p99 больше порога; в этом случае
+скрипт завершается с кодом 1, чтобы его можно было ставить в CI.
+
+Пример:
+    python -m benchmarks.compare base.json new.json --threshold 0.1
+"""
+import argparse
+import json
+import sys
+from typing import List, Optional, Tuple
+
+# (название, путь в результатах уровня, чем больше - тем лучше)
+METRICS: List[Tuple[str, Tuple[str, ...], bool]] = [
+    ("throughput_rps", ("throughput_rps",), True),
+    ("p50_ms", ("latency_ms", "p50"), False),
+    ("p95_ms", ("latency_ms", "p95"), False),
+    ("p99_ms", ("latency_ms", "p99"), False),
+    ("mem_growth_kb", ("memory", "traced_growth_kb"), False),
+]
+
+
+def _get(level: dict, path: Tuple[str, ...]) -> Optional[float]:
+    value = level
+    for key in path:
+        if not isinstance(value, dict) or value.get(key) is None:
+            return None
+        value = value[key]
+    return float(value)
+
+
+def compare(base: dict, new: dict, threshold: float) -> Tuple[List[str], List[str]]:
+    """Возвращает строки таблицы и список найденных регрессий."""
+    rows = [f"{'c':>4}  {'метрика':<16}{'было':>12}{'стало':>12}{'изм.':>9}"]
+    regressions = []
+    base_levels = {level["concurrency"]: level for level in base["levels"]}
+    for level in new["levels"]:
+        concurrency = level["concurrency"]
+        old = base_levels.get(concurrency)
+        if old is None:
+            rows.append(f"{concurrency:>4}  нет в базовом прогоне")
+            continue
+        for name, path, higher_is_better in METRICS:
+            before, after = _get(old, path), _get(level, path)
+            if before is None or after is None:
+                continue
+            change = (after - before) / abs(before) if before else 0.0
+            worse = -change if higher_is_better else change
+            # Прирост памяти около нуля шумит в процентах - сравниваем только заметные значения
+            mark = ""
+            if worse > threshold and not (name == "mem_growth_kb" and abs(after - before) < 256):
+                mark = "  <-- регрессия"
+                regressions.append(f"c={concurrency} {name}: {before:g} -> {after:g} ({change:+.1%})")
+            rows.append(f"{concurrency:>4}  {name:<16}{before:>12g}{after:>12g}{change:>+9.1%}{mark}")
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение результатов benchmarks/run.py")
+    parser.add_argument("base", help="JSON базового прогона")
+    parser.add_argument("new", help="JSON нового прогона")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Допустимое ухудшение, доля (0.10 = 10%%)")
+    args = parser.parse_args()
+
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+
+    print(f"база: {base['meta'].get('commit')}  новый: {new['meta'].get('commit')}")
+    rows, regressions = compare(base, new, args.threshold)
+    print("\n".join(rows))
+    if regressions:
+        print(f"\nРегрессий: {len(regressions)} (порог {args.threshold:.0%})")
+        sys.exit(1)
+    print("\nРегрессий нет.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""
+Нагрузочный прогон nox-core без GPU и без живого Home Assistant.
+
+FastAPI-приложение поднимается в этом же процессе (httpx.ASGITransport), а
+Ollama и Home Assistant заменены заглушками из fakes/. Для каждого уровня
+параллельности считаются пропускная способность, p50/p95/p99 задержки,
+время узлов графа и прирост памяти (tracemalloc). Результат пишется в JSON,
+который сравнивает benchmarks/compare.py.
+
+С --workers N приложение запускается отдельным uvicorn с N процессами поверх
+общего хранилища (--state-backend sqlite или redis на fakes/fake_redis.py), и
+запросы идут по HTTP - так видно, как пропускная способность растет с числом
+воркеров. Время узлов и память в этом режиме не считаются.
+
+Пример:
+    python -m benchmarks.run --concurrency 1,4,16 --requests 100 \\
+        --token-rate 200 --first-token-latency 0.05 --output bench.json
+    python -m benchmarks.run --workers 4 --state-backend redis --concurrency 16,64
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import List, Optional
+
+from fakes.fake_ha import FakeHomeAssistant
+from fakes.fake_ollama import FakeOllama
+from fakes.fake_redis import FakeRedis
+
+QUESTIONS = [
+    "Какая сейчас температура дома?",
+    "Сколько градусов в квартире?",
+    "Какая температура в комнате?",
+    "Тепло ли сейчас дома?",
+]
+
+
+def _percentiles(samples: List[float]) -> dict:
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 2)
+    return {
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "mean": round(statistics.fmean(ordered), 2),
+        "max": round(ordered[-1], 2),
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _rss_kb() -> int:
+    # ru_maxrss в Linux - в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+async def _run_level(client, main, ollamas: List[FakeOllama], concurrency: int, requests: int, users: int, use_tracemalloc: bool) -> dict:
+    # main=None - приложение в отдельных процессах, узлы и память не меряем
+    if main is not None:
+        main.node_timings.reset()
+    latencies: List[float] = []
+    statuses = {"ok": 0, "rejected": 0, "errors": 0}
+    llm_requests_before = sum(o.requests for o in ollamas)
+    next_index = iter(range(requests))
+
+    gc.collect()
+    if use_tracemalloc:
+        tracemalloc.reset_peak()
+        memory_before = tracemalloc.get_traced_memory()[0]
+
+    async def worker():
+        for i in next_index:
+            payload = {"user_id": f"bench-{i % users}", "text": QUESTIONS[i % len(QUESTIONS)]}
+            started = time.perf_counter()
+            try:
+                response = await client.post("/command/telegram", json=payload)
+            except Exception:
+                statuses["errors"] += 1
+                continue
+            if response.status_code == 200:
+                latencies.append((time.perf_counter() - started) * 1000)
+                statuses["ok"] += 1
+            elif response.status_code == 429:
+                statuses["rejected"] += 1
+            else:
+                statuses["errors"] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+
+    # Даем фоновым задачам (обучение роутера, сводки) завершиться до замера памяти
+    await asyncio.sleep(0.2)
+    gc.collect()
+    memory = {"rss_max_kb": _rss_kb()} if main is not None else None
+    if use_tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        memory["traced_growth_kb"] = round((current - memory_before) / 1024, 1)
+        memory["traced_peak_kb"] = round(peak / 1024, 1)
+
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        **statuses,
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(statuses["ok"] / wall, 2) if wall else None,
+        "latency_ms": _percentiles(latencies),
+        "nodes": main.node_timings.snapshot() if main is not None else None,
+        "llm_requests": sum(o.requests for o in ollamas) - llm_requests_before,
+        "memory": memory,
+    }
+
+
+async def _run_levels(args, client, main, ollamas: List[FakeOllama]) -> List[dict]:
+    levels = []
+    for i in range(args.warmup):
+        await client.post("/command/telegram", json={"user_id": "bench-warmup", "text": QUESTIONS[i % len(QUESTIONS)]})
+    for concurrency in args.concurrency:
+        result = await _run_level(client, main, ollamas, concurrency, args.requests, args.users, main is not None and not args.no_tracemalloc)
+        levels.append(result)
+        latency = result["latency_ms"]
+        print(
+            f"c={concurrency:<4} ok={result['ok']:<5} 429={result['rejected']:<4} err={result['errors']:<4} "
+            f"rps={result['throughput_rps']:<8} p50={latency['p50']} p95={latency['p95']} p99={latency['p99']} мс",
+            file=sys.stderr,
+        )
+    return levels
+
+
+async def _run(args, main, ollamas: List[FakeOllama]) -> List[dict]:
+    import httpx
+
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=args.timeout) as client:
+            # Модель и компоненты грузятся в фоне - мерим только готовый сервис
+            while (await client.get("/ready")).status_code != 200:
+                await asyncio.sleep(0.05)
+            return await _run_levels(args, client, main, ollamas)
+
+
+async def _wait_workers(client, workers: int, timeout: float = 60.0):
+    """Ждет, пока каждый воркер готов и видит остальных (иначе партиции еще не поделены)."""
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    ready = set()
+    while time.monotonic() < deadline:
+        try:
+            # Новое соединение на каждый запрос, чтобы попадать в разные процессы
+            response = await client.get("/stats", headers={"Connection": "close"})
+        except httpx.HTTPError:
+            await asyncio.sleep(0.2)
+            continue
+        if response.status_code == 200:
+            cluster = response.json()["cluster"]
+            if cluster["members"] >= workers and (await client.get("/ready", headers={"Connection": "close"})).status_code == 200:
+                ready.add(cluster["worker_id"])
+                if len(ready) >= workers:
+                    return
+        await asyncio.sleep(0.05)
+    raise TimeoutError(f"Воркеры не поднялись за {timeout:.0f} с (готовы: {len(ready)} из {workers}).")
+
+
+async def _run_external(args, ollamas: List[FakeOllama], port: int) -> List[dict]:
+    import httpx
+
+    limits = httpx.Limits(max_connections=max(args.concurrency) + 8, max_keepalive_connections=max(args.concurrency) + 8)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=args.timeout, limits=limits) as client:
+        await _wait_workers(client, args.workers)
+        return await _run_levels(args, client, None, ollamas)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон nox-core на заглушках")
+    parser.add_argument("--concurrency", default="1,4,16", help="Уровни параллельности через запятую")
+    parser.add_argument("--requests", type=int, default=50, help="Запросов на каждый уровень")
+    parser.add_argument("--users", type=int, default=1000, help="Число различных user_id (по кругу)")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--token-rate", type=float, default=0.0, help="Токенов в секунду у заглушки Ollama, 0 - без задержки")
+    parser.add_argument("--first-token-latency", type=float, default=0.0, help="Задержка первого токена, с")
+    parser.add_argument("--ollama-backends", type=int, default=1, help="Сколько заглушек Ollama поднять в пуле")
+    parser.add_argument("--ha-latency", type=float, default=0.0, help="Задержка ответов заглушки HA, с")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--no-tracemalloc", action="store_true", help="Не считать прирост памяти (tracemalloc замедляет прогон)")
+    parser.add_argument("--enable-caches", action="store_true", help="Включить быстрый путь, кэш ответов и долгосрочную память")
+    parser.add_argument("--workers", type=int, default=0, help="Запустить N процессов uvicorn и гонять запросы по HTTP (0 - в этом процессе)")
+    parser.add_argument("--state-backend", choices=["sqlite", "redis"], default="sqlite", help="Общее хранилище для --workers")
+    parser.add_argument("--port", type=int, default=18000, help="Порт uvicorn для --workers")
+    parser.add_argument("--output", help="Куда записать JSON с результатами (по умолчанию stdout)")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    args.concurrency = [int(c) for c in args.concurrency.split(",") if c.strip()]
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    ollamas = [FakeOllama(token_rate=args.token_rate, first_token_latency=args.first_token_latency) for _ in range(args.ollama_backends)]
+    urls = [ollama.start() for ollama in ollamas]
+    ha = FakeHomeAssistant(latency=args.ha_latency)
+    ha_url = ha.start()
+    redis = FakeRedis() if args.workers and args.state_backend == "redis" else None
+    state_dir = tempfile.mkdtemp(prefix="nox-bench-")
+
+    # Настройки читаются при импорте main, поэтому окружение готовим заранее
+    os.environ.update({
+        "OLLAMA_BASE_URL": urls[0],
+        "OLLAMA_BASE_URLS": ",".join(urls),
+        "HA_URL": ha_url,
+        "HA_TOK": ha.token,
+        "SESSIONS_DB_PATH": os.path.join(state_dir, "sessions.db"),
+        "LANCEDB_PATH": os.path.join(state_dir, "lancedb"),
+        "SCHEDULER_MAX_QUEUE": str(max(args.concurrency) * 2),
+    })
+    if not args.enable_caches:
+        os.environ.update({"ROUTER_ENABLED": "0", "RESPONSE_CACHE_ENABLED": "0", "LTM_ENABLED": "0"})
+
+    server = None
+    try:
+        if args.workers:
+            os.environ.update({"NOX_WORKERS": str(args.workers), "STATE_BACKEND": args.state_backend})
+            if redis is not None:
+                os.environ["STATE_REDIS_URL"] = redis.start()
+            server = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "main:app", "--workers", str(args.workers),
+                 "--port", str(args.port), "--log-level", "info" if args.verbose else "warning"],
+                stdout=None if args.verbose else subprocess.DEVNULL,
+            )
+            levels = asyncio.run(_run_external(args, ollamas, args.port))
+        else:
+            if not args.no_tracemalloc:
+                tracemalloc.start()
+            import main as nox_main
+            if not args.verbose:
+                logging.getLogger().setLevel(logging.WARNING)
+            levels = asyncio.run(_run(args, nox_main, ollamas))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(30)
+        if redis is not None:
+            redis.stop()
+        ha.stop()
+        for ollama in ollamas:
+            ollama.stop()
+
+    results = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {k: v for k, v in vars(args).items() if k != "output"},
+        },
+        "levels": levels,
+    }
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,170 +1,249 @@
+import asyncio
 import logging
-import json
-import yaml
-from pathlib import Path
+import time
 import uuid
-from typing import TypedDict, Annotated, Sequence
+from typing import Dict, List, TypedDict, Annotated, Sequence
 from requests.exceptions import ConnectionError
 # ДОБАВЬ ЭТОТ ИМПОРТ В СПИСОК ДРУГИХ ИМПОРТОВ ИЗ langchain_core.messages
 from langchain_core.messages import BaseMessage, HumanMessage, ToolMessage, AIMessage
 from langgraph.graph import StateGraph, END
-from langgraph.prebuilt import ToolExecutor
-from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableConfig
 from langchain.tools.render import render_text_description
 
 from .tools import nox_tools
-from .llm_client import get_llm
-from .memory import format_history_for_gemma3n
+from .tool_cache import tool_cache
+from .llm_client import llm_pool
+from .memory import estimate_history_tokens, estimate_tokens, format_history_for_gemma3n
+from .metrics import (
+    LLM_COMPLETION_TOKENS, LLM_FIRST_TOKEN, LLM_PROMPT_TOKENS, PARSE_FAILURES, TOOL_ERRORS,
+    observe_ollama_metadata, span,
+)
+from .config import settings
+from .prompts import INSTRUCTIONS_PATH, PromptRegistry
+from .streaming import ActionStreamParser, ResponseStreamExtractor, early_stop_stats, parse_actions
 
 logger = logging.getLogger(__name__)
 
-def load_prompt_template() -> str:
-    """Загружает и собирает шаблон промпта из YAML-файла."""
-    try:
-        instructions_path = Path(__file__).parent.parent / "configs" / "llm_instructions.yaml"
-        with instructions_path.open("r", encoding="utf-8") as f:
-            instructions = yaml.safe_load(f)
-        persona = instructions.get('persona_nox_v_svoboda', '')
-        react_instructions = instructions.get('ha_execution_prompt_with_react', '')
-        final_prompt_template = react_instructions.replace("<<: *persona", persona)
-        logger.info("Шаблон промпта успешно загружен из llm_instructions.yaml")
-        return final_prompt_template
-    except Exception as e:
-        logger.error(f"КРИТИЧЕСКАЯ ОШИБКА при загрузке промпта: {e}")
-        return ""
-    
-
-# --- Состояние графа ---
-class AgentState(TypedDict):
-    messages: Annotated[Sequence[BaseMessage], lambda x, y: x + y]
-    chat_history: str
-
-# --- Инициализация компонентов ---
-tool_executor = ToolExecutor(nox_tools)
-llm = get_llm()
-
-react_prompt_template = load_prompt_template()
-#prompt = ChatPromptTemplate.from_template(react_prompt_template)
-#formatted_tools = render_text_description(nox_tools)
+# Дописывается к описанию инструментов: call_tool умеет выполнять список действий параллельно
+MULTI_ACTION_HINT = (
+    "Независимые действия (например, с несколькими устройствами) можно выполнить за один шаг, "
+    'передав список: Action: [{"action": "...", "action_input": {...}}, {"action": "...", "action_input": {...}}]. '
+    "Результаты придут одним сообщением. respond_to_user всегда вызывается отдельно."
+)
 
-
-def load_prompt_template() -> str:
-    """Загружает и собирает шаблон промпта из YAML-файла."""
-    try:
-        instructions_path = Path(__file__).parent.parent / "configs" / "llm_instructions.yaml"
-        with instructions_path.open("r", encoding="utf-8") as f:
-            instructions = yaml.safe_load(f)
-        persona = instructions.get('persona_nox_v_svoboda', '')
-        react_instructions = instructions.get('ha_execution_prompt_with_react', '')
-        final_prompt_template = react_instructions.replace("<<: *persona", persona)
-        logger.info("Шаблон промпта успешно загружен из llm_instructions.yaml")
-        return final_prompt_template
-    except Exception as e:
-        logger.error(f"КРИТИЧЕСКАЯ ОШИБКА при загрузке промпта: {e}")
-        return ""
-    
-# Создаем класс-обертку, чтобы хранить изменяемые компоненты
-class PromptComponents:
-    def __init__(self):
-        self.react_prompt_template = ""
-        self.prompt = None
-        self.formatted_tools = ""
-
-    def load(self):
-        """Загружает и компилирует все компоненты промпта."""
-        try:
-            instructions_path = Path(__file__).parent.parent / "configs" / "llm_instructions.yaml"
-            with instructions_path.open("r", encoding="utf-8") as f:
-                instructions = yaml.safe_load(f)
-            persona = instructions.get('persona_nox_v_svoboda', '')
-            react_instructions = instructions.get('ha_execution_prompt_with_react', '')
-            self.react_prompt_template = react_instructions.replace("<<: *persona", persona)
-            self.prompt = ChatPromptTemplate.from_template(self.react_prompt_template)
-            self.formatted_tools = render_text_description(nox_tools)
-            logger.info("Шаблон промпта успешно загружен и скомпилирован.")
-            return True
-        except Exception as e:
-            logger.error(f"КРИТИЧЕСКАЯ ОШИБКА при загрузке промпта: {e}")
-            return False
-        
-# Создаем один экземпляр нашего хранилища
-prompt_components = PromptComponents()
-# И сразу же загружаем инструкцию при старте
-prompt_components.load()
+# Инструменты не меняются за время жизни процесса - описание рендерится один раз
+prompt_registry = PromptRegistry(
+    path=INSTRUCTIONS_PATH,
+    tools=render_text_description(nox_tools) + "\n\n" + MULTI_ACTION_HINT,
+    watch_interval=settings.prompt_watch_interval,
+    default_variant=settings.prompt_default_variant,
+)
+prompt_registry.load()
 
 class AgentState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], lambda x, y: x + y]
     chat_history: str # Это долгосрочная история из main.py
+    # Уже отрендеренная часть текущего хода и число сообщений в ней,
+    # чтобы на каждом шаге ReAct дописывать только новые сегменты
+    rendered_turn: str
+    rendered_count: int
 
 
 # --- Узлы графа ---
-def call_model(state: AgentState):
+def _ns_to_ms(value):
+    # Ollama отдает длительности в наносекундах
+    return round(value / 1e6, 2) if value is not None else None
+
+
+async def call_model(state: AgentState, config: RunnableConfig):
     """
     Вызывает LLM, используя актуальную версию промпта.
+    Ответ читается потоком: если в конфиге передан on_token, текст для
+    respond_to_user отдается наружу по мере генерации.
     """
     logger.info("Агент думает...")
     
-    current_turn_string = format_history_for_gemma3n(state["messages"])
+    rendered_count = state.get("rendered_count", 0)
+    new_segments = format_history_for_gemma3n(state["messages"][rendered_count:])
+    current_turn_string = "\n".join(part for part in (state.get("rendered_turn", ""), new_segments) if part)
     full_history = state["chat_history"] + "\n" + current_turn_string if state["chat_history"] else current_turn_string
-
-    inputs = {
-        "tools": prompt_components.formatted_tools, # Используем из объекта
-        "conversation_history": full_history
-    }
+    render_state = {"rendered_turn": current_turn_string, "rendered_count": len(state["messages"])}
     
-    if not prompt_components.prompt:
+    # Вариант берется один раз на шаг: перезагрузка файла посреди шага его не затронет
+    variant_name = config.get("configurable", {}).get("prompt_variant")
+    prompt = prompt_registry.get(variant_name)
+    if prompt is None and variant_name:
+        logger.warning(f"Вариант промпта '{variant_name}' не найден, использую вариант по умолчанию.")
+        prompt = prompt_registry.get()
+    if prompt is None:
         logger.error("Промпт не загружен! Возвращаю ошибку.")
         # Возвращаем AIMessage, чтобы граф не упал
         return {"messages": [AIMessage(content='Action: {"action": "respond_to_user", "action_input": {"response": "Критическая ошибка: моя инструкция не загружена. Я не могу думать."}}')]}
 
-    chain = prompt_components.prompt | llm # Используем из объекта
-    try:
-        response = chain.invoke(inputs)
-        return {"messages": [response]}
-    except Exception as e:
-        logger.error(f"ОШИБКА во время вызова LLM: {e}")
-        error_message = AIMessage(content='Action: {"action": "respond_to_user", "action_input": {"response": "Прости, Искра, я не могу подключиться к своему мозгу (Ollama)."}}')
-        return {"messages": [error_message]}
+    on_token = config.get("configurable", {}).get("on_token")
+    session_id = config.get("configurable", {}).get("session_id")
+    extractor = ResponseStreamExtractor()
+    parser = ActionStreamParser()
+    stopped_early = False
+    # Изредка даем модели договорить после JSON - по этим шагам оценивается экономия
+    early_stop = settings.react_early_stop and not early_stop_stats.should_calibrate(settings.react_early_stop_calibration_rate)
+
+    prompt_messages = [HumanMessage(content=prompt.render(full_history))]
+    with span("call_model") as model_span:
+        # По частям: статические куски и сообщения истории повторяются между шагами, весь промпт - нет
+        prompt_tokens = (
+            estimate_tokens(prompt.static_prefix) + estimate_history_tokens(full_history) + estimate_tokens(prompt.dynamic_suffix)
+        )
+        LLM_PROMPT_TOKENS.observe(prompt_tokens)
+        started = time.perf_counter()
+        first_token_at = None
+        try:
+            response_metadata = {}
+            stream = llm_pool.astream(prompt_messages, config=config, affinity=session_id)
+            try:
+                async for chunk in stream:
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        LLM_FIRST_TOKEN.observe(first_token_at - started)
+                    response_metadata = chunk.response_metadata or response_metadata
+                    if on_token:
+                        visible = extractor.feed(chunk.content)
+                        if visible:
+                            on_token(visible)
+                    if parser.feed(chunk.content) and early_stop:
+                        # JSON действия закрыт - остальное нам не нужно, рвем запрос к Ollama
+                        stopped_early = True
+                        break
+            finally:
+                await stream.aclose()
+            early_stop_stats.record(parser, stopped_early)
+            LLM_COMPLETION_TOKENS.observe(parser.tokens)
+            observe_ollama_metadata(response_metadata)
+            model_span.set(
+                prompt_variant=prompt.name,
+                prompt_hash=prompt.hash,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=parser.tokens,
+                first_token_ms=round((first_token_at - started) * 1000, 2) if first_token_at else None,
+                stopped_early=stopped_early,
+                prompt_eval_count=response_metadata.get("prompt_eval_count"),
+                prompt_eval_duration_ms=_ns_to_ms(response_metadata.get("prompt_eval_duration")),
+                eval_duration_ms=_ns_to_ms(response_metadata.get("eval_duration")),
+            )
+            if not parser.buffer:
+                raise ValueError("Модель вернула пустой поток.")
+            if stopped_early:
+                logger.info(f"Генерация остановлена после JSON действия ({parser.tokens} токенов).")
+            elif response_metadata.get("prompt_eval_count") is not None:
+                logger.info(
+                    f"Ollama: prompt_eval_count={response_metadata.get('prompt_eval_count')}, "
+                    f"prompt_eval_duration={response_metadata.get('prompt_eval_duration')} нс"
+                )
+            return {"messages": [AIMessage(content=parser.text, response_metadata=response_metadata)], **render_state}
+        except Exception as e:
+            logger.error(f"ОШИБКА во время вызова LLM: {e}")
+            model_span.set(error=str(e)[:200])
+            error_message = AIMessage(content='Action: {"action": "respond_to_user", "action_input": {"response": "Прости, Искра, я не могу подключиться к своему мозгу (Ollama)."}}')
+            return {"messages": [error_message]}
 
     
-def call_tool(state: AgentState):
+# Имя, под которым в историю попадает общий результат списка действий
+MULTI_ACTION_NAME = "parallel_actions"
+
+def _find_tool(tool_name: str):
+    for tool in nox_tools:
+        if tool.name == tool_name:
+            return tool
+    raise ValueError(f"Инструмент с именем '{tool_name}' не найден.")
+
+def _invoke_tool(selected_tool, tool_input):
+    """Синхронный вызов инструмента; выполняется в потоке, чтобы не блокировать цикл событий."""
+    try:
+        with span(f"tool.{selected_tool.name}"):
+            return selected_tool.invoke(tool_input)
+    except Exception:
+        TOOL_ERRORS.labels(tool=selected_tool.name).inc()
+        raise
+
+async def _execute_tool(tool_name: str, tool_input) -> str:
+    """Вызывает инструмент, а для объявивших cache_ttl сначала смотрит в кэш результатов."""
+    selected_tool = _find_tool(tool_name)
+    cached = tool_cache.lookup(selected_tool, tool_input)
+    if cached is not None:
+        result, age = cached
+        logger.info(f"Результат {tool_name} взят из кэша (возраст {age:.1f} с).")
+        # Модель должна знать, что данные получены не только что
+        return f"[из кэша, получено {age:.0f} с назад]\n{result}"
+    result = await asyncio.to_thread(_invoke_tool, selected_tool, tool_input)
+    tool_cache.store(selected_tool, tool_input, result)
+    return str(result)
+
+async def _run_actions(actions: List[dict]) -> str:
+    """
+    Выполняет независимые действия одновременно (не больше react_max_parallel_actions
+    за раз) и собирает их результаты в одно наблюдение. Ошибка одного действия
+    не отменяет остальные - модель увидит ее в своем пункте.
+    """
+    semaphore = asyncio.Semaphore(max(1, settings.react_max_parallel_actions))
+
+    async def run(index: int, action: dict) -> str:
+        tool_name = action["action"]
+        if tool_name == "respond_to_user":
+            return f"{index}. respond_to_user: пропущено - ответ пользователю дается отдельным шагом, когда результаты получены."
+        async with semaphore:
+            try:
+                result = await _execute_tool(tool_name, action["action_input"])
+            except Exception as e:
+                logger.error(f"Ошибка инструмента {tool_name} в списке действий: {e}")
+                result = f"Ошибка: {e}"
+        return f"{index}. {tool_name}:\n{result}"
+
+    results = await asyncio.gather(*(run(index, action) for index, action in enumerate(actions, 1)))
+    return "\n".join(results)
+
+async def call_tool(state: AgentState):
     """
     Парсит текстовый ответ модели, находит нужный инструмент, вызывает его
     и возвращает результат с уникальным tool_call_id.
+    Если модель прислала список действий, они выполняются параллельно,
+    а результаты возвращаются одним сообщением.
     """
     logger.info("Агент действует...")
     raw_response = state["messages"][-1].content
-    try:
-        logger.info(f"Полный ответ модели (Thought & Action):\n---\n{raw_response}\n---")
+    with span("call_tool") as tool_span:
+        try:
+            logger.info(f"Полный ответ модели (Thought & Action):\n---\n{raw_response}\n---")
 
-        action_str_match = raw_response.split("Action:")[-1].strip()
-        action_json = json.loads(action_str_match)
-        
-        tool_name = action_json.get("action")
-        tool_input = action_json.get("action_input")
-        if not tool_name or tool_input is None:
-            raise ValueError("В JSON отсутствуют поля 'action' или 'action_input'")
-
-        selected_tool = None
-        for tool in nox_tools:
-            if tool.name == tool_name:
-                selected_tool = tool
-                break
-        
-        if not selected_tool:
-            raise ValueError(f"Инструмент с именем '{tool_name}' не найден.")
+            try:
+                actions = parse_actions(raw_response)
+                for action_json in actions:
+                    if not action_json.get("action") or action_json.get("action_input") is None:
+                        raise ValueError("В JSON отсутствуют поля 'action' или 'action_input'")
+            except Exception:
+                PARSE_FAILURES.inc()
+                tool_span.set(parse_failed=True)
+                raise
 
-        response = selected_tool.invoke(tool_input)
-        
-        tool_call_id = str(uuid.uuid4())
-        
-        return {"messages": [ToolMessage(content=str(response), name=tool_name, tool_call_id=tool_call_id)]}
-        
-    except Exception as e:
-        logger.error(f"Ошибка парсинга или вызова инструмента: {e}")
-        # ИСПРАВЛЕНО: В случае ошибки возвращаем ТОЛЬКО ОРИГИНАЛЬНЫЙ ответ модели.
-        # Без лишних слов и дублирования.
-        return {"messages": [HumanMessage(content=raw_response)]}
+            tool_call_id = str(uuid.uuid4())
+
+            if len(actions) > 1:
+                tool_span.set(tool=MULTI_ACTION_NAME, actions=[action["action"] for action in actions])
+                logger.info(f"Параллельное выполнение {len(actions)} действий: {[action['action'] for action in actions]}")
+                observation = await _run_actions(actions)
+                return {"messages": [ToolMessage(content=observation, name=MULTI_ACTION_NAME, tool_call_id=tool_call_id)]}
+
+            tool_name = actions[0]["action"]
+            tool_span.set(tool=tool_name)
+            response = await _execute_tool(tool_name, actions[0]["action_input"])
+            
+            return {"messages": [ToolMessage(content=str(response), name=tool_name, tool_call_id=tool_call_id)]}
+            
+        except Exception as e:
+            logger.error(f"Ошибка парсинга или вызова инструмента: {e}")
+            tool_span.set(error=str(e)[:200])
+            # ИСПРАВЛЕНО: В случае ошибки возвращаем ТОЛЬКО ОРИГИНАЛЬНЫЙ ответ модели.
+            # Без лишних слов и дублирования.
+            return {"messages": [HumanMessage(content=raw_response)]}
 
 
 def should_continue(state: AgentState):
@@ -182,6 +261,38 @@ def should_continue(state: AgentState):
     # Во всех остальных случаях (вызов ha_control_tool) - продолжаем думать.
     return "continue"
 
+# --- Время работы узлов ---
+class NodeTimings:
+    """Накопленное время выполнения узлов графа (agent, action) по всем запросам."""
+
+    def __init__(self):
+        self.count: Dict[str, int] = {}
+        self.total_ms: Dict[str, float] = {}
+        self.max_ms: Dict[str, float] = {}
+
+    def record(self, node: str, elapsed_ms: float):
+        self.count[node] = self.count.get(node, 0) + 1
+        self.total_ms[node] = self.total_ms.get(node, 0.0) + elapsed_ms
+        self.max_ms[node] = max(self.max_ms.get(node, 0.0), elapsed_ms)
+
+    def reset(self):
+        self.count.clear()
+        self.total_ms.clear()
+        self.max_ms.clear()
+
+    def snapshot(self) -> dict:
+        return {
+            node: {
+                "count": count,
+                "avg_ms": round(self.total_ms[node] / count, 2),
+                "max_ms": round(self.max_ms[node], 2),
+                "total_ms": round(self.total_ms[node], 1),
+            }
+            for node, count in self.count.items()
+        }
+
+node_timings = NodeTimings()
+
 # --- Сборка графа ---
 def create_agent_graph():
     """Собирает все узлы и связи в единый граф."""
@@ -0,0 +1,418 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+from .config import settings
+from .scheduler import PRIORITY_INTERACTIVE, SchedulerBusyError, TokenCallback
+from .state_backend import StateBackend, state_backend
+
+logger = logging.getLogger(__name__)
+
+REPLY_QUEUE_PREFIX = "reply:"
+PARTITION_QUEUE_PREFIX = "partition:"
+LEASE_PREFIX = "partition:"
+
+# submit(user_id, text, on_token=..., priority=..., prompt_variant=..., on_start=...) -> awaitable с ответом
+LocalSubmit = Callable[..., Awaitable[str]]
+
+
+def _hash(value: str) -> int:
+    # hash() в Python случаен для каждого процесса - воркерам нужен общий
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class _RemoteTurn:
+    __slots__ = ("future", "on_token", "on_start")
+
+    def __init__(self, future: asyncio.Future, on_token: Optional[TokenCallback], on_start: Optional[Callable[[], None]]):
+        self.future = future
+        self.on_token = on_token
+        self.on_start = on_start
+
+
+class Cluster:
+    """
+    Распределение ходов между воркерами nox-core (процессами uvicorn или репликами).
+
+    user_id хэшируется в одну из partitions партиций, каждая партиция
+    закреплена за одним живым воркером (rendezvous-хэширование по списку из
+    heartbeat). Все ходы пользователя выполняет один процесс: его TurnScheduler
+    по-прежнему держит очередь пользователя, а сессия живет в кэше SessionStore
+    этого процесса. При смене состава воркеров переезжает только доля партиций
+    ушедшего или пришедшего воркера, их сессии выгружаются в общее хранилище.
+
+    Обслуживать партицию можно только с арендой в StateBackend (время жизни -
+    member_ttl, продлевается каждым heartbeat). Воркер стартует без партиций и
+    берет свои после первого heartbeat; отданную партицию он перестает
+    принимать сразу, но аренду снимает, лишь когда доиграны начатые в ней ходы
+    и записаны сессии. До этого новый владелец ее не получит, а сообщения
+    ждут в очереди партиции - два воркера не ведут один диалог одновременно.
+
+    Запрос, принятый чужим воркером, кладется в очередь партиции в StateBackend;
+    владелец выполняет ход и шлет события (started/token/done/error/busy) в
+    очередь ответов принявшего воркера. Свои партиции обслуживаются напрямую,
+    без хранилища, так что с одним воркером все работает как раньше.
+    """
+
+    def __init__(
+        self,
+        backend: StateBackend,
+        partitions: int,
+        heartbeat_interval: float,
+        member_ttl: float,
+        request_timeout: float,
+        enabled: bool,
+    ):
+        self.backend = backend
+        self.partitions = partitions
+        self.heartbeat_interval = heartbeat_interval
+        self.member_ttl = member_ttl
+        self.request_timeout = request_timeout
+        self.enabled = enabled
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.reply_queue = REPLY_QUEUE_PREFIX + self.worker_id
+
+        self.members: List[str] = [self.worker_id]
+        # В кластере партиции наши только с арендой (см. _claim); без кластера - все
+        self._owned: Set[int] = set() if enabled else set(range(partitions))
+        # Отданные партиции, на которых еще доигрываются ходы: аренда пока за нами
+        self._draining: Set[int] = set()
+        self._active_users: Callable[[], Iterable[str]] = lambda: ()
+        self._pending: Dict[str, _RemoteTurn] = {}
+        self._serving: set = set()
+        # (очередь, событие) для потока отправки; None - остановка
+        self._outbox: "queue.Queue" = queue.Queue()
+        self._local_submit: Optional[LocalSubmit] = None
+        self._on_partitions_lost: Optional[Callable[[Set[int]], None]] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._threads: List[threading.Thread] = []
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+        self.local_turns = 0
+        self.forwarded = 0
+        self.served_remote = 0
+        self.timeouts = 0
+        self.rebalances = 0
+
+    # --- Партиции ---
+
+    def partition_of(self, user_id: str) -> int:
+        return _hash(user_id) % self.partitions
+
+    def owner_of(self, partition: int) -> str:
+        return max(self.members, key=lambda member: _hash(f"{member}/{partition}"))
+
+    def owns(self, user_id: str) -> bool:
+        return self.partition_of(user_id) in self._owned
+
+    def _lease(self, partition: int) -> str:
+        return LEASE_PREFIX + str(partition)
+
+    def _update_members(self, members: List[str]):
+        if self.worker_id not in members:
+            members = sorted([*members, self.worker_id])
+        if members == self.members:
+            return
+        self.members = members
+        assigned = {p for p in range(self.partitions) if self.owner_of(p) == self.worker_id}
+        held = self._owned | self._draining
+        # Новые ходы в отданные партиции больше не принимаем, аренду держим до конца начатых
+        self._owned = held & assigned
+        self._draining = held - assigned
+        self.rebalances += 1
+        logger.info(f"Состав воркеров изменился ({len(members)}): за {self.worker_id} {len(assigned)} партиций из {self.partitions}.")
+
+    async def _release(self, partitions: Set[int]):
+        """Записывает сессии отданных партиций и только потом снимает их аренду."""
+        if self._on_partitions_lost is not None:
+            await asyncio.to_thread(self._on_partitions_lost, partitions)
+        await asyncio.to_thread(self.backend.release_leases, [self._lease(p) for p in sorted(partitions)], self.worker_id)
+
+    async def _claim(self):
+        """Продлевает аренды, берет освободившиеся партиции и отдает доигранные."""
+        assigned = {p for p in range(self.partitions) if self.owner_of(p) == self.worker_id}
+        held = self._owned | self._draining
+        wanted = sorted(assigned | held)
+        granted = await asyncio.to_thread(
+            self.backend.acquire_leases, [self._lease(p) for p in wanted], self.worker_id, self.member_ttl
+        )
+        granted = {int(name[len(LEASE_PREFIX):]) for name in granted}
+        expired = held - granted
+        if expired:
+            # Аренду не продлили вовремя, и ее забрал другой воркер: наши копии сессий устарели
+            logger.warning(f"Воркер {self.worker_id} потерял аренду {len(expired)} партиций.")
+            # Множества заменяем целиком: _owned без блокировки читает поток приема
+            self._owned = self._owned - expired
+            self._draining = self._draining - expired
+            if self._on_partitions_lost is not None:
+                await asyncio.to_thread(self._on_partitions_lost, expired)
+        owned = assigned & granted
+        if owned != self._owned:
+            self._owned = owned
+            logger.info(f"За воркером {self.worker_id} {len(owned)} партиций из {self.partitions}.")
+        busy = {self.partition_of(user_id) for user_id in self._active_users()}
+        drained = self._draining - busy
+        if drained:
+            await self._release(drained)
+            self._draining = self._draining - drained
+
+    async def _heartbeat(self):
+        self._update_members(await asyncio.to_thread(self.backend.heartbeat, self.worker_id, self.member_ttl))
+        await self._claim()
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self._heartbeat()
+            except Exception as e:
+                logger.error(f"Не удалось обновить список воркеров ({self.backend.name}): {e}")
+
+    # --- Отправка ходов ---
+
+    def submit(
+        self,
+        user_id: str,
+        text: str,
+        on_token: Optional[TokenCallback] = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        prompt_variant: Optional[str] = None,
+        on_start: Optional[Callable[[], None]] = None,
+    ) -> Awaitable[str]:
+        """
+        Выполняет ход у воркера-владельца user_id. Свой ход сразу уходит в
+        локальный планировщик (SchedulerBusyError - синхронно), чужой - в
+        очередь партиции; отказ владельца приходит как SchedulerBusyError при ожидании.
+        """
+        if not self.enabled or self.owns(user_id):
+            self.local_turns += 1
+            return self._local_submit(user_id, text, on_token=on_token, priority=priority,
+                                      prompt_variant=prompt_variant, on_start=on_start)
+        return self._forward(user_id, text, on_token, priority, prompt_variant, on_start)
+
+    async def _forward(self, user_id: str, text: str, on_token: Optional[TokenCallback], priority: int,
+                       prompt_variant: Optional[str], on_start: Optional[Callable[[], None]]) -> str:
+        request_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = _RemoteTurn(future, on_token, on_start)
+        partition = self.partition_of(user_id)
+        self.forwarded += 1
+        self._outbox.put((PARTITION_QUEUE_PREFIX + str(partition), {
+            "id": request_id,
+            "reply_to": self.reply_queue,
+            "user_id": user_id,
+            "text": text,
+            "priority": priority,
+            "prompt_variant": prompt_variant,
+            "stream": on_token is not None,
+        }))
+        try:
+            return await asyncio.wait_for(future, self.request_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise TimeoutError(f"Воркер {self.owner_of(partition)} не ответил за {self.request_timeout:.0f} с.")
+        finally:
+            self._pending.pop(request_id, None)
+
+    # --- Прием событий ---
+
+    def _dispatch(self, queue_name: str, raw: str):
+        """Вызывается в цикле событий для каждого элемента, забранного из хранилища."""
+        try:
+            message = json.loads(raw)
+        except ValueError:
+            logger.error(f"Неразборчивое сообщение в очереди {queue_name}: {raw[:100]}")
+            return
+        if queue_name == self.reply_queue:
+            self._on_reply(message)
+        else:
+            self._serve(message)
+
+    def _on_reply(self, message: dict):
+        turn = self._pending.get(message.get("id"))
+        if turn is None or turn.future.done():
+            # Ответ пришел после таймаута или отмены
+            return
+        event = message.get("event")
+        if event == "token":
+            if turn.on_token:
+                turn.on_token(message["delta"])
+        elif event == "started":
+            if turn.on_start:
+                turn.on_start()
+        elif event == "done":
+            turn.future.set_result(message["response"])
+        elif event == "busy":
+            turn.future.set_exception(SchedulerBusyError(message["detail"], retry_after=message["retry_after"]))
+        else:
+            turn.future.set_exception(RuntimeError(message.get("detail") or "Ошибка на воркере-владельце."))
+
+    def _serve(self, message: dict):
+        """Выполняет ход, присланный другим воркером, и отправляет ему события."""
+        reply_to, request_id = message["reply_to"], message["id"]
+        partition = self.partition_of(message["user_id"])
+        if partition not in self._owned:
+            # Забрали из очереди, пока партиция переезжала: пусть выполнит новый владелец
+            self._outbox.put((PARTITION_QUEUE_PREFIX + str(partition), message))
+            return
+
+        def send(event: str, **data):
+            self._outbox.put((reply_to, {"id": request_id, "event": event, **data}))
+
+        self.served_remote += 1
+        try:
+            answer = self._local_submit(
+                message["user_id"],
+                message["text"],
+                on_token=(lambda delta: send("token", delta=delta)) if message.get("stream") else None,
+                priority=message.get("priority", PRIORITY_INTERACTIVE),
+                prompt_variant=message.get("prompt_variant"),
+                on_start=lambda: send("started"),
+            )
+        except SchedulerBusyError as e:
+            send("busy", detail=str(e), retry_after=e.retry_after)
+            return
+
+        def on_done(task: asyncio.Future):
+            self._serving.discard(task)
+            if task.cancelled():
+                send("error", detail="Ход отменен.")
+            elif task.exception() is not None:
+                send("error", detail=str(task.exception()) or type(task.exception()).__name__)
+            else:
+                send("done", response=task.result())
+
+        task = asyncio.ensure_future(answer)
+        self._serving.add(task)
+        task.add_done_callback(on_done)
+
+    # --- Фоновые потоки ---
+
+    def _receive_loop(self):
+        while not self._stopping:
+            queues = [self.reply_queue] + [PARTITION_QUEUE_PREFIX + str(p) for p in sorted(self._owned)]
+            try:
+                item = self.backend.pop(queues, timeout=1.0)
+            except Exception as e:
+                logger.error(f"Ошибка чтения очередей ({self.backend.name}): {e}")
+                time.sleep(1.0)
+                continue
+            if item is not None:
+                self._loop.call_soon_threadsafe(self._dispatch, *item)
+
+    def _send_loop(self):
+        while True:
+            item = self._outbox.get()
+            if item is None:
+                return
+            batch = [item]
+            # Токены, накопившиеся за время предыдущей отправки, склеиваем в одно событие
+            while True:
+                try:
+                    item = self._outbox.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._outbox.put(None)
+                    break
+                target, event = item
+                last_target, last_event = batch[-1]
+                if (event.get("event") == "token" and last_event.get("event") == "token"
+                        and target == last_target and event["id"] == last_event["id"]):
+                    last_event["delta"] += event["delta"]
+                else:
+                    batch.append(item)
+            for target, event in batch:
+                try:
+                    self.backend.push(target, json.dumps(event, ensure_ascii=False))
+                except Exception as e:
+                    logger.error(f"Не удалось отправить событие в {target} ({self.backend.name}): {e}")
+
+    # --- Запуск ---
+
+    async def start(
+        self,
+        local_submit: LocalSubmit,
+        on_partitions_lost: Optional[Callable[[Set[int]], None]] = None,
+        active_users: Optional[Callable[[], Iterable[str]]] = None,
+    ):
+        """
+        on_partitions_lost(partitions) вызывается в отдельном потоке и должен записать
+        сессии этих партиций в хранилище; active_users() - пользователи с начатыми ходами.
+        """
+        self._local_submit = local_submit
+        self._on_partitions_lost = on_partitions_lost
+        if active_users is not None:
+            self._active_users = active_users
+        if not self.enabled or self._threads:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._stopping = False
+        try:
+            await self._heartbeat()
+        except Exception as e:
+            logger.error(f"Не удалось зарегистрировать воркер ({self.backend.name}): {e}")
+        self._threads = [
+            threading.Thread(target=self._receive_loop, name="cluster-receive", daemon=True),
+            threading.Thread(target=self._send_loop, name="cluster-send", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+        logger.info(f"Воркер {self.worker_id} в кластере ({self.backend.name}), воркеров: {len(self.members)}.")
+
+    async def stop(self):
+        if not self._threads:
+            return
+        self._heartbeat_task.cancel()
+        self._heartbeat_task = None
+        self._stopping = True
+        self._outbox.put(None)
+        await asyncio.to_thread(lambda: [thread.join() for thread in self._threads])
+        self._threads = []
+        for turn in self._pending.values():
+            if not turn.future.done():
+                turn.future.set_exception(RuntimeError("Воркер останавливается."))
+        held, self._owned, self._draining = self._owned | self._draining, set(), set()
+        try:
+            if held:
+                await self._release(held)
+            await asyncio.to_thread(self.backend.leave, self.worker_id)
+        except Exception as e:
+            logger.error(f"Не удалось снять воркер с учета ({self.backend.name}): {e}")
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "worker_id": self.worker_id,
+            "backend": self.backend.name,
+            "members": len(self.members),
+            "owned_partitions": len(self._owned),
+            "draining_partitions": len(self._draining),
+            "partitions": self.partitions,
+            "local_turns": self.local_turns,
+            "forwarded": self.forwarded,
+            "served_remote": self.served_remote,
+            "in_flight_remote": len(self._pending),
+            "timeouts": self.timeouts,
+            "rebalances": self.rebalances,
+        }
+
+
+cluster = Cluster(
+    backend=state_backend,
+    partitions=settings.cluster_partitions,
+    heartbeat_interval=settings.cluster_heartbeat_interval,
+    member_ttl=settings.cluster_member_ttl,
+    request_timeout=settings.cluster_request_timeout,
+    enabled=settings.clustered,
+)
@@ -1,4 +1,5 @@
 import os
+from typing import List, Literal, Optional
 from pydantic_settings import BaseSettings
 from pydantic import Field
 
@@ -12,9 +13,137 @@ class Settings(BaseSettings):
     
     # ИЗМЕНЕНИЕ: Теперь читаем модель из .env
     ollama_model: str = Field(default="gemma3n:e4b", env="OLLAMA_MODEL")
-    
+    ollama_keep_alive: str = Field(default="30m", env="OLLAMA_KEEP_ALIVE")
+
+    # Несколько узлов Ollama через запятую; если пусто, используется OLLAMA_BASE_URL.
+    # Лимиты OLLAMA_BACKEND_MAX_CONCURRENCY и SCHEDULER_MAX_CONCURRENCY общие для всех NOX_WORKERS
+    # (каждый воркер получает свою долю, см. per_worker), но не для реплик в разных контейнерах
+    ollama_base_urls: str = Field(default="", env="OLLAMA_BASE_URLS")
+    ollama_backend_max_concurrency: int = Field(default=2, env="OLLAMA_BACKEND_MAX_CONCURRENCY")
+    ollama_health_interval: float = Field(default=10.0, env="OLLAMA_HEALTH_INTERVAL")
+
     lancedb_path: str = "/app/lancedb_data"
 
+    # Хранилище сессий (краткосрочная память пользователей)
+    sessions_db_path: str = Field(default="/app/state/sessions.db", env="SESSIONS_DB_PATH")
+    sessions_max_count: int = Field(default=1000, env="SESSIONS_MAX_COUNT")
+    sessions_max_bytes: int = Field(default=64 * 1024 * 1024, env="SESSIONS_MAX_BYTES")
+    sessions_idle_ttl: float = Field(default=3600.0, env="SESSIONS_IDLE_TTL")
+
+    # Общее состояние воркеров: sqlite - файл SESSIONS_DB_PATH (одна машина), redis - STATE_REDIS_URL
+    state_backend: Literal["sqlite", "redis"] = Field(default="sqlite", env="STATE_BACKEND")
+    state_redis_url: str = Field(default="redis://localhost:6379/0", env="STATE_REDIS_URL")
+    # Число процессов uvicorn; при NOX_WORKERS > 1 или CLUSTER_ENABLED ходы распределяются
+    # между воркерами по user_id через общие очереди (см. core/cluster.py)
+    nox_workers: int = Field(default=1, env="NOX_WORKERS")
+    cluster_enabled: bool = Field(default=False, env="CLUSTER_ENABLED")
+    cluster_partitions: int = Field(default=64, env="CLUSTER_PARTITIONS")
+    cluster_heartbeat_interval: float = Field(default=2.0, env="CLUSTER_HEARTBEAT_INTERVAL")
+    cluster_member_ttl: float = Field(default=6.0, env="CLUSTER_MEMBER_TTL")
+    cluster_request_timeout: float = Field(default=300.0, env="CLUSTER_REQUEST_TIMEOUT")
+    # Общий каталог метрик Prometheus для воркеров; пусто - свой каталог во временной папке на каждый запуск
+    prometheus_multiproc_dir: Optional[str] = Field(default=None, env="PROMETHEUS_MULTIPROC_DIR")
+
+    # Пул прогретых исполнителей для python_script_executor
+    sandbox_pool_size: int = Field(default=2, env="SANDBOX_POOL_SIZE")
+    sandbox_preload_modules: str = Field(default="os,json,httpx", env="SANDBOX_PRELOAD_MODULES")
+    sandbox_max_runs: int = Field(default=50, env="SANDBOX_MAX_RUNS")
+    sandbox_timeout: float = Field(default=30.0, env="SANDBOX_TIMEOUT")
+    # Вывод скрипта: жесткий лимит (дальше скрипт останавливается), сколько байт начала и конца
+    # попадает в ответ модели, и куда сохранять полный вывод (пусто - не сохранять)
+    sandbox_output_max_bytes: int = Field(default=1024 * 1024, env="SANDBOX_OUTPUT_MAX_BYTES")
+    sandbox_output_head_bytes: int = Field(default=3000, env="SANDBOX_OUTPUT_HEAD_BYTES")
+    sandbox_output_tail_bytes: int = Field(default=1500, env="SANDBOX_OUTPUT_TAIL_BYTES")
+    sandbox_spill_dir: Optional[str] = Field(default=None, env="SANDBOX_SPILL_DIR")
+    sandbox_spill_keep: int = Field(default=50, env="SANDBOX_SPILL_KEEP")
+
+    # Бюджет краткосрочной памяти (в токенах gemma, оценка без токенизатора)
+    stm_max_tokens: int = Field(default=1500, env="STM_MAX_TOKENS")
+    stm_summarize: bool = Field(default=True, env="STM_SUMMARIZE")
+    stm_summary_max_tokens: int = Field(default=300, env="STM_SUMMARY_MAX_TOKENS")
+    stm_tool_result_max_tokens: int = Field(default=400, env="STM_TOOL_RESULT_MAX_TOKENS")
+
+    # Быстрый путь для частых команд умного дома (без LLM)
+    router_enabled: bool = Field(default=True, env="ROUTER_ENABLED")
+    router_min_confidence: float = Field(default=0.8, env="ROUTER_MIN_CONFIDENCE")
+    router_use_embeddings: bool = Field(default=True, env="ROUTER_USE_EMBEDDINGS")
+    router_nn_threshold: float = Field(default=0.92, env="ROUTER_NN_THRESHOLD")
+    router_max_exemplars: int = Field(default=500, env="ROUTER_MAX_EXEMPLARS")
+
+    # Семантический кэш ответов агента (LanceDB)
+    response_cache_enabled: bool = Field(default=True, env="RESPONSE_CACHE_ENABLED")
+    response_cache_scope: Literal["user", "global"] = Field(default="user", env="RESPONSE_CACHE_SCOPE")
+    response_cache_threshold: float = Field(default=0.95, env="RESPONSE_CACHE_THRESHOLD")
+    response_cache_ttl: float = Field(default=24 * 3600.0, env="RESPONSE_CACHE_TTL")
+    response_cache_state_ttl: float = Field(default=300.0, env="RESPONSE_CACHE_STATE_TTL")
+    response_cache_max_entries: int = Field(default=10000, env="RESPONSE_CACHE_MAX_ENTRIES")
+    # Более короткие реплики ("да", "почему?") без истории диалога не имеют смысла - мимо кэша
+    response_cache_min_words: int = Field(default=3, env="RESPONSE_CACHE_MIN_WORDS")
+
+    # Долгосрочная память (LanceDB + ANN)
+    ltm_enabled: bool = Field(default=True, env="LTM_ENABLED")
+    ltm_top_k: int = Field(default=3, env="LTM_TOP_K")
+    ltm_min_similarity: float = Field(default=0.5, env="LTM_MIN_SIMILARITY")
+    ltm_recall_timeout: float = Field(default=0.2, env="LTM_RECALL_TIMEOUT")
+    ltm_batch_size: int = Field(default=64, env="LTM_BATCH_SIZE")
+    ltm_batch_interval: float = Field(default=1.0, env="LTM_BATCH_INTERVAL")
+    ltm_queue_size: int = Field(default=10000, env="LTM_QUEUE_SIZE")
+    ltm_index_min_rows: int = Field(default=10000, env="LTM_INDEX_MIN_ROWS")
+    ltm_optimize_every: int = Field(default=1000, env="LTM_OPTIMIZE_EVERY")
+    ltm_nprobes: int = Field(default=20, env="LTM_NPROBES")
+
+    # Планировщик ходов: 0 - лимит по числу узлов Ollama и их OLLAMA_BACKEND_MAX_CONCURRENCY
+    scheduler_max_concurrency: int = Field(default=0, env="SCHEDULER_MAX_CONCURRENCY")
+    scheduler_max_queue: int = Field(default=32, env="SCHEDULER_MAX_QUEUE")
+    # Склеивать сообщения, пришедшие подряд в пределах окна (с); 0 - не склеивать
+    scheduler_merge_window: float = Field(default=0.0, env="SCHEDULER_MERGE_WINDOW")
+
+    # Асинхронные задачи (/jobs)
+    jobs_retention: float = Field(default=600.0, env="JOBS_RETENTION")
+    jobs_max: int = Field(default=10000, env="JOBS_MAX")
+    jobs_callback_timeout: float = Field(default=10.0, env="JOBS_CALLBACK_TIMEOUT")
+    jobs_callback_retries: int = Field(default=3, env="JOBS_CALLBACK_RETRIES")
+
+    # Прогрев при старте: модель загружается в память Ollama пустым запросом, эмбеддинги и LanceDB - заранее
+    startup_warmup: bool = Field(default=True, env="STARTUP_WARMUP")
+
+    # Трассы медленных ходов: порог в секундах (0 - не собирать), доля сохраняемых и файл JSONL
+    trace_slow_threshold: float = Field(default=15.0, env="TRACE_SLOW_THRESHOLD")
+    trace_slow_sample_rate: float = Field(default=1.0, env="TRACE_SLOW_SAMPLE_RATE")
+    trace_slow_keep: int = Field(default=50, env="TRACE_SLOW_KEEP")
+    trace_slow_log_path: Optional[str] = Field(default=None, env="TRACE_SLOW_LOG_PATH")
+
+    # Промпт из configs/llm_instructions.yaml: как часто проверять файл на изменения (0 - только
+    # /reload_instructions) и какой вариант брать, если запрос не указал свой
+    prompt_watch_interval: float = Field(default=2.0, env="PROMPT_WATCH_INTERVAL")
+    prompt_default_variant: str = Field(default="default", env="PROMPT_DEFAULT_VARIANT")
+
+    # Обрывать генерацию, как только JSON действия в ответе модели закрылся
+    react_early_stop: bool = Field(default=True, env="REACT_EARLY_STOP")
+    # Доля шагов, которые все равно генерируются до конца, чтобы оценить сэкономленные токены
+    react_early_stop_calibration_rate: float = Field(default=0.02, env="REACT_EARLY_STOP_CALIBRATION_RATE")
+    # Сколько инструментов из списка 'Action: [...]' выполняется одновременно
+    react_max_parallel_actions: int = Field(default=4, env="REACT_MAX_PARALLEL_ACTIONS")
+
+    # Кэш результатов инструментов, объявивших cache_ttl (скрипты только на чтение)
+    tool_cache_enabled: bool = Field(default=True, env="TOOL_CACHE_ENABLED")
+    tool_cache_max_entries: int = Field(default=256, env="TOOL_CACHE_MAX_ENTRIES")
+    tool_cache_script_ttl: float = Field(default=60.0, env="TOOL_CACHE_SCRIPT_TTL")
+
+    @property
+    def clustered(self) -> bool:
+        return self.cluster_enabled or self.nox_workers > 1
+
+    def per_worker(self, limit: int) -> int:
+        """Доля общего лимита на один процесс uvicorn: воркеры не делят между собой счетчики."""
+        share = limit // max(self.nox_workers, 1)
+        return max(share, 1)
+
+    @property
+    def ollama_urls(self) -> List[str]:
+        urls = [url.strip() for url in self.ollama_base_urls.split(",") if url.strip()]
+        return urls or [self.ollama_base_url]
+
     class Config:
         env_file = ".env"
         env_file_encoding = 'utf-8'
@@ -0,0 +1,312 @@
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Union
+
+import aiohttp
+import httpx
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+StateListener = Callable[[str, Optional[dict], Optional[dict]], None]
+
+
+class HomeAssistantError(RuntimeError):
+    """Ошибка при обращении к Home Assistant."""
+
+
+def _websocket_url(base_url: str) -> str:
+    base = base_url.rstrip("/")
+    if base.startswith("https://"):
+        base = "wss://" + base[len("https://"):]
+    elif base.startswith("http://"):
+        base = "ws://" + base[len("http://"):]
+    return base + "/api/websocket"
+
+
+class HomeAssistantClient:
+    """
+    Постоянное подключение к Home Assistant.
+
+    Фоновый поток держит один websocket: при подключении забирает все состояния
+    (get_states) и подписывается на state_changed, так что состояние любой
+    сущности читается из памяти без сетевого запроса. Вызовы сервисов уходят
+    сразу по тому же соединению, без нового HTTP-запроса на каждый. HA просим
+    склеивать события в один кадр (coalesce_messages) - при всплеске
+    state_changed это заметно меньше кадров. Пока websocket не поднят,
+    используется REST через общий пул соединений httpx.
+    """
+
+    def __init__(self, base_url: str, token: str, call_timeout: float = 10.0):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.call_timeout = call_timeout
+
+        self._states: Dict[str, dict] = {}
+        self._states_changed = threading.Condition()
+        self._listeners: List[StateListener] = []
+        self._connected = threading.Event()
+        self._ids = itertools.count(1)
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._stopping = False
+
+        self._http: Optional[httpx.Client] = None
+        self._http_lock = threading.Lock()
+
+        self.service_calls = 0
+        self.events = 0
+        self.reconnects = 0
+
+    # --- Подписки на изменения ---
+
+    def add_listener(self, listener: StateListener):
+        """Регистрирует колбэк (entity_id, old_state, new_state) на каждое изменение состояния."""
+        self._listeners.append(listener)
+
+    def _apply_state(self, entity_id: str, old_state: Optional[dict], new_state: Optional[dict]):
+        with self._states_changed:
+            if new_state is None:
+                self._states.pop(entity_id, None)
+            else:
+                self._states[entity_id] = new_state
+            self._states_changed.notify_all()
+        for listener in self._listeners:
+            try:
+                listener(entity_id, old_state, new_state)
+            except Exception as e:
+                logger.error(f"Ошибка в обработчике изменения состояния {entity_id}: {e}")
+
+    # --- REST (резервный путь) ---
+
+    def _http_client(self) -> httpx.Client:
+        with self._http_lock:
+            if self._http is None:
+                self._http = httpx.Client(
+                    base_url=self.base_url,
+                    headers={"Authorization": f"Bearer {self.token}"},
+                    timeout=self.call_timeout,
+                    limits=httpx.Limits(max_keepalive_connections=5, max_connections=10),
+                )
+            return self._http
+
+    def _rest_get_state(self, entity_id: str) -> Optional[dict]:
+        response = self._http_client().get(f"/api/states/{entity_id}")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    def _rest_call_service(self, domain: str, service: str, data: dict) -> Any:
+        response = self._http_client().post(f"/api/services/{domain}/{service}", json=data)
+        response.raise_for_status()
+        return response.json()
+
+    # --- Websocket ---
+
+    async def _request(self, message: dict) -> Any:
+        if self._ws is None or self._ws.closed:
+            raise HomeAssistantError("Нет websocket-подключения к Home Assistant.")
+        message = {"id": next(self._ids), **message}
+        future = self._loop.create_future()
+        self._pending[message["id"]] = future
+        try:
+            await self._ws.send_json(message)
+        except Exception as e:
+            self._pending.pop(message["id"], None)
+            raise HomeAssistantError(f"Не удалось отправить запрос в HA: {e}")
+        return await future
+
+    def _handle_message(self, message: dict):
+        if message.get("type") == "result":
+            future = self._pending.pop(message.get("id"), None)
+            if future is None or future.done():
+                return
+            if message.get("success"):
+                future.set_result(message.get("result"))
+            else:
+                error = message.get("error") or {}
+                future.set_exception(HomeAssistantError(error.get("message", "Неизвестная ошибка HA")))
+        elif message.get("type") == "event":
+            event = message.get("event") or {}
+            if event.get("event_type") != "state_changed":
+                return
+            data = event.get("data") or {}
+            self.events += 1
+            self._apply_state(data.get("entity_id"), data.get("old_state"), data.get("new_state"))
+
+    async def _session(self, http: aiohttp.ClientSession):
+        async with http.ws_connect(_websocket_url(self.base_url), heartbeat=30) as ws:
+            hello = await ws.receive_json()
+            if hello.get("type") == "auth_required":
+                await ws.send_json({"type": "auth", "access_token": self.token})
+                auth = await ws.receive_json()
+                if auth.get("type") != "auth_ok":
+                    raise HomeAssistantError(f"Авторизация в HA не удалась: {auth.get('message', auth.get('type'))}")
+            self._ws = ws
+            # Ответ не ждем: старые версии HA этой команды не знают, ошибка просто игнорируется
+            await ws.send_json({"id": next(self._ids), "type": "supported_features", "features": {"coalesce_messages": 1}})
+
+            reader = asyncio.ensure_future(self._read_loop(ws))
+            try:
+                subscribe = asyncio.ensure_future(self._request({"type": "subscribe_events", "event_type": "state_changed"}))
+                states = await self._request({"type": "get_states"})
+                await subscribe
+                with self._states_changed:
+                    self._states = {s["entity_id"]: s for s in states}
+                    self._states_changed.notify_all()
+                self._connected.set()
+                logger.info(f"Подключено к Home Assistant по websocket, сущностей: {len(states)}")
+                await reader
+            finally:
+                reader.cancel()
+                self._connected.clear()
+                self._ws = None
+                for future in self._pending.values():
+                    if not future.done():
+                        future.set_exception(HomeAssistantError("Соединение с HA потеряно."))
+                self._pending.clear()
+
+    async def _read_loop(self, ws: aiohttp.ClientWebSocketResponse):
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                payload = msg.json()
+                # HA может присылать пачку сообщений одним кадром
+                for message in payload if isinstance(payload, list) else [payload]:
+                    self._handle_message(message)
+            elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                break
+
+    async def _run(self):
+        backoff = 1.0
+        async with aiohttp.ClientSession() as http:
+            while not self._stopping:
+                try:
+                    await self._session(http)
+                    backoff = 1.0
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.warning(f"Websocket Home Assistant недоступен ({e}), повтор через {backoff:.0f} с.")
+                if self._stopping:
+                    break
+                self.reconnects += 1
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60.0)
+
+    def _thread_main(self):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._run())
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._loop.close()
+
+    # --- Жизненный цикл ---
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._thread_main, name="home-assistant", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopping = True
+
+        def _cancel_all():
+            for task in asyncio.all_tasks(self._loop):
+                task.cancel()
+
+        self._loop.call_soon_threadsafe(_cancel_all)
+        self._thread.join(timeout=5)
+        self._thread = None
+        if self._http is not None:
+            self._http.close()
+            self._http = None
+
+    def wait_ready(self, timeout: float) -> bool:
+        return self._connected.wait(timeout)
+
+    # --- Публичный интерфейс ---
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    def get_state(self, entity_id: str) -> Optional[dict]:
+        """Состояние сущности из кэша, а без websocket - через REST."""
+        if self.connected:
+            with self._states_changed:
+                return self._states.get(entity_id)
+        return self._rest_get_state(entity_id)
+
+    def list_states(self, domain: Optional[str] = None) -> List[dict]:
+        if self.connected:
+            with self._states_changed:
+                states = list(self._states.values())
+        else:
+            response = self._http_client().get("/api/states")
+            response.raise_for_status()
+            states = response.json()
+        if domain:
+            states = [s for s in states if s["entity_id"].startswith(f"{domain}.")]
+        return sorted(states, key=lambda s: s["entity_id"])
+
+    def call_service(
+        self,
+        domain: str,
+        service: str,
+        entity_id: Union[str, List[str], None] = None,
+        data: Optional[dict] = None,
+    ) -> Any:
+        """Вызывает сервис HA: по websocket, а пока его нет - через REST."""
+        self.service_calls += 1
+        service_data = dict(data or {})
+        if self.connected:
+            message = {"type": "call_service", "domain": domain, "service": service, "service_data": service_data}
+            if entity_id:
+                message["target"] = {"entity_id": entity_id}
+            future = asyncio.run_coroutine_threadsafe(self._request(message), self._loop)
+            return future.result(timeout=self.call_timeout)
+        if entity_id:
+            service_data["entity_id"] = entity_id
+        return self._rest_call_service(domain, service, service_data)
+
+    def wait_for_update(self, entity_ids: List[str], previous: Dict[str, Optional[dict]], timeout: float) -> Dict[str, Optional[dict]]:
+        """Ждет, пока у сущностей сменится состояние (после вызова сервиса), но не дольше timeout."""
+        deadline = time.monotonic() + timeout
+        with self._states_changed:
+            while True:
+                current = {eid: self._states.get(eid) for eid in entity_ids}
+                if not self.connected or any(current[eid] != previous.get(eid) for eid in entity_ids):
+                    return current
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return current
+                self._states_changed.wait(remaining)
+
+    def stats(self) -> dict:
+        with self._states_changed:
+            entities = len(self._states)
+        return {
+            "connected": self.connected,
+            "entities": entities,
+            "events": self.events,
+            "service_calls": self.service_calls,
+            "reconnects": self.reconnects,
+        }
+
+
+ha_client = HomeAssistantClient(settings.ha_url, settings.ha_tok)
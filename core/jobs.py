@@ -0,0 +1,251 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import AsyncIterator, List, Optional, Tuple
+
+import httpx
+
+from .config import settings
+from .state_backend import StateBackend, state_backend
+
+logger = logging.getLogger(__name__)
+
+JobEvent = Tuple[str, dict]
+
+
+class Job:
+    """Одна команда, принятая асинхронно: статус, накопленный текст ответа и подписчики."""
+
+    def __init__(self, user_id: str, text: str, callback_url: Optional[str]):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.text = text
+        self.callback_url = callback_url
+        self.status = "queued"
+        self.result: Optional[str] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._deltas: List[str] = []
+        self._listeners: List[asyncio.Queue] = []
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "error")
+
+    def _publish(self, event: str, data: dict):
+        for queue in self._listeners:
+            queue.put_nowait((event, data))
+
+    def mark_running(self):
+        if self.status == "queued":
+            self.status = "running"
+            self.started_at = time.time()
+
+    def push_token(self, delta: str):
+        self.mark_running()
+        self._deltas.append(delta)
+        self._publish("token", {"delta": delta})
+
+    def finish(self, result: str):
+        self.status, self.result, self.finished_at = "done", result, time.time()
+        self._publish(*self._final_event())
+
+    def fail(self, error: str):
+        self.status, self.error, self.finished_at = "error", error, time.time()
+        self._publish(*self._final_event())
+
+    def _final_event(self) -> JobEvent:
+        if self.status == "done":
+            return "done", {"response": self.result}
+        return "error", {"detail": self.error}
+
+    async def events(self) -> AsyncIterator[JobEvent]:
+        """Уже сгенерированный текст одним событием, затем новые токены до 'done'/'error'."""
+        text = "".join(self._deltas)
+        if text:
+            yield "token", {"delta": text}
+        if self.finished:
+            yield self._final_event()
+            return
+        queue: asyncio.Queue = asyncio.Queue()
+        self._listeners.append(queue)
+        try:
+            while True:
+                event, data = await queue.get()
+                yield event, data
+                if event in ("done", "error"):
+                    return
+        finally:
+            self._listeners.remove(queue)
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "user_id": self.user_id,
+            "status": self.status,
+            "response": self.result,
+            "error": self.error,
+            "partial": "".join(self._deltas) if not self.finished else None,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    """
+    Реестр асинхронных команд.
+
+    Клиент получает job_id сразу, а результат забирает через GET /jobs/{id},
+    поток событий /jobs/{id}/events или callback_url, на который ответ
+    отправляется POST-запросом (с повторами) из общего пула соединений.
+    Завершенные задачи хранятся retention секунд, всего не больше max_jobs.
+
+    Если задан backend (несколько воркеров), запись задачи дублируется в общее
+    хранилище: GET /jobs/{id} может прийти на любой воркер, а не только на тот,
+    что принял задачу. Чужая задача видна без потока токенов - только статус
+    и итоговый ответ.
+    """
+
+    def __init__(self, retention: float, max_jobs: int, callback_timeout: float, callback_retries: int,
+                 backend: Optional[StateBackend] = None, poll_interval: float = 0.5):
+        self.retention = retention
+        self.max_jobs = max_jobs
+        self.callback_timeout = callback_timeout
+        self.callback_retries = callback_retries
+        self.backend = backend
+        self.poll_interval = poll_interval
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._http: Optional[httpx.AsyncClient] = None
+
+        self.created = 0
+        self.callbacks_sent = 0
+        self.callbacks_failed = 0
+
+    def create(self, user_id: str, text: str, callback_url: Optional[str] = None) -> Job:
+        self._purge()
+        job = Job(user_id, text, callback_url)
+        self._jobs[job.id] = job
+        self.created += 1
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def discard(self, job_id: str):
+        self._jobs.pop(job_id, None)
+
+    async def share(self, job: Job):
+        """Пишет запись задачи в общее хранилище, чтобы ее видели другие воркеры."""
+        if self.backend is None:
+            return
+        try:
+            await asyncio.to_thread(self.backend.set, f"job:{job.id}", json.dumps(job.to_dict(), ensure_ascii=False), self.retention)
+        except Exception as e:
+            logger.error(f"Не удалось записать задачу {job.id} в общее хранилище: {e}")
+
+    async def fetch(self, job_id: str) -> Optional[dict]:
+        """Запись задачи: своя из памяти, чужая - из общего хранилища."""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        if self.backend is None:
+            return None
+        try:
+            data = await asyncio.to_thread(self.backend.get, f"job:{job_id}")
+        except Exception as e:
+            logger.error(f"Не удалось прочитать задачу {job_id} из общего хранилища: {e}")
+            return None
+        return json.loads(data) if data else None
+
+    async def remote_events(self, job_id: str) -> AsyncIterator[JobEvent]:
+        """События задачи, принятой другим воркером: опрашиваем ее запись до завершения."""
+        while True:
+            data = await self.fetch(job_id)
+            if data is None:
+                yield "error", {"detail": "Задача не найдена."}
+                return
+            if data["status"] == "done":
+                yield "done", {"response": data["response"]}
+                return
+            if data["status"] == "error":
+                yield "error", {"detail": data["error"]}
+                return
+            await asyncio.sleep(self.poll_interval)
+
+    def _purge(self):
+        """Удаляет завершенные задачи старше retention и самые старые при переполнении."""
+        cutoff = time.time() - self.retention
+        overflow = len(self._jobs) - self.max_jobs + 1
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and (job.finished_at < cutoff or overflow > 0):
+                del self._jobs[job_id]
+                overflow -= 1
+
+    async def complete(self, job: Job, answer):
+        """
+        Дожидается ответа планировщика, фиксирует результат и доставляет его по callback_url.
+        Начальную запись задачи в общее хранилище делает вызывающий (см. share).
+        """
+        try:
+            job.finish(await answer)
+        except asyncio.CancelledError:
+            job.fail("Задача отменена.")
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при выполнении задачи {job.id}: {e}")
+            job.fail(str(e))
+        await self.share(job)
+        if job.callback_url:
+            await self._deliver(job)
+
+    async def _deliver(self, job: Job):
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                timeout=self.callback_timeout,
+                limits=httpx.Limits(max_keepalive_connections=10, max_connections=50),
+            )
+        delay = 1.0
+        for attempt in range(1, self.callback_retries + 1):
+            try:
+                response = await self._http.post(job.callback_url, json=job.to_dict())
+                response.raise_for_status()
+                self.callbacks_sent += 1
+                return
+            except httpx.HTTPError as e:
+                logger.warning(f"Callback задачи {job.id} не доставлен (попытка {attempt}): {e}")
+            if attempt < self.callback_retries:
+                await asyncio.sleep(delay)
+                delay *= 2
+        self.callbacks_failed += 1
+
+    async def stop(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    def stats(self) -> dict:
+        statuses = {}
+        for job in self._jobs.values():
+            statuses[job.status] = statuses.get(job.status, 0) + 1
+        return {
+            "jobs": len(self._jobs),
+            "by_status": statuses,
+            "created": self.created,
+            "callbacks_sent": self.callbacks_sent,
+            "callbacks_failed": self.callbacks_failed,
+        }
+
+
+job_manager = JobManager(
+    retention=settings.jobs_retention,
+    max_jobs=settings.jobs_max,
+    callback_timeout=settings.jobs_callback_timeout,
+    callback_retries=settings.jobs_callback_retries,
+    backend=state_backend if settings.clustered else None,
+)
@@ -1,14 +1,273 @@
 # core/llm_client.py
 
-# ИЗМЕНЕНИЕ: Импортируем из правильной библиотеки
-from langchain_community.chat_models import ChatOllama
+import asyncio
+import logging
+import time
+import zlib
+from typing import AsyncIterator, List, Optional
+
+import httpx
+from langchain_core.messages import BaseMessage, BaseMessageChunk
+from langchain_core.runnables import RunnableConfig
+
 from .config import settings
 
-def get_llm():
+logger = logging.getLogger(__name__)
+
+# После JSON действия модель любит дописывать выдуманный "Observation:" или
+# закрывать ход. На этих последовательностях Ollama останавливается сама.
+REACT_STOP_SEQUENCES = ["Observation:", "<end_of_turn>"]
+
+def get_llm(base_url: Optional[str] = None):
     """Инициализирует и возвращает клиент для работы с LLM через Ollama."""
+    # Импорт модуля ChatOllama заметно тормозит старт, поэтому он здесь, а не наверху
+    from langchain_community.chat_models import ChatOllama
+
     llm = ChatOllama(
         model=settings.ollama_model,
-        base_url=settings.ollama_base_url,
+        base_url=base_url or settings.ollama_base_url,
         temperature=1.0, # Как рекомендовано в плане для gemma3n
+        stop=REACT_STOP_SEQUENCES,
+        # Модель не выгружается между запросами, иначе теряется и кэш префикса промпта
+        keep_alive=settings.ollama_keep_alive,
     )
-    return llm
\ No newline at end of file
+    return llm
+
+
+def _model_name(name: Optional[str]) -> str:
+    # Ollama дописывает ":latest" к моделям без тега: "gemma3n" и "gemma3n:latest" - одна модель
+    name = (name or "").strip()
+    return name[:-len(":latest")] if name.endswith(":latest") else name
+
+
+class NoHealthyBackendError(RuntimeError):
+    """Ни один из узлов Ollama не доступен."""
+
+
+class OllamaBackend:
+    """Один узел Ollama: клиент, лимит параллельных запросов и счетчики."""
+
+    def __init__(self, base_url: str, max_concurrency: int):
+        self.base_url = base_url.rstrip("/")
+        self._llm = None
+        self.max_concurrency = max_concurrency
+        self.healthy = True
+        # None - последняя проверка не дошла до узла, и про модель ничего не известно
+        self.model_missing: Optional[bool] = False
+        self.last_error: Optional[str] = None
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.latency_ms: Optional[float] = None
+        self.first_token_ms: Optional[float] = None
+
+    @property
+    def llm(self):
+        if self._llm is None:
+            self._llm = get_llm(self.base_url)
+        return self._llm
+
+    @property
+    def has_capacity(self) -> bool:
+        return self.outstanding < self.max_concurrency
+
+    def mark_unhealthy(self, reason: str):
+        if self.healthy:
+            logger.warning(f"Узел Ollama {self.base_url} помечен недоступным: {reason}")
+        self.healthy = False
+        self.last_error = reason
+
+    def record_latency(self, first_token_ms: Optional[float], total_ms: float):
+        def ema(old, new):
+            return new if old is None else 0.8 * old + 0.2 * new
+        self.latency_ms = ema(self.latency_ms, total_ms)
+        if first_token_ms is not None:
+            self.first_token_ms = ema(self.first_token_ms, first_token_ms)
+
+    def stats(self) -> dict:
+        return {
+            "url": self.base_url,
+            "healthy": self.healthy,
+            "model_missing": self.model_missing,
+            "last_error": self.last_error,
+            "outstanding": self.outstanding,
+            "max_concurrency": self.max_concurrency,
+            "requests": self.requests,
+            "failures": self.failures,
+            "latency_ms": round(self.latency_ms, 1) if self.latency_ms is not None else None,
+            "first_token_ms": round(self.first_token_ms, 1) if self.first_token_ms is not None else None,
+        }
+
+
+class LLMPool:
+    """
+    Пул узлов Ollama с балансировкой по наименьшему числу запросов в работе.
+
+    У каждого узла свой лимит параллельных запросов; если все узлы заняты,
+    запрос ждет в очереди. Фоновая проверка /api/tags выводит упавшие узлы из
+    ротации и возвращает поднявшиеся. Если узел отвалился до первого токена,
+    запрос прозрачно переезжает на другой узел - история диалога целиком в
+    промпте, так что следующий шаг ReAct может выполняться на любом узле.
+    При равной загрузке сессия остается на "своем" узле, где уже лежит KV-кэш
+    ее префикса.
+    """
+
+    def __init__(self, urls: List[str], max_concurrency: int, health_interval: float):
+        self.backends = [OllamaBackend(url, max_concurrency) for url in urls]
+        self.health_interval = health_interval
+        self._available: Optional[asyncio.Condition] = None
+        self._health_task: Optional[asyncio.Task] = None
+        self.waiting = 0
+        self.failovers = 0
+
+    def _condition(self) -> asyncio.Condition:
+        if self._available is None:
+            self._available = asyncio.Condition()
+        return self._available
+
+    # --- Выбор узла ---
+
+    def _pick(self, affinity: Optional[str], exclude: set) -> Optional[OllamaBackend]:
+        candidates = [b for b in self.backends if b.healthy and b.has_capacity and b not in exclude]
+        if not candidates:
+            return None
+        least = min(b.outstanding for b in candidates)
+        candidates = [b for b in candidates if b.outstanding == least]
+        if affinity is not None:
+            preferred = self.backends[zlib.crc32(affinity.encode("utf-8")) % len(self.backends)]
+            if preferred in candidates:
+                return preferred
+        return min(candidates, key=lambda b: (b.requests, self.backends.index(b)))
+
+    async def _acquire(self, affinity: Optional[str], exclude: set) -> OllamaBackend:
+        condition = self._condition()
+        async with condition:
+            self.waiting += 1
+            try:
+                while True:
+                    if not any(b.healthy and b not in exclude for b in self.backends):
+                        raise NoHealthyBackendError("Нет доступных узлов Ollama.")
+                    backend = self._pick(affinity, exclude)
+                    if backend is not None:
+                        backend.outstanding += 1
+                        backend.requests += 1
+                        return backend
+                    await condition.wait()
+            finally:
+                self.waiting -= 1
+
+    async def _release(self, backend: OllamaBackend):
+        condition = self._condition()
+        async with condition:
+            backend.outstanding -= 1
+            condition.notify_all()
+
+    # --- Генерация ---
+
+    async def astream(
+        self,
+        messages: List[BaseMessage],
+        config: Optional[RunnableConfig] = None,
+        affinity: Optional[str] = None,
+    ) -> AsyncIterator[BaseMessageChunk]:
+        tried: set = set()
+        while True:
+            backend = await self._acquire(affinity, tried)
+            started = time.perf_counter()
+            first_token_ms = None
+            stream = backend.llm.astream(messages, config=config)
+            try:
+                async for chunk in stream:
+                    if first_token_ms is None:
+                        first_token_ms = (time.perf_counter() - started) * 1000
+                    yield chunk
+                backend.record_latency(first_token_ms, (time.perf_counter() - started) * 1000)
+                return
+            except GeneratorExit:
+                # Потребитель сам оборвал поток (ранняя остановка) - это не ошибка узла
+                backend.record_latency(first_token_ms, (time.perf_counter() - started) * 1000)
+                raise
+            except Exception as e:
+                backend.failures += 1
+                if first_token_ms is not None:
+                    raise
+                backend.mark_unhealthy(str(e) or type(e).__name__)
+                tried.add(backend)
+                self.failovers += 1
+                logger.warning(f"Запрос переносится с {backend.base_url} на другой узел Ollama.")
+            finally:
+                # Закрываем HTTP-поток к Ollama сразу, а не когда до него доберется GC
+                await stream.aclose()
+                await self._release(backend)
+
+    # --- Проверка здоровья ---
+
+    async def probe(self, client: httpx.AsyncClient, backend: OllamaBackend):
+        try:
+            response = await client.get(f"{backend.base_url}/api/tags", timeout=5.0)
+            response.raise_for_status()
+            models = {_model_name(m.get("name")) for m in response.json().get("models", [])}
+            model_missing = _model_name(settings.ollama_model) not in models
+            if model_missing and backend.model_missing is not True:
+                logger.warning(f"На узле Ollama {backend.base_url} нет модели {settings.ollama_model} (есть: {', '.join(sorted(models)) or '-'}).")
+            backend.model_missing = model_missing
+            if model_missing:
+                # Узел отвечает; выводить ли его из ротации, решает _check_models по всем узлам
+                backend.last_error = f"модель {settings.ollama_model} не загружена"
+                return
+            if not backend.healthy:
+                logger.info(f"Узел Ollama {backend.base_url} снова доступен.")
+            backend.healthy = True
+            backend.last_error = None
+        except Exception as e:
+            backend.model_missing = None
+            backend.mark_unhealthy(str(e) or type(e).__name__)
+
+    def _check_models(self):
+        """
+        Узел без модели выводится из ротации, только если есть другой живой узел
+        с моделью. Иначе он остается: модель может еще докачиваться или
+        называться чуть иначе, а без узлов каждый запрос упал бы с NoHealthyBackendError.
+        """
+        serving = any(b.healthy and b.model_missing is False for b in self.backends)
+        for backend in self.backends:
+            # Только узлы, которые на последней проверке ответили, но без модели
+            if backend.model_missing is not True:
+                continue
+            if serving:
+                backend.mark_unhealthy(backend.last_error)
+            elif not backend.healthy:
+                logger.info(f"Узел Ollama {backend.base_url} остается в ротации: других узлов с моделью нет.")
+                backend.healthy = True
+
+    async def _health_loop(self):
+        async with httpx.AsyncClient() as client:
+            while True:
+                await asyncio.gather(*(self.probe(client, b) for b in self.backends))
+                self._check_models()
+                async with self._condition():
+                    self._condition().notify_all()
+                await asyncio.sleep(self.health_interval)
+
+    def start(self):
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def stop(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.waiting,
+            "failovers": self.failovers,
+            "backends": [b.stats() for b in self.backends],
+        }
+
+
+llm_pool = LLMPool(
+    urls=settings.ollama_urls,
+    max_concurrency=settings.per_worker(settings.ollama_backend_max_concurrency),
+    health_interval=settings.ollama_health_interval,
+)
@@ -1,17 +1,89 @@
-import lancedb
+import asyncio
 import logging
-from typing import List
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
 # Добавляем ToolMessage в импорты
-from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
-from langchain.memory import ConversationBufferWindowMemory
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import LanceDB
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
 from .config import settings
+from .llm_client import llm_pool
+from .scheduler import turn_scheduler, PRIORITY_BACKGROUND
+
+# lancedb, pyarrow и sentence-transformers тяжелые: импортируются при первом обращении
+if TYPE_CHECKING:
+    from langchain_huggingface import HuggingFaceEmbeddings
 
 logger = logging.getLogger(__name__)
 
+# --- Подсчет токенов ---
+
+_TOKEN_PIECE_RE = re.compile(r"\w+|[^\w\s]")
+
+@lru_cache(maxsize=8192)
+def estimate_tokens(text: str) -> int:
+    """
+    Приближенное число токенов gemma без загрузки токенизатора: латинское слово
+    дает токен на ~4 символа, кириллическое - на ~3, знак препинания - токен.
+    Результат кэшируется, так что неизменные сообщения истории не пересчитываются.
+    Кэш рассчитан на отдельные сообщения: целый промпт каждый раз новый,
+    его нужно считать по частям (см. estimate_history_tokens).
+    """
+    count = 0
+    for piece in _TOKEN_PIECE_RE.findall(text):
+        if piece[0].isalnum() or piece[0] == "_":
+            count += -(-len(piece) // (4 if piece.isascii() else 3))
+        else:
+            count += 1
+    return count
+
+_SEGMENT_SPLIT_RE = re.compile(r"\n(?=<start_of_turn>)")
+
+def estimate_history_tokens(history: str) -> int:
+    """Оценка для отрендеренной истории - сумма по сегментам сообщений, каждый из которых берется из кэша."""
+    return sum(estimate_tokens(segment) for segment in _SEGMENT_SPLIT_RE.split(history)) if history else 0
+
+def clip_to_tokens(text: str, max_tokens: int, keep_tail: bool = False) -> str:
+    """Обрезает текст примерно до max_tokens токенов с начала (или с конца)."""
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    max_chars = max(1, len(text) * max_tokens // tokens)
+    return text[-max_chars:] if keep_tail else text[:max_chars]
+
+def elide_middle(text: str, max_tokens: int) -> str:
+    """Оставляет начало и конец длинного текста, середину заменяет пометкой."""
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    keep_chars = max(2, len(text) * max_tokens // tokens)
+    head, tail = text[:keep_chars * 2 // 3], text[-(keep_chars // 3):]
+    return f"{head}\n... [пропущено {len(text) - len(head) - len(tail)} символов] ...\n{tail}"
+
 # --- Краткосрочная память ---
 
+def format_message_for_gemma3n(msg) -> Optional[str]:
+    """Рендерит одно сообщение в сегмент <start_of_turn>...<end_of_turn>."""
+    if isinstance(msg, HumanMessage):
+        role = "user"
+        content = msg.content
+    elif isinstance(msg, AIMessage):
+        role = "model"
+        content = msg.content
+    elif isinstance(msg, ToolMessage):
+        # Gemma не имеет роли "tool", поэтому мы представляем результат
+        # инструмента как часть "модельного" мира, с которым она работает.
+        role = "model"
+        # Длинный вывод скрипта иначе раздувает промпт на каждом следующем шаге
+        result = elide_middle(str(msg.content), settings.stm_tool_result_max_tokens)
+        content = f"РЕЗУЛЬТАТ ВЫПОЛНЕНИЯ ИНСТРУМЕНТА:\n{result}"
+    else:
+        # Пропускаем любые другие типы сообщений, чтобы не сломать формат
+        return None
+    return f"<start_of_turn>{role}\n{content}<end_of_turn>"
+
 def format_history_for_gemma3n(messages: List) -> str:
     """
     Преобразует список сообщений (включая Human, AI и Tool) в формат,
@@ -19,66 +91,471 @@ def format_history_for_gemma3n(messages: List) -> str:
     """
     formatted_lines = []
     for msg in messages:
-        if isinstance(msg, HumanMessage):
-            role = "user"
-            content = msg.content
-        elif isinstance(msg, AIMessage):
-            role = "model"
-            content = msg.content
-        elif isinstance(msg, ToolMessage):
-            # Gemma не имеет роли "tool", поэтому мы представляем результат
-            # инструмента как часть "модельного" мира, с которым она работает.
-            role = "model"
-            content = f"РЕЗУЛЬТАТ ВЫПОЛНЕНИЯ ИНСТРУМЕНТА:\n{msg.content}"
-        else:
-            # Пропускаем любые другие типы сообщений, чтобы не сломать формат
-            continue
-        
-        formatted_lines.append(f"<start_of_turn>{role}\n{content}<end_of_turn>")
+        segment = format_message_for_gemma3n(msg)
+        if segment is not None:
+            formatted_lines.append(segment)
     return "\n".join(formatted_lines)
 
-def get_short_term_memory(k_value: int = 5) -> ConversationBufferWindowMemory:
-    """Инициализирует краткосрочную память 'в окне'."""
+class IncrementalHistoryRenderer:
+    """
+    Помнит уже отрендеренные сообщения сессии и при следующем запросе
+    рендерит только новые. Сообщения сравниваются по идентичности объектов,
+    поэтому обрезка окна спереди тоже не требует полного перерендера.
+    """
+
+    def __init__(self):
+        self._messages: List = []
+        self._segments: List[Optional[str]] = []
+        self.text = ""
+
+    def render(self, messages: List) -> str:
+        offset = 0
+        if messages and self._messages:
+            # Ищем, с какого места старого списка начинается новый (окно сдвинулось)
+            first = messages[0]
+            offset = next((i for i, m in enumerate(self._messages) if m is first), len(self._messages))
+
+        kept = 0
+        old = self._messages[offset:]
+        while kept < len(old) and kept < len(messages) and old[kept] is messages[kept]:
+            kept += 1
+
+        if offset == 0 and kept == len(self._messages) and kept == len(messages):
+            return self.text
+
+        segments = self._segments[offset:offset + kept]
+        segments.extend(format_message_for_gemma3n(m) for m in messages[kept:])
+        self._messages = list(messages)
+        self._segments = segments
+        self.text = "\n".join(seg for seg in segments if seg is not None)
+        return self.text
+
+class HistoryRenderCache:
+    """LRU-кэш рендереров истории по сессиям."""
+
+    def __init__(self, max_sessions: int):
+        self.max_sessions = max_sessions
+        self._renderers: "OrderedDict[str, IncrementalHistoryRenderer]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, session_id: str, messages: List) -> str:
+        with self._lock:
+            renderer = self._renderers.get(session_id)
+            if renderer is None:
+                renderer = IncrementalHistoryRenderer()
+                self._renderers[session_id] = renderer
+                while len(self._renderers) > self.max_sessions:
+                    self._renderers.popitem(last=False)
+            else:
+                self._renderers.move_to_end(session_id)
+        return renderer.render(messages)
+
+history_render_cache = HistoryRenderCache(max_sessions=settings.sessions_max_count)
+
+class ChatHistory:
+    """Список сообщений сессии (то, что раньше давал ChatMessageHistory из langchain)."""
+
+    def __init__(self, messages: Optional[List[BaseMessage]] = None):
+        self.messages: List[BaseMessage] = list(messages or [])
+
+    def add_message(self, message: BaseMessage):
+        self.messages.append(message)
+
+class TokenBudgetMemory:
+    """
+    Краткосрочная память с бюджетом токенов.
+
+    Кроме окна в k обменов, история вместе со сводкой не должна превышать
+    max_tokens. Старые сообщения, вышедшие за окно или бюджет, отдаются
+    trim() вызывающему - HistorySummarizer сворачивает их в summary, которая
+    идет в промпт перед историей.
+
+    Своя маленькая замена ConversationBufferWindowMemory: окно и историю мы
+    ведем сами, а импорт пакета langchain ради нее стоил почти секунду старта.
+    """
+
+    def __init__(self, k: int = 5, max_tokens: int = 1500):
+        self.k = k
+        self.max_tokens = max_tokens
+        self.summary = ""
+        self.chat_memory = ChatHistory()
+
+    def save_context(self, inputs: Dict[str, str], outputs: Dict[str, str]):
+        """Добавляет обмен (реплика пользователя, ответ Нокса) - как у памяти langchain."""
+        self.chat_memory.add_message(HumanMessage(content=inputs["input"]))
+        self.chat_memory.add_message(AIMessage(content=outputs["output"]))
+
+    def trim(self) -> List[BaseMessage]:
+        """Удаляет самые старые сообщения сверх окна и бюджета и возвращает их."""
+        messages = self.chat_memory.messages
+        keep_from = max(0, len(messages) - self.k * 2)
+        total = estimate_tokens(self.summary) + sum(estimate_tokens(str(m.content)) for m in messages[keep_from:])
+        # Последний обмен остается всегда, даже если сам по себе больше бюджета
+        while total > self.max_tokens and len(messages) - keep_from > 2:
+            total -= estimate_tokens(str(messages[keep_from].content))
+            keep_from += 1
+        evicted = messages[:keep_from]
+        if evicted:
+            self.chat_memory.messages = messages[keep_from:]
+        return evicted
+
+def get_short_term_memory(k_value: int = 5) -> TokenBudgetMemory:
+    """Инициализирует краткосрочную память 'в окне' с бюджетом токенов."""
     logger.info(f"Инициализация краткосрочной памяти с окном в {k_value} сообщений.")
-    return ConversationBufferWindowMemory(k=k_value, return_messages=True)
+    return TokenBudgetMemory(k=k_value, max_tokens=settings.stm_max_tokens)
 
+def format_summary_for_gemma3n(summary: str) -> str:
+    """Оформляет сводку старой части разговора отдельным сегментом истории."""
+    return f"<start_of_turn>user\n[Краткое содержание предыдущего разговора]\n{summary}<end_of_turn>"
 
-# --- Долгосрочная память (Векторная база) ---
+SUMMARY_PROMPT = """Ты ведешь краткую сводку разговора ассистента Нокс с пользователем.
+Обнови сводку, добавив из новых сообщений то, что пригодится дальше: факты о пользователе,
+его просьбы и договоренности, незавершенные дела. Пиши по-русски, не длиннее {words} слов.
+Ответь только текстом обновленной сводки.
 
-# core/memory.py
+Текущая сводка:
+{summary}
 
-def get_vector_store() -> LanceDB:
+Новые сообщения:
+{transcript}"""
+
+class HistorySummarizer:
     """
-    Инициализирует и возвращает векторное хранилище LanceDB.
+    Сворачивает вытесненные из окна сообщения в сводку фоновым вызовом LLM.
+
+    Работает вне пути запроса и занимает слот LLM с фоновым приоритетом, так
+    что ответы пользователям идут вперед. На одного пользователя - не больше
+    одной задачи сжатия; сообщения, вытесненные за время ее работы, попадут в
+    следующий проход. Если LLM недоступна, сводка дополняется обрезанными
+    репликами без модели.
     """
-    logger.info("Инициализация долгосрочной памяти (LanceDB)...")
-
-    # 1. Инициализируем модель для создания эмбеддингов
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-    
-    # 2. Подключаемся к нашей базе данных LanceDB
-    db = lancedb.connect(settings.lancedb_path)
-    table_name = "nox_long_term_memory"
-
-    # 3. Проверяем, существует ли таблица
-    if table_name not in db.table_names():
-        logger.info(f"Таблица '{table_name}' не найдена. Создание новой...")
-        # Если таблицы нет, создаем ее с помощью метода .from_texts
-        # Этот метод LangChain сам создает таблицу и добавляет в нее первые документы.
-        vector_store = LanceDB.from_texts(
-            ["Это первоначальный документ для инициализации памяти Нокса."],
-            embedding=embeddings,
-            connection=db,
-            table_name=table_name
-        )
-        logger.info(f"Таблица '{table_name}' успешно создана.")
-    else:
-        logger.info(f"Подключение к существующей таблице LanceDB: '{table_name}'")
-        # Если таблица есть, просто подключаемся к ней
-        vector_store = LanceDB(
-            connection=db,
-            embedding=embeddings,
-            table_name=table_name
+
+    def __init__(self, max_tokens: int, enabled: bool):
+        self.max_tokens = max_tokens
+        self.enabled = enabled
+        self._pending: Dict[str, List[BaseMessage]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+        self.runs = 0
+        self.failures = 0
+        self.messages_summarized = 0
+
+    @staticmethod
+    def _transcript(messages: List[BaseMessage], max_tokens_per_message: int) -> List[str]:
+        lines = []
+        for message in messages:
+            role = "Пользователь" if isinstance(message, HumanMessage) else "Нокс"
+            lines.append(f"{role}: {clip_to_tokens(str(message.content), max_tokens_per_message)}")
+        return lines
+
+    def _fallback(self, summary: str, messages: List[BaseMessage]) -> str:
+        lines = self._transcript(messages, 40)
+        return "\n".join([summary, *lines] if summary else lines)
+
+    async def _summarize(self, summary: str, messages: List[BaseMessage]) -> str:
+        prompt = SUMMARY_PROMPT.format(
+            words=max(20, self.max_tokens // 2),
+            summary=summary or "(пока пусто)",
+            transcript="\n".join(self._transcript(messages, 300)),
         )
-    
-    return vector_store
\ No newline at end of file
+        parts = []
+        async for chunk in llm_pool.astream([HumanMessage(content=prompt)]):
+            parts.append(chunk.content)
+        return "".join(parts).strip()
+
+    async def _run(self, user_id: str, memory: TokenBudgetMemory, on_updated: Callable[[str, TokenBudgetMemory], None]):
+        while self._pending.get(user_id):
+            messages = self._pending.pop(user_id)
+            self.runs += 1
+            try:
+                async with turn_scheduler.llm_slot(PRIORITY_BACKGROUND):
+                    summary = await self._summarize(memory.summary, messages)
+                if not summary:
+                    raise ValueError("Модель вернула пустую сводку.")
+            except Exception as e:
+                self.failures += 1
+                logger.warning(f"Не удалось сжать историю user_id={user_id} через LLM ({e}), сводка дополнена репликами.")
+                summary = self._fallback(memory.summary, messages)
+            memory.summary = clip_to_tokens(summary, self.max_tokens, keep_tail=True)
+            self.messages_summarized += len(messages)
+            on_updated(user_id, memory)
+
+    def schedule(self, user_id: str, memory: TokenBudgetMemory, evicted: List[BaseMessage],
+                 on_updated: Callable[[str, TokenBudgetMemory], None]):
+        """Ставит вытесненные сообщения в очередь на сжатие в сводку."""
+        if not self.enabled or not evicted:
+            return
+        self._pending.setdefault(user_id, []).extend(evicted)
+        if user_id in self._tasks:
+            return
+        task = asyncio.get_running_loop().create_task(self._run(user_id, memory, on_updated))
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(user_id, None))
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "running": len(self._tasks),
+            "runs": self.runs,
+            "failures": self.failures,
+            "messages_summarized": self.messages_summarized,
+        }
+
+history_summarizer = HistorySummarizer(max_tokens=settings.stm_summary_max_tokens, enabled=settings.stm_summarize)
+
+
+# --- Долгосрочная память (Векторная база) ---
+
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+@lru_cache(maxsize=1)
+def get_embeddings() -> "HuggingFaceEmbeddings":
+    """Модель эмбеддингов загружается один раз и переиспользуется всеми компонентами."""
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    logger.info(f"Загрузка модели эмбеддингов {EMBEDDING_MODEL_NAME}...")
+    return HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+
+LONG_TERM_TABLE_NAME = "nox_long_term_memory_v2"
+
+
+class LongTermMemory:
+    """
+    Долгосрочная память Нокса в LanceDB.
+
+    Запись никогда не блокирует запрос: завершенные ходы диалога кладутся во
+    внутреннюю очередь, фоновая задача пачками считает эмбеддинги и добавляет
+    их в таблицу одной операцией. Поиск идет по ANN-индексу (IVF-PQ) с
+    префильтром по user_id; новые строки вливаются в индекс через optimize(),
+    а при двукратном росте таблицы индекс переобучается.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        top_k: int,
+        batch_size: int,
+        batch_interval: float,
+        queue_size: int,
+        index_min_rows: int,
+        optimize_every: int,
+        nprobes: int,
+        min_similarity: float,
+    ):
+        self.db_path = db_path
+        self.top_k = top_k
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.queue_size = queue_size
+        self.index_min_rows = index_min_rows
+        self.optimize_every = optimize_every
+        self.nprobes = nprobes
+        self.min_similarity = min_similarity
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._table = None
+        self._table_lock = threading.Lock()
+        self._index_lock = threading.Lock()
+        self._rows = 0
+        self._indexed_at_rows = 0
+        self._unoptimized_rows = 0
+        self._has_index = False
+
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.index_builds = 0
+        self.recalls = 0
+
+    # --- LanceDB ---
+
+    def _open_table(self, dim: Optional[int] = None):
+        with self._table_lock:
+            if self._table is not None:
+                return self._table
+            import lancedb
+            import pyarrow as pa
+
+            db = lancedb.connect(self.db_path)
+            if LONG_TERM_TABLE_NAME in db.table_names():
+                self._table = db.open_table(LONG_TERM_TABLE_NAME)
+            elif dim is not None:
+                schema = pa.schema([
+                    pa.field("vector", pa.list_(pa.float32(), dim)),
+                    pa.field("user_id", pa.string()),
+                    pa.field("text", pa.string()),
+                    pa.field("created_at", pa.float64()),
+                ])
+                self._table = db.create_table(LONG_TERM_TABLE_NAME, schema=schema, exist_ok=True)
+                logger.info(f"Создана таблица долгосрочной памяти '{LONG_TERM_TABLE_NAME}'.")
+            if self._table is not None:
+                self._rows = self._table.count_rows()
+                indices = self._table.list_indices()
+                self._has_index = any("vector" in index.columns for index in indices)
+                self._indexed_at_rows = self._rows if self._has_index else 0
+            return self._table
+
+    def _write_batch(self, batch: List[dict]):
+        vectors = get_embeddings().embed_documents([item["text"] for item in batch])
+        table = self._open_table(dim=len(vectors[0]))
+        table.add([{**item, "vector": vector} for item, vector in zip(batch, vectors)])
+        self._rows += len(batch)
+        self._unoptimized_rows += len(batch)
+        self.written += len(batch)
+        self.batches += 1
+        if not self._index_lock.locked():
+            # Построение индекса может занять минуты - не задерживаем им запись следующих пачек
+            threading.Thread(target=self._maintain_index, args=(table,), name="ltm-index", daemon=True).start()
+
+    def _maintain_index(self, table):
+        """Строит, дополняет или переобучает ANN-индекс по мере роста таблицы."""
+        if not self._index_lock.acquire(blocking=False):
+            return
+        try:
+            if not self._has_index:
+                if self._rows < self.index_min_rows:
+                    return
+                dim = table.schema.field("vector").type.list_size
+                logger.info(f"Построение IVF-PQ индекса долгосрочной памяти ({self._rows} записей)...")
+                table.create_index(
+                    metric="cosine",
+                    num_partitions=max(1, int(self._rows ** 0.5)),
+                    num_sub_vectors=max(1, dim // 8),
+                    index_type="IVF_PQ",
+                    replace=True,
+                )
+                table.create_scalar_index("user_id", replace=True)
+                self._has_index = True
+                self._indexed_at_rows = self._rows
+                self._unoptimized_rows = 0
+                self.index_builds += 1
+            elif self._rows >= 2 * self._indexed_at_rows:
+                # Таблица выросла вдвое - центроиды устарели, переобучаем индекс
+                logger.info(f"Переобучение индекса долгосрочной памяти ({self._rows} записей)...")
+                table.optimize(retrain=True)
+                self._indexed_at_rows = self._rows
+                self._unoptimized_rows = 0
+                self.index_builds += 1
+            elif self._unoptimized_rows >= self.optimize_every:
+                # Добавляем новые строки в существующий индекс без переобучения
+                table.optimize()
+                self._unoptimized_rows = 0
+        except Exception as e:
+            logger.error(f"Ошибка обслуживания индекса долгосрочной памяти: {e}")
+        finally:
+            self._index_lock.release()
+
+    def _search(self, user_id: str, text: str) -> List[str]:
+        table = self._open_table()
+        if table is None:
+            return []
+        vector = get_embeddings().embed_query(text)
+        query = table.search(vector).metric("cosine")
+        if self._has_index:
+            query = query.nprobes(self.nprobes).refine_factor(5)
+        safe_user_id = user_id.replace("'", "''")
+        rows = query.where(f"user_id = '{safe_user_id}'", prefilter=True).limit(self.top_k).to_list()
+        return [row["text"] for row in rows if 1.0 - row["_distance"] >= self.min_similarity]
+
+    # --- Фоновая запись ---
+
+    async def _writer_loop(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = asyncio.get_running_loop().time() + self.batch_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await asyncio.to_thread(self._write_batch, batch)
+            except Exception as e:
+                logger.error(f"Не удалось записать {len(batch)} воспоминаний в LanceDB: {e}")
+
+    def warm_up(self):
+        """Открывает таблицу заранее, чтобы первый поиск не ждал подключения к LanceDB."""
+        self._open_table()
+
+    def start(self):
+        if self._writer is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._writer = asyncio.create_task(self._writer_loop())
+
+    async def stop(self):
+        if self._writer is None:
+            return
+        self._writer.cancel()
+        self._writer = None
+        # Дописываем то, что осталось в очереди
+        pending = []
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        for i in range(0, len(pending), self.batch_size):
+            try:
+                await asyncio.to_thread(self._write_batch, pending[i:i + self.batch_size])
+            except Exception as e:
+                logger.error(f"Не удалось записать воспоминания при остановке: {e}")
+
+    # --- Публичный интерфейс ---
+
+    def remember(self, user_id: str, text: str):
+        """Ставит текст в очередь на запись. Никогда не ждет эмбеддингов."""
+        if self._queue is None:
+            return
+        item = {"user_id": user_id, "text": text, "created_at": time.time()}
+        try:
+            self._queue.put_nowait(item)
+            self.enqueued += 1
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning("Очередь долгосрочной памяти переполнена, воспоминание отброшено.")
+
+    async def recall(self, user_id: str, text: str, timeout: float) -> List[str]:
+        """Top-k похожих воспоминаний пользователя. При превышении timeout возвращает пустой список."""
+        self.recalls += 1
+        try:
+            return await asyncio.wait_for(asyncio.to_thread(self._search, user_id, text), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Поиск в долгосрочной памяти не уложился в {timeout * 1000:.0f} мс, пропускаю.")
+        except Exception as e:
+            logger.error(f"Ошибка поиска в долгосрочной памяти: {e}")
+        return []
+
+    def stats(self) -> dict:
+        return {
+            "rows": self._rows,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "written": self.written,
+            "batches": self.batches,
+            "indexed": self._has_index,
+            "index_builds": self.index_builds,
+            "recalls": self.recalls,
+        }
+
+
+def format_memories_for_gemma3n(memories: List[str]) -> str:
+    """Оформляет найденные воспоминания отдельным сегментом истории."""
+    lines = "\n".join(f"- {memory}" for memory in memories)
+    return f"<start_of_turn>user\n[Воспоминания из прошлых разговоров]\n{lines}<end_of_turn>"
+
+
+long_term_memory = LongTermMemory(
+    db_path=settings.lancedb_path,
+    top_k=settings.ltm_top_k,
+    batch_size=settings.ltm_batch_size,
+    batch_interval=settings.ltm_batch_interval,
+    queue_size=settings.ltm_queue_size,
+    index_min_rows=settings.ltm_index_min_rows,
+    optimize_every=settings.ltm_optimize_every,
+    nprobes=settings.ltm_nprobes,
+    min_similarity=settings.ltm_min_similarity,
+)
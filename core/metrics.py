@@ -0,0 +1,242 @@
+import contextvars
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _multiprocess_dir() -> Optional[str]:
+    """
+    Каталог для метрик всех процессов uvicorn. prometheus_client читает
+    PROMETHEUS_MULTIPROC_DIR при импорте, поэтому путь выставляется до него.
+    По умолчанию каталог свой у каждого запуска: воркеры - дети одного
+    процесса uvicorn, и счетчики прошлого запуска в него не попадают.
+    """
+    if not settings.clustered:
+        return None
+    path = settings.prometheus_multiproc_dir or os.path.join(tempfile.gettempdir(), f"nox-prometheus-{os.getppid()}")
+    os.makedirs(path, exist_ok=True)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+    return path
+
+
+MULTIPROCESS_DIR = _multiprocess_dir()
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess  # noqa: E402
+
+# --- Метрики Prometheus ---
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 120)
+_TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+SPAN_DURATION = Histogram(
+    "nox_span_duration_seconds",
+    "Длительность этапов обработки: request, graph_step, call_model, call_tool, tool.<имя>",
+    ["span"],
+    buckets=_LATENCY_BUCKETS,
+)
+REQUESTS = Counter("nox_requests_total", "Обработанные ходы диалога по пути ответа", ["route"])
+QUEUE_WAIT = Histogram(
+    "nox_queue_wait_seconds",
+    "Ожидание в планировщике: lane - очередь пользователя, llm - слот LLM",
+    ["stage"],
+    buckets=_LATENCY_BUCKETS,
+)
+REACT_STEPS = Histogram("nox_react_steps", "Число шагов ReAct (вызовов LLM) на один ход", buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15))
+PARSE_FAILURES = Counter("nox_parse_failures_total", "Ответы модели, из которых не удалось извлечь действие")
+TOOL_ERRORS = Counter("nox_tool_errors_total", "Ошибки при вызове инструментов", ["tool"])
+
+LLM_FIRST_TOKEN = Histogram("nox_llm_first_token_seconds", "Время до первого токена от Ollama", buckets=_LATENCY_BUCKETS)
+LLM_PROMPT_TOKENS = Histogram("nox_llm_prompt_tokens", "Размер промпта в токенах (оценка)", buckets=_TOKEN_BUCKETS)
+LLM_COMPLETION_TOKENS = Histogram("nox_llm_completion_tokens", "Сгенерировано токенов за вызов", buckets=_TOKEN_BUCKETS)
+LLM_PROMPT_EVAL_TOKENS = Histogram(
+    "nox_llm_prompt_eval_tokens",
+    "prompt_eval_count от Ollama - только токены, не попавшие в кэш префикса",
+    buckets=_TOKEN_BUCKETS,
+)
+LLM_PROMPT_EVAL = Histogram("nox_llm_prompt_eval_seconds", "prompt_eval_duration от Ollama", buckets=_LATENCY_BUCKETS)
+LLM_EVAL = Histogram("nox_llm_eval_seconds", "eval_duration от Ollama", buckets=_LATENCY_BUCKETS)
+
+
+def observe_ollama_metadata(metadata: Dict[str, Any]):
+    """Переносит счетчики из последнего чанка Ollama (если поток дошел до конца)."""
+    if metadata.get("prompt_eval_count") is not None:
+        LLM_PROMPT_EVAL_TOKENS.observe(metadata["prompt_eval_count"])
+    if metadata.get("prompt_eval_duration") is not None:
+        LLM_PROMPT_EVAL.observe(metadata["prompt_eval_duration"] / 1e9)
+    if metadata.get("eval_duration") is not None:
+        LLM_EVAL.observe(metadata["eval_duration"] / 1e9)
+
+
+def render_metrics() -> bytes:
+    """Метрики сразу всех воркеров, какой бы из них ни принял запрос."""
+    if MULTIPROCESS_DIR is None:
+        return generate_latest()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=MULTIPROCESS_DIR)
+    return generate_latest(registry)
+
+
+def mark_process_dead():
+    """Убирает файлы остановленного воркера, которые не должны суммироваться с живыми."""
+    if MULTIPROCESS_DIR is not None:
+        multiprocess.mark_process_dead(os.getpid(), path=MULTIPROCESS_DIR)
+
+
+METRICS_CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+# --- Трассировка запросов ---
+
+
+class Span:
+    __slots__ = ("name", "started_at", "duration", "attrs")
+
+    def __init__(self, name: str, attrs: Dict[str, Any]):
+        self.name = name
+        self.started_at = 0.0
+        self.duration = 0.0
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self, origin: float) -> dict:
+        return {
+            "name": self.name,
+            "start_ms": round((self.started_at - origin) * 1000, 2),
+            "duration_ms": round(self.duration * 1000, 2),
+            **({"attrs": self.attrs} if self.attrs else {}),
+        }
+
+
+class Trace:
+    """Все этапы одного хода диалога; собирается, только пока ход выполняется."""
+
+    def __init__(self, user_id: str, text: str):
+        self.id = uuid.uuid4().hex[:16]
+        self.user_id = user_id
+        self.text = text
+        self.started_at = time.perf_counter()
+        self.wall_started_at = time.time()
+        self.duration = 0.0
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        # call_tool выполняется в потоке исполнителя, поэтому под замком
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.started_at)
+        return {
+            "trace_id": self.id,
+            "user_id": self.user_id,
+            "text": self.text,
+            "started_at": self.wall_started_at,
+            "duration_ms": round(self.duration * 1000, 2),
+            "spans": [s.to_dict(self.started_at) for s in spans],
+        }
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("nox_trace", default=None)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Замеряет этап: пишет длительность в гистограмму nox_span_duration_seconds
+    и, если идет трассировка хода, добавляет этап в трассу.
+    """
+    current = Span(name, attrs)
+    current.started_at = time.perf_counter()
+    try:
+        yield current
+    except Exception as e:
+        current.attrs["error"] = str(e)[:200]
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.started_at
+        SPAN_DURATION.labels(span=name).observe(current.duration)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(current)
+
+
+def record_span(name: str, started_at: float, **attrs):
+    """Этап, начало которого известно заранее (perf_counter), а конец - сейчас."""
+    current = Span(name, attrs)
+    current.started_at = started_at
+    current.duration = time.perf_counter() - started_at
+    SPAN_DURATION.labels(span=name).observe(current.duration)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(current)
+
+
+class SlowTraceSampler:
+    """
+    Сохраняет полные трассы медленных ходов: последние keep штук доступны
+    через /traces/slow, а при заданном пути каждая дописывается в файл JSONL.
+    """
+
+    def __init__(self, threshold: float, sample_rate: float, keep: int, log_path: Optional[str]):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.log_path = log_path
+        self._recent: "deque[dict]" = deque(maxlen=keep)
+        self._file_lock = threading.Lock()
+        self.sampled = 0
+
+    def offer(self, trace: Trace):
+        if self.threshold <= 0 or trace.duration < self.threshold:
+            return
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        data = trace.to_dict()
+        self._recent.append(data)
+        self.sampled += 1
+        logger.warning(f"Медленный ход {trace.id} ({data['duration_ms']} мс) для user_id={trace.user_id}, этапов: {len(data['spans'])}")
+        if self.log_path:
+            try:
+                with self._file_lock, open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(data, ensure_ascii=False) + "\n")
+            except OSError as e:
+                logger.error(f"Не удалось записать трассу в {self.log_path}: {e}")
+
+    def recent(self) -> List[dict]:
+        return list(self._recent)
+
+
+slow_trace_sampler = SlowTraceSampler(
+    threshold=settings.trace_slow_threshold,
+    sample_rate=settings.trace_slow_sample_rate,
+    keep=settings.trace_slow_keep,
+    log_path=settings.trace_slow_log_path,
+)
+
+
+@contextmanager
+def trace_request(user_id: str, text: str):
+    """Открывает трассу хода и корневой этап request; медленные трассы уходят в sampler."""
+    trace = Trace(user_id, text)
+    token = _current_trace.set(trace)
+    try:
+        with span("request", user_id=user_id) as root:
+            yield root
+    finally:
+        _current_trace.reset(token)
+        trace.duration = time.perf_counter() - trace.started_at
+        slow_trace_sampler.offer(trace)
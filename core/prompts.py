@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Optional
+
+import yaml
+from langchain_core.prompts import ChatPromptTemplate
+
+logger = logging.getLogger(__name__)
+
+INSTRUCTIONS_PATH = Path(__file__).parent.parent / "configs" / "llm_instructions.yaml"
+DEFAULT_VARIANT = "default"
+
+
+class PromptVariant:
+    """
+    Скомпилированный вариант промпта одной версии файла инструкций.
+
+    Статическая часть (персона + инструменты) до истории диалога отрендерена
+    заранее: она должна быть побайтно одинаковой между запросами, чтобы Ollama
+    переиспользовала уже посчитанный KV-кэш этого префикса. hash меняется
+    только вместе с текстом промпта - по нему можно ключевать кэши ответов.
+    """
+
+    __slots__ = ("name", "version", "static_prefix", "dynamic_suffix", "hash")
+
+    def __init__(self, name: str, version: int, template: str, tools: str):
+        self.name = name
+        self.version = version
+        self.static_prefix, self.dynamic_suffix = self._split(template, tools)
+        digest = hashlib.sha256(f"{self.static_prefix}\x00{self.dynamic_suffix}".encode("utf-8"))
+        self.hash = digest.hexdigest()[:16]
+
+    def _split(self, template: str, tools: str):
+        """Рендерит шаблон один раз и делит его на префикс до истории и хвост после нее."""
+        prompt = ChatPromptTemplate.from_template(template)
+        marker = f"\x00history-{uuid.uuid4().hex}\x00"
+        rendered = prompt.format_messages(tools=tools, conversation_history=marker)[0].content
+        prefix, found, suffix = rendered.partition(marker)
+        if not found:
+            raise ValueError(f"в варианте '{self.name}' нет {{conversation_history}}")
+        if tools and tools not in prefix:
+            logger.warning(f"В варианте промпта '{self.name}' история идет раньше инструментов - префикс не будет кэшироваться в Ollama.")
+        return prefix, suffix
+
+    def render(self, conversation_history: str) -> str:
+        return self.static_prefix + conversation_history + self.dynamic_suffix
+
+
+class PromptRegistry:
+    """
+    Скомпилированные промпты из llm_instructions.yaml с горячей перезагрузкой.
+
+    Вариант по умолчанию собирается, как и раньше, из persona_nox_v_svoboda и
+    ha_execution_prompt_with_react. Дополнительные варианты описываются в
+    секции prompt_variants: имя -> {persona: ..., template: ...}; отсутствующее
+    поле берется из варианта по умолчанию.
+
+    Файл проверяется по mtime раз в watch_interval секунд. Новая версия
+    компилируется целиком и подменяет старую одним присваиванием, так что
+    читатели не берут блокировок и всегда видят согласованный набор вариантов.
+    Если файл сломан, остается предыдущая версия.
+    """
+
+    def __init__(self, path: Path, tools: str, watch_interval: float, default_variant: str = DEFAULT_VARIANT):
+        self.path = Path(path)
+        self.tools = tools
+        self.watch_interval = watch_interval
+        self.default_variant = default_variant
+
+        self._variants: Dict[str, PromptVariant] = {}
+        self._signature = None
+        self._load_lock = threading.Lock()
+        self._watch_task: Optional[asyncio.Task] = None
+
+        self.version = 0
+        self.loaded_at: Optional[float] = None
+        self.reloads = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _compile(self, instructions: dict, version: int) -> Dict[str, PromptVariant]:
+        persona = instructions.get('persona_nox_v_svoboda', '')
+        react_instructions = instructions.get('ha_execution_prompt_with_react', '')
+        sources = {DEFAULT_VARIANT: (persona, react_instructions)}
+        for name, spec in (instructions.get('prompt_variants') or {}).items():
+            spec = spec or {}
+            sources[str(name)] = (spec.get('persona', persona), spec.get('template', react_instructions))
+        return {
+            name: PromptVariant(name, version, template.replace("<<: *persona", variant_persona), self.tools)
+            for name, (variant_persona, template) in sources.items()
+        }
+
+    def load(self) -> bool:
+        """Перечитывает файл и атомарно подменяет все варианты. При ошибке оставляет прежние."""
+        with self._load_lock:
+            signature = self._file_signature()
+            try:
+                with self.path.open("r", encoding="utf-8") as f:
+                    instructions = yaml.safe_load(f) or {}
+                variants = self._compile(instructions, self.version + 1)
+                if self.default_variant not in variants:
+                    raise ValueError(f"нет варианта по умолчанию '{self.default_variant}'")
+            except Exception as e:
+                self._signature = signature
+                self.failures += 1
+                self.last_error = str(e)[:200]
+                logger.error(f"КРИТИЧЕСКАЯ ОШИБКА при загрузке промпта: {e}")
+                return False
+            self._variants = variants
+            self._signature = signature
+            self.version += 1
+            self.loaded_at = time.time()
+            self.last_error = None
+            if self.version > 1:
+                self.reloads += 1
+            hashes = ", ".join(f"{name}={variant.hash}" for name, variant in variants.items())
+            logger.info(f"Промпт v{self.version} загружен и скомпилирован: {hashes}")
+            return True
+
+    def reload_if_changed(self) -> bool:
+        """Перезагружает промпт, если файл изменился с прошлой загрузки."""
+        if self._file_signature() == self._signature:
+            return False
+        logger.info(f"Файл {self.path.name} изменился, перезагружаю промпт...")
+        return self.load()
+
+    def get(self, name: Optional[str] = None) -> Optional[PromptVariant]:
+        """Вариант по имени (или по умолчанию); None, если такого нет или промпт не загружен."""
+        return self._variants.get(name or self.default_variant)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._variants
+
+    @property
+    def loaded(self) -> bool:
+        return bool(self._variants)
+
+    async def _watch_loop(self):
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            try:
+                await asyncio.to_thread(self.reload_if_changed)
+            except Exception as e:
+                logger.error(f"Ошибка при проверке файла промпта: {e}")
+
+    def start(self):
+        if self._watch_task is None and self.watch_interval > 0:
+            self._watch_task = asyncio.create_task(self._watch_loop())
+
+    async def stop(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            self._watch_task = None
+
+    def stats(self) -> dict:
+        variants = self._variants
+        return {
+            "version": self.version,
+            "loaded_at": self.loaded_at,
+            "reloads": self.reloads,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "default": self.default_variant,
+            "variants": {name: variant.hash for name, variant in variants.items()},
+        }
@@ -0,0 +1,304 @@
+import asyncio
+import logging
+import re
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from langchain_core.messages import AIMessage, BaseMessage, ToolMessage
+
+from .config import settings
+from .home_assistant import ha_client
+from .memory import get_embeddings
+from .streaming import parse_action
+
+logger = logging.getLogger(__name__)
+
+TABLE_NAME = "nox_response_cache"
+GLOBAL_SCOPE = "__global__"
+
+
+def _quote(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _mentions_entity(entity_id: str) -> str:
+    """Фильтр LanceDB по списку сущностей через запятую в колонке entities."""
+    value = entity_id.replace("'", "''")
+    return (
+        f"entities = '{value}' OR entities LIKE '{value},%' "
+        f"OR entities LIKE '%,{value}' OR entities LIKE '%,{value},%'"
+    )
+
+
+_WORD_RE = re.compile(r"\w+")
+# Реплики, смысл которых зависит от предыдущего обмена: "а завтра?", "выключи его", "почему?"
+_FOLLOW_UP_STARTS = {"а", "и", "но", "да", "нет", "ну", "так", "and", "but", "yes", "no", "so"}
+_FOLLOW_UP_WORDS = {
+    "это", "этот", "эта", "эти", "этого", "этом", "тот", "та", "то", "там", "тогда", "тоже", "еще",
+    "он", "она", "оно", "они", "его", "ее", "их", "ему", "ей", "им", "нему", "ней", "них",
+    "почему", "зачем", "подробнее", "дальше",
+    "it", "its", "this", "that", "these", "those", "they", "them", "there", "then", "why", "also",
+}
+
+
+class SemanticResponseCache:
+    """
+    Кэш готовых ответов агента перед agent_graph.
+
+    Входящий текст превращается в эмбеддинг (MiniLM) и ищется в таблице LanceDB;
+    если ранее был вопрос с косинусной близостью выше порога, его ответ
+    возвращается без прогона графа. Записи живут ttl секунд, таблица ограничена
+    max_entries (вытесняются самые старые).
+
+    Ответы, построенные на состоянии устройств (home_assistant get_state и т.п.),
+    помечаются сущностями, от которых зависят, и становятся недействительными при
+    первом же state_changed по этим сущностям. Ходы с побочными эффектами
+    (call_service, python_script_executor) не кэшируются вовсе.
+
+    Область поиска включает хэш варианта промпта: ответы, полученные с другой
+    инструкцией, после ее смены не отдаются.
+
+    Ключ - только текст реплики, без истории диалога, поэтому короткие и
+    явно продолжающие разговор реплики ("да", "почему?", "а завтра?") мимо
+    кэша идут прямо к агенту (см. cacheable).
+    """
+
+    def __init__(self, db_path: str, scope: str, threshold: float, ttl: float, state_ttl: float, max_entries: int,
+                 min_words: int):
+        self.db_path = db_path
+        self.scope = scope
+        self.threshold = threshold
+        self.ttl = ttl
+        self.state_ttl = state_ttl
+        self.max_entries = max_entries
+        self.min_words = min_words
+
+        self._table = None
+        self._table_lock = threading.Lock()
+        self._rows: Optional[int] = None
+        # entity_id -> время последнего изменения состояния
+        self._entity_changed_at: Dict[str, float] = {}
+        # Все записи, созданные раньше этого момента, недействительны
+        self._invalidated_before = 0.0
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.stores = 0
+        self.evictions = 0
+        self.skipped = 0
+
+    # --- Инвалидация ---
+
+    def on_state_changed(self, entity_id: str, old_state: Optional[dict], new_state: Optional[dict]):
+        """Хук для HomeAssistantClient: вызывается на каждое изменение состояния."""
+        old_value = (old_state or {}).get("state")
+        new_value = (new_state or {}).get("state")
+        if old_value != new_value or (old_state or {}).get("attributes") != (new_state or {}).get("attributes"):
+            self._entity_changed_at[entity_id] = time.time()
+
+    def invalidate(self, entity_ids: Optional[Iterable[str]] = None):
+        """
+        Сбрасывает ответы, зависящие от указанных сущностей, или весь кэш.
+        Записи удаляются из таблицы, так что сброс переживает перезапуск и виден
+        другим воркерам; отметки в памяти закрывают ходы, которые допишут ответ
+        уже после удаления.
+        """
+        now = time.time()
+        if entity_ids is None:
+            self._invalidated_before = now
+            condition = f"created_at <= {now}"
+        else:
+            entity_ids = list(entity_ids)
+            for entity_id in entity_ids:
+                self._entity_changed_at[entity_id] = now
+            if not entity_ids:
+                return
+            condition = " OR ".join(f"({_mentions_entity(entity_id)})" for entity_id in entity_ids)
+        table = self._open_table()
+        if table is None:
+            return
+        table.delete(condition)
+        self._rows = table.count_rows()
+        logger.info(f"Кэш ответов сброшен{'' if entity_ids is None else ' для ' + ', '.join(entity_ids)}.")
+
+    def _is_valid(self, row: dict) -> bool:
+        created_at = row["created_at"]
+        if created_at <= self._invalidated_before:
+            return False
+        if row["state_dependent"] and time.time() - created_at > self.state_ttl:
+            return False
+        for entity_id in filter(None, row["entities"].split(",")):
+            if self._entity_changed_at.get(entity_id, 0.0) >= created_at:
+                return False
+        return True
+
+    # --- LanceDB ---
+
+    def _open_table(self, dim: Optional[int] = None):
+        with self._table_lock:
+            if self._table is not None:
+                return self._table
+            import lancedb
+            import pyarrow as pa
+
+            db = lancedb.connect(self.db_path)
+            if TABLE_NAME in db.table_names():
+                self._table = db.open_table(TABLE_NAME)
+            elif dim is not None:
+                schema = pa.schema([
+                    pa.field("vector", pa.list_(pa.float32(), dim)),
+                    pa.field("scope", pa.string()),
+                    pa.field("text", pa.string()),
+                    pa.field("answer", pa.string()),
+                    pa.field("entities", pa.string()),
+                    pa.field("state_dependent", pa.bool_()),
+                    pa.field("created_at", pa.float64()),
+                ])
+                self._table = db.create_table(TABLE_NAME, schema=schema, exist_ok=True)
+                logger.info(f"Создана таблица кэша ответов '{TABLE_NAME}'.")
+            if self._table is not None and self._rows is None:
+                self._rows = self._table.count_rows()
+            return self._table
+
+    def warm_up(self):
+        """Открывает таблицу заранее, чтобы первый поиск не ждал подключения к LanceDB."""
+        self._open_table()
+
+    def cacheable(self, text: str) -> bool:
+        """Можно ли искать и хранить ответ на реплику без учета предыдущего обмена."""
+        words = _WORD_RE.findall(text.lower().replace("ё", "е"))
+        if len(words) < self.min_words or words[0] in _FOLLOW_UP_STARTS:
+            return False
+        return not _FOLLOW_UP_WORDS.intersection(words)
+
+    def _scope_for(self, user_id: str, prompt_hash: Optional[str]) -> str:
+        scope = user_id if self.scope == "user" else GLOBAL_SCOPE
+        return f"{scope}@{prompt_hash}" if prompt_hash else scope
+
+    def _lookup(self, user_id: str, text: str, prompt_hash: Optional[str]) -> Optional[str]:
+        table = self._open_table()
+        if table is None:
+            return None
+        vector = get_embeddings().embed_query(text)
+        cutoff = time.time() - self.ttl
+        rows = (
+            table.search(vector)
+            .metric("cosine")
+            .where(f"scope = {_quote(self._scope_for(user_id, prompt_hash))} AND created_at > {cutoff}", prefilter=True)
+            .limit(3)
+            .to_list()
+        )
+        for row in rows:
+            if 1.0 - row["_distance"] < self.threshold:
+                break
+            if self._is_valid(row):
+                return row["answer"]
+            self.stale += 1
+        return None
+
+    def _store(self, user_id: str, text: str, answer: str, entities: List[str], state_dependent: bool, prompt_hash: Optional[str]):
+        vector = get_embeddings().embed_query(text)
+        table = self._open_table(dim=len(vector))
+        table.add([{
+            "vector": vector,
+            "scope": self._scope_for(user_id, prompt_hash),
+            "text": text,
+            "answer": answer,
+            "entities": ",".join(sorted(set(entities))),
+            "state_dependent": state_dependent,
+            "created_at": time.time(),
+        }])
+        self.stores += 1
+        self._rows = (self._rows or 0) + 1
+        if self._rows > self.max_entries:
+            self._evict(table)
+
+    def _evict(self, table):
+        """Удаляет самые старые записи и все просроченные, оставляя ~90% от лимита."""
+        keep = int(self.max_entries * 0.9)
+        created = sorted(table.search().select(["created_at"]).limit(self._rows + 100).to_arrow().column("created_at").to_pylist())
+        if len(created) <= keep:
+            self._rows = len(created)
+            return
+        cutoff = max(created[len(created) - keep - 1], time.time() - self.ttl)
+        table.delete(f"created_at <= {cutoff}")
+        self._rows = table.count_rows()
+        self.evictions += len(created) - self._rows
+        logger.info(f"Кэш ответов: вытеснено {len(created) - self._rows} записей.")
+
+    # --- Публичный интерфейс ---
+
+    async def lookup(self, user_id: str, text: str, prompt_hash: Optional[str] = None) -> Optional[str]:
+        if not self.cacheable(text):
+            self.skipped += 1
+            return None
+        try:
+            answer = await asyncio.to_thread(self._lookup, user_id, text, prompt_hash)
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша ответов: {e}")
+            answer = None
+        if answer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            logger.info(f"Ответ для '{text}' взят из семантического кэша.")
+        return answer
+
+    async def store(self, user_id: str, text: str, answer: str, turn_messages: List[BaseMessage], prompt_hash: Optional[str] = None):
+        """Сохраняет ответ, если ход не имел побочных эффектов и реплика не зависит от контекста."""
+        if not self.cacheable(text):
+            return
+        entities: List[str] = []
+        state_dependent = False
+        for message in turn_messages:
+            if isinstance(message, ToolMessage):
+                if message.name == "respond_to_user":
+                    continue
+                if message.name != "home_assistant" or str(message.content).startswith("Ошибка"):
+                    return
+            if not isinstance(message, AIMessage):
+                continue
+            try:
+                action = parse_action(message.content)
+            except ValueError:
+                return
+            if action.get("action") == "respond_to_user":
+                continue
+            tool_input = action.get("action_input") or {}
+            if action.get("action") != "home_assistant" or tool_input.get("operation") == "call_service":
+                return
+            state_dependent = True
+            entity_id = tool_input.get("entity_id")
+            entities.extend([entity_id] if isinstance(entity_id, str) else list(entity_id or []))
+        try:
+            await asyncio.to_thread(self._store, user_id, text, answer, entities, state_dependent, prompt_hash)
+        except Exception as e:
+            logger.error(f"Ошибка записи в кэш ответов: {e}")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "scope": self.scope,
+            "entries": self._rows,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "stale": self.stale,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "skipped": self.skipped,
+        }
+
+
+response_cache = SemanticResponseCache(
+    db_path=settings.lancedb_path,
+    scope=settings.response_cache_scope,
+    threshold=settings.response_cache_threshold,
+    ttl=settings.response_cache_ttl,
+    state_ttl=settings.response_cache_state_ttl,
+    max_entries=settings.response_cache_max_entries,
+    min_words=settings.response_cache_min_words,
+)
+ha_client.add_listener(response_cache.on_state_changed)
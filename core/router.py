@@ -0,0 +1,367 @@
+import asyncio
+import logging
+import re
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.messages import AIMessage, BaseMessage, ToolMessage
+
+from .config import settings
+from .home_assistant import ha_client
+from .memory import get_embeddings
+from .streaming import parse_action
+from .tools import home_assistant, respond_to_user
+
+logger = logging.getLogger(__name__)
+
+# --- Нормализация текста ---
+
+_FILLER_RE = re.compile(r"^(?:нокс|nox|эй|hey|пожалуйста|please)[\s,]+|[\s,]+(?:пожалуйста|please)$")
+_PUNCT_RE = re.compile(r"[!?.,;:«»\"']+")
+
+_ON_WORDS = {"включи", "зажги", "включить", "on"}
+_OFF_WORDS = {"выключи", "погаси", "выключить", "off"}
+_TOGGLE_DOMAINS = ("light", "switch", "fan", "input_boolean")
+_LIGHT_WORDS = {"свет", "лампу", "лампа", "лампочку", "light", "lights", "lamp"}
+_STOP_WORDS = {"на", "в", "во", "the", "in", "a", "ли", "сейчас", "дома", "квартире", "комнате", "is", "it"}
+
+
+def normalize_command(text: str) -> str:
+    text = text.lower().replace("ё", "е").strip()
+    text = _PUNCT_RE.sub(" ", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    previous = None
+    while previous != text:
+        previous = text
+        text = _FILLER_RE.sub("", text).strip()
+    return text
+
+
+def _stems(words: Sequence[str]) -> set:
+    # Грубый стемминг: "кухне"/"кухня"/"kitchen" -> первые 4 символа
+    return {w[:4] for w in words if len(w) >= 3}
+
+
+def _guard_tokens(text: str) -> set:
+    """Слова, которые обязаны совпадать у похожих команд: направление действия и числа."""
+    words = normalize_command(text).split()
+    guard = {w for w in words if w.isdigit()}
+    if _ON_WORDS & set(words):
+        guard.add("+on")
+    if _OFF_WORDS & set(words):
+        guard.add("+off")
+    return guard
+
+
+@dataclass
+class RouteMatch:
+    tool_input: dict
+    confidence: float
+    source: str
+    render: Callable[[str], str]
+
+
+# --- Разрешение сущностей по названию ---
+
+def _entity_stems(state: dict) -> set:
+    name = (state.get("attributes") or {}).get("friendly_name", "")
+    words = re.split(r"[\s_.]+", f"{normalize_command(name)} {state['entity_id'].lower()}")
+    return _stems(words)
+
+
+def _resolve_entity(target_words: List[str], domains: Sequence[str], predicate: Optional[Callable[[dict], bool]] = None):
+    """Ищет единственную сущность, название которой лучше всего совпадает со словами запроса."""
+    query = _stems([w for w in target_words if w not in _STOP_WORDS and w not in _LIGHT_WORDS])
+    candidates = []
+    for domain in domains:
+        for state in ha_client.list_states(domain):
+            if predicate and not predicate(state):
+                continue
+            candidates.append((len(query & _entity_stems(state)), state))
+    if not candidates:
+        return None, 0.0
+    candidates.sort(key=lambda item: item[0], reverse=True)
+    best_score, best = candidates[0]
+    if len(candidates) == 1 and not query:
+        return best, 1.0
+    if best_score == 0:
+        return None, 0.0
+    if len(candidates) > 1 and candidates[1][0] == best_score:
+        # Несколько одинаково подходящих сущностей - пусть разбирается LLM
+        return best, 0.5
+    return best, min(1.0, best_score / max(1, len(query)))
+
+
+def _friendly(state: dict) -> str:
+    return (state.get("attributes") or {}).get("friendly_name") or state["entity_id"]
+
+
+def _on_off_text(value: Optional[str]) -> str:
+    return {"on": "включено", "off": "выключено"}.get(value or "", value or "неизвестно")
+
+
+def _render_state(entity_id: str) -> str:
+    state = ha_client.get_state(entity_id)
+    if state is None:
+        return f"Не нашел {entity_id}."
+    domain = entity_id.split(".", 1)[0]
+    if domain in _TOGGLE_DOMAINS:
+        return f"{_friendly(state)}: {_on_off_text(state.get('state'))}."
+    unit = (state.get("attributes") or {}).get("unit_of_measurement", "")
+    return f"{_friendly(state)}: {state.get('state')}{f' {unit}' if unit else ''}."
+
+
+def _render_tool_result(tool_input: dict) -> Callable[[str], str]:
+    entity_id = tool_input.get("entity_id")
+
+    def render(result: str) -> str:
+        if result.startswith("Ошибка"):
+            return result
+        if isinstance(entity_id, str):
+            prefix = "Готово. " if tool_input.get("operation") == "call_service" else ""
+            return prefix + _render_state(entity_id)
+        return result
+
+    return render
+
+
+# --- Правила ---
+
+_TURN_RE = re.compile(r"^(?P<verb>включи|выключи|зажги|погаси|turn on|turn off|switch on|switch off)\s+(?P<target>.+)$")
+_IS_ON_RE = re.compile(r"^(?:(?:горит|включен|включена|включено|работает)\s+ли|is)\s+(?P<target>.+?)(?:\s+(?:on|off))?$")
+_TEMPERATURE_RE = re.compile(
+    r"^(?:какая|сколько)\s+(?:сейчас\s+)?(?:температура|градусов)(?P<target>.*)$"
+    r"|^what s the temperature(?P<target_en>.*)$|^what is the temperature(?P<target_en2>.*)$"
+)
+
+
+def _is_temperature_sensor(state: dict) -> bool:
+    attributes = state.get("attributes") or {}
+    return attributes.get("device_class") == "temperature" or attributes.get("unit_of_measurement") in ("°C", "°F")
+
+
+def _rule_match(text: str) -> Optional[RouteMatch]:
+    normalized = normalize_command(text)
+
+    match = _TURN_RE.match(normalized)
+    if match:
+        verb = match.group("verb")
+        service = "turn_off" if verb in ("выключи", "погаси", "turn off", "switch off") else "turn_on"
+        words = match.group("target").split()
+        domains = ("light",) if _LIGHT_WORDS & set(words) else _TOGGLE_DOMAINS
+        state, confidence = _resolve_entity(words, domains)
+        if state is None:
+            return None
+        tool_input = {"operation": "call_service", "entity_id": state["entity_id"], "service": service}
+        return RouteMatch(tool_input, confidence, "rule", _render_tool_result(tool_input))
+
+    match = _IS_ON_RE.match(normalized)
+    if match:
+        words = match.group("target").split()
+        domains = ("light",) if _LIGHT_WORDS & set(words) else _TOGGLE_DOMAINS
+        state, confidence = _resolve_entity(words, domains)
+        if state is None:
+            return None
+        tool_input = {"operation": "get_state", "entity_id": state["entity_id"]}
+        return RouteMatch(tool_input, confidence, "rule", _render_tool_result(tool_input))
+
+    match = _TEMPERATURE_RE.match(normalized)
+    if match:
+        target = match.group("target") or match.group("target_en") or match.group("target_en2") or ""
+        words = target.split()
+        outside = bool({"улице", "снаружи", "outside"} & set(words))
+
+        def predicate(state: dict) -> bool:
+            if not _is_temperature_sensor(state):
+                return False
+            is_outside = bool(_stems(["улице", "outside", "снаружи"]) & _entity_stems(state))
+            return is_outside == outside
+
+        state, confidence = _resolve_entity(words, ("sensor",), predicate)
+        if state is None:
+            return None
+        tool_input = {"operation": "get_state", "entity_id": state["entity_id"]}
+        return RouteMatch(tool_input, confidence, "rule", _render_tool_result(tool_input))
+
+    return None
+
+
+# --- Ближайшие соседи по прошлым успешным командам ---
+
+def _same_target(text: str, tool_input: dict) -> bool:
+    """
+    Эмбеддинги плохо различают названия комнат ("на кухне" и "в спальне"
+    почти совпадают), поэтому call_service повторяется, только если сущность,
+    найденная по словам самого запроса, та же, что у образца. get_state ничего
+    не меняет и повторяется как есть.
+    """
+    if tool_input.get("operation") != "call_service":
+        return True
+    entity_id = tool_input.get("entity_id")
+    if not isinstance(entity_id, str) or "." not in entity_id:
+        return False
+    state, _ = _resolve_entity(normalize_command(text).split(), (entity_id.split(".", 1)[0],))
+    return state is not None and state["entity_id"] == entity_id
+
+
+@dataclass
+class _Exemplar:
+    text: str
+    guard: set
+    tool_input: dict
+    vector: np.ndarray
+
+
+class FastPathRouter:
+    """
+    Быстрый путь перед графом агента: частые команды умного дома выполняются
+    напрямую через инструмент home_assistant, а ответ формируется шаблоном и
+    отдается через respond_to_user - без единого вызова LLM.
+
+    Сначала проверяются правила, затем поиск ближайшего соседа по эмбеддингам
+    прошлых команд, которые агент успешно выполнил одним вызовом home_assistant.
+    При низкой уверенности запрос уходит в agent_graph.
+    """
+
+    def __init__(self, min_confidence: float, nn_threshold: float, max_exemplars: int, use_embeddings: bool):
+        self.min_confidence = min_confidence
+        self.nn_threshold = nn_threshold
+        self.use_embeddings = use_embeddings
+        self._exemplars: "deque[_Exemplar]" = deque(maxlen=max_exemplars)
+        self._lock = threading.Lock()
+
+        self.hits: Dict[str, int] = {"rule": 0, "nearest": 0}
+        self.misses = 0
+        self.low_confidence = 0
+        self.learned = 0
+        self._agent_latency_ms: Optional[float] = None
+        self._saved_ms = 0.0
+
+    # --- Статистика ---
+
+    def record_agent_latency(self, elapsed_ms: float):
+        """Скользящее среднее времени полного прогона графа - база для оценки экономии."""
+        if self._agent_latency_ms is None:
+            self._agent_latency_ms = elapsed_ms
+        else:
+            self._agent_latency_ms = 0.9 * self._agent_latency_ms + 0.1 * elapsed_ms
+
+    def stats(self) -> dict:
+        total = sum(self.hits.values()) + self.misses
+        return {
+            "hits": dict(self.hits),
+            "misses": self.misses,
+            "low_confidence": self.low_confidence,
+            "hit_rate": round(sum(self.hits.values()) / total, 3) if total else 0.0,
+            "exemplars": len(self._exemplars),
+            "avg_agent_latency_ms": round(self._agent_latency_ms, 1) if self._agent_latency_ms is not None else None,
+            "saved_ms_estimate": round(self._saved_ms, 1),
+        }
+
+    # --- Поиск маршрута ---
+
+    def _nearest(self, text: str) -> Optional[RouteMatch]:
+        with self._lock:
+            exemplars = list(self._exemplars)
+        if not exemplars:
+            return None
+        guard = _guard_tokens(text)
+        candidates = [e for e in exemplars if e.guard == guard]
+        if not candidates:
+            return None
+        query = np.asarray(get_embeddings().embed_query(normalize_command(text)), dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        scores = np.stack([e.vector for e in candidates]) @ query
+        for best in np.argsort(-scores):
+            if scores[best] < self.nn_threshold:
+                return None
+            exemplar = candidates[best]
+            if _same_target(text, exemplar.tool_input):
+                confidence = float(scores[best])
+                return RouteMatch(dict(exemplar.tool_input), confidence, "nearest", _render_tool_result(exemplar.tool_input))
+        return None
+
+    def _match(self, text: str) -> Optional[RouteMatch]:
+        if not ha_client.connected:
+            return None
+        match = _rule_match(text)
+        if match is None and self.use_embeddings:
+            try:
+                match = self._nearest(text)
+            except Exception as e:
+                logger.error(f"Ошибка поиска ближайшей команды: {e}")
+        return match
+
+    async def try_handle(self, text: str) -> Optional[str]:
+        """Возвращает готовый ответ, если команду можно выполнить без LLM, иначе None."""
+        started = time.perf_counter()
+        match = await asyncio.to_thread(self._match, text)
+        if match is None:
+            self.misses += 1
+            return None
+        if match.confidence < self.min_confidence:
+            self.low_confidence += 1
+            self.misses += 1
+            logger.info(f"Быстрый путь: низкая уверенность ({match.confidence:.2f}) для '{text}', передаю агенту.")
+            return None
+
+        result = await asyncio.to_thread(home_assistant.invoke, match.tool_input)
+        answer = respond_to_user.invoke({"response": match.render(result)})
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.hits[match.source] += 1
+        if self._agent_latency_ms is not None:
+            self._saved_ms += max(0.0, self._agent_latency_ms - elapsed_ms)
+        logger.info(f"Быстрый путь ({match.source}, {match.confidence:.2f}) за {elapsed_ms:.1f} мс: {match.tool_input}")
+        return answer
+
+    # --- Обучение на успешных прогонах агента ---
+
+    def _learn(self, text: str, tool_input: dict):
+        vector = np.asarray(get_embeddings().embed_query(normalize_command(text)), dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        with self._lock:
+            self._exemplars.append(_Exemplar(text, _guard_tokens(text), tool_input, vector))
+        self.learned += 1
+
+    async def learn(self, text: str, turn_messages: List[BaseMessage]):
+        """
+        Запоминает команду, если агент выполнил ее ровно одним вызовом
+        home_assistant (get_state или call_service) без ошибок.
+        """
+        if not self.use_embeddings:
+            return
+        calls = []
+        last_action = None
+        for message in turn_messages:
+            if isinstance(message, AIMessage):
+                try:
+                    last_action = parse_action(message.content)
+                except ValueError:
+                    last_action = None
+            elif isinstance(message, ToolMessage) and message.name != "respond_to_user":
+                calls.append((message, last_action))
+        if len(calls) != 1:
+            return
+        message, action = calls[0]
+        if message.name != "home_assistant" or not action or str(message.content).startswith("Ошибка"):
+            return
+        tool_input = action.get("action_input")
+        if not isinstance(tool_input, dict) or tool_input.get("operation") not in ("get_state", "call_service"):
+            return
+        try:
+            await asyncio.to_thread(self._learn, text, tool_input)
+        except Exception as e:
+            logger.error(f"Не удалось запомнить команду для быстрого пути: {e}")
+
+
+fast_router = FastPathRouter(
+    min_confidence=settings.router_min_confidence,
+    nn_threshold=settings.router_nn_threshold,
+    max_exemplars=settings.router_max_exemplars,
+    use_embeddings=settings.router_use_embeddings,
+)
@@ -0,0 +1,321 @@
+import json
+import logging
+import os
+import queue
+import select
+import struct
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+WORKER_SCRIPT = Path(__file__).with_name("sandbox_worker.py")
+
+
+class SandboxWorkerError(RuntimeError):
+    """Процесс-исполнитель упал или нарушил протокол."""
+
+
+class SandboxWorker:
+    """Один заранее запущенный интерпретатор с уже импортированными модулями."""
+
+    def __init__(self, preload: List[str]):
+        self.runs = 0
+        self.process = subprocess.Popen(
+            [sys.executable, "-u", str(WORKER_SCRIPT), *preload],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=None,
+        )
+        self._buffer = b""
+
+    def _read_exact(self, size: int, deadline: Optional[float]) -> bytes:
+        fd = self.process.stdout.fileno()
+        while len(self._buffer) < size:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            ready, _, _ = select.select([fd], [], [], timeout)
+            if not ready:
+                raise TimeoutError
+            chunk = self.process.stdout.read1(65536)
+            if not chunk:
+                raise SandboxWorkerError("Процесс-исполнитель завершился.")
+            self._buffer += chunk
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def receive(self, deadline: Optional[float]) -> dict:
+        (size,) = struct.unpack(">I", self._read_exact(4, deadline))
+        return json.loads(self._read_exact(size, deadline).decode("utf-8"))
+
+    def send(self, payload: dict):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        try:
+            self.process.stdin.write(struct.pack(">I", len(body)) + body)
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise SandboxWorkerError(f"Процесс-исполнитель недоступен: {e}")
+
+    def wait_ready(self, timeout: float):
+        self.receive(time.monotonic() + timeout)
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            pass
+        for stream in (self.process.stdin, self.process.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+
+class SandboxPool:
+    """
+    Пул прогретых исполнителей для python_script_executor.
+
+    Вместо запуска нового интерпретатора на каждый вызов код отправляется по
+    пайпу одному из заранее запущенных процессов. Исполнитель перезапускается
+    после max_runs скриптов, по таймауту или если он упал.
+
+    Вывод скрипта ограничен: в ответ попадают только начало и конец, а после
+    output_max_bytes скрипт останавливается. Если задан spill_dir, полный
+    вывод обрезанных запусков сохраняется там (последние spill_keep файлов).
+    """
+
+    def __init__(
+        self,
+        size: int,
+        preload: List[str],
+        max_runs: int,
+        timeout: float,
+        output_max_bytes: int = 1024 * 1024,
+        output_head_bytes: int = 3000,
+        output_tail_bytes: int = 1500,
+        spill_dir: Optional[str] = None,
+        spill_keep: int = 50,
+    ):
+        self.size = size
+        self.preload = preload
+        self.max_runs = max_runs
+        self.timeout = timeout
+        self.output_max_bytes = output_max_bytes
+        self.output_head_bytes = output_head_bytes
+        self.output_tail_bytes = output_tail_bytes
+        self.spill_dir = spill_dir
+        self.spill_keep = spill_keep
+        self._idle: "queue.LifoQueue[SandboxWorker]" = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._alive = 0
+        self._closed = False
+
+        self.runs = 0
+        self.recycled = 0
+        self.crashed = 0
+        self.timeouts = 0
+        self.output_kills = 0
+        self.truncated = 0
+        self.spilled = 0
+
+    def _spawn(self) -> Optional[SandboxWorker]:
+        try:
+            worker = SandboxWorker(self.preload)
+            worker.wait_ready(timeout=60)
+            return worker
+        except Exception as e:
+            logger.error(f"Не удалось запустить процесс-исполнитель: {e}")
+            with self._lock:
+                self._alive -= 1
+            return None
+
+    def _spawn_into_idle(self):
+        worker = self._spawn()
+        if worker is None:
+            return
+        if self._closed:
+            self._discard(worker)
+            return
+        self._idle.put(worker)
+
+    def _replace_in_background(self):
+        with self._lock:
+            if self._closed or self._alive >= self.size:
+                return
+            self._alive += 1
+        threading.Thread(target=self._spawn_into_idle, name="sandbox-spawn", daemon=True).start()
+
+    def _discard(self, worker: SandboxWorker):
+        worker.kill()
+        with self._lock:
+            self._alive -= 1
+
+    def start(self):
+        """Прогревает пул в фоне, не блокируя запуск приложения."""
+        self._closed = False
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        for _ in range(self.size):
+            self._replace_in_background()
+        logger.info(f"Пул исполнителей Python: {self.size} процессов, предзагрузка: {', '.join(self.preload) or '-'}")
+
+    def stop(self):
+        self._closed = True
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    def _acquire(self) -> SandboxWorker:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_spawn = self._alive < self.size
+            if can_spawn:
+                self._alive += 1
+        if can_spawn:
+            worker = self._spawn()
+            if worker is None:
+                raise SandboxWorkerError("Не удалось запустить процесс-исполнитель.")
+            return worker
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise subprocess.TimeoutExpired(cmd="python_script_executor", timeout=self.timeout)
+
+    def _release(self, worker: SandboxWorker):
+        worker.runs += 1
+        if self._closed or worker.runs >= self.max_runs:
+            self.recycled += 1
+            self._discard(worker)
+            self._replace_in_background()
+        else:
+            self._idle.put(worker)
+
+    def run(self, code: str) -> Tuple[int, str, str]:
+        """
+        Выполняет код в одном из исполнителей. Возвращает (returncode, stdout, stderr),
+        как subprocess.run. При превышении таймаута бросает subprocess.TimeoutExpired.
+        """
+        self.runs += 1
+        output_id = uuid.uuid4().hex[:12] if self.spill_dir else None
+        spill_path = self.spill_path(output_id) if output_id else None
+        request = {
+            "code": code,
+            "limits": {
+                "max_bytes": self.output_max_bytes,
+                "head_bytes": self.output_head_bytes,
+                "tail_bytes": self.output_tail_bytes,
+                "spill_path": spill_path,
+            },
+        }
+        # Простаивавший исполнитель мог умереть сам по себе - код еще не выполнялся,
+        # поэтому один раз берем другой. Сломанный исполнитель всегда заменяем, иначе пул усохнет.
+        for attempt in range(2):
+            worker = self._acquire()
+            try:
+                worker.send(request)
+                break
+            except SandboxWorkerError as e:
+                self.crashed += 1
+                self._discard(worker)
+                self._replace_in_background()
+                if attempt:
+                    self._remove_spill(spill_path)
+                    return 1, "", f"Не удалось передать код процессу-исполнителю: {e}"
+        try:
+            result = worker.receive(deadline=time.monotonic() + self.timeout)
+        except TimeoutError:
+            self.timeouts += 1
+            self._discard(worker)
+            self._replace_in_background()
+            self._remove_spill(spill_path)
+            raise subprocess.TimeoutExpired(cmd="python_script_executor", timeout=self.timeout)
+        except (SandboxWorkerError, ValueError, struct.error) as e:
+            self.crashed += 1
+            returncode = worker.process.poll()
+            self._discard(worker)
+            self._replace_in_background()
+            self._remove_spill(spill_path)
+            return returncode if returncode not in (None, 0) else 1, "", f"Процесс-исполнитель аварийно завершился: {e}"
+        self._release(worker)
+        return self._finish_output(result, output_id, spill_path)
+
+    def _finish_output(self, result: dict, output_id: Optional[str], spill_path: Optional[str]) -> Tuple[int, str, str]:
+        stdout, stderr = result["stdout"], result["stderr"]
+        total = result.get("stdout_bytes", 0) + result.get("stderr_bytes", 0)
+        if result.get("killed"):
+            self.output_kills += 1
+            logger.warning(f"Скрипт остановлен: вывод превысил {self.output_max_bytes} байт.")
+            stderr = f"Вывод превысил лимит {self.output_max_bytes} байт, скрипт остановлен.\n{stderr}"
+        if not result.get("truncated"):
+            self._remove_spill(spill_path)
+            return result["returncode"], stdout, stderr
+        self.truncated += 1
+        if spill_path and os.path.exists(spill_path):
+            self.spilled += 1
+            stdout += f"\n[полный вывод ({total} байт) сохранен: output_id={output_id}, файл {spill_path}]"
+            self._trim_spills()
+        return result["returncode"], stdout, stderr
+
+    # --- Полный вывод обрезанных запусков ---
+
+    def spill_path(self, output_id: str) -> Optional[str]:
+        if not self.spill_dir or not output_id.isalnum():
+            return None
+        return os.path.join(self.spill_dir, f"{output_id}.log")
+
+    def _remove_spill(self, spill_path: Optional[str]):
+        if spill_path:
+            try:
+                os.remove(spill_path)
+            except OSError:
+                pass
+
+    def _trim_spills(self):
+        try:
+            paths = [os.path.join(self.spill_dir, name) for name in os.listdir(self.spill_dir) if name.endswith(".log")]
+            paths.sort(key=os.path.getmtime)
+        except OSError as e:
+            logger.error(f"Не удалось прочитать каталог {self.spill_dir}: {e}")
+            return
+        for path in paths[:max(0, len(paths) - self.spill_keep)]:
+            self._remove_spill(path)
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "alive": self._alive,
+            "idle": self._idle.qsize(),
+            "runs": self.runs,
+            "recycled": self.recycled,
+            "crashed": self.crashed,
+            "timeouts": self.timeouts,
+            "output_kills": self.output_kills,
+            "truncated": self.truncated,
+            "spilled": self.spilled,
+        }
+
+
+sandbox_pool = SandboxPool(
+    size=settings.sandbox_pool_size,
+    preload=[name.strip() for name in settings.sandbox_preload_modules.split(",") if name.strip()],
+    max_runs=settings.sandbox_max_runs,
+    timeout=settings.sandbox_timeout,
+    output_max_bytes=settings.sandbox_output_max_bytes,
+    output_head_bytes=settings.sandbox_output_head_bytes,
+    output_tail_bytes=settings.sandbox_output_tail_bytes,
+    spill_dir=settings.sandbox_spill_dir,
+    spill_keep=settings.sandbox_spill_keep,
+)
@@ -0,0 +1,261 @@
+"""
+Процесс-исполнитель для python_script_executor.
+
+Запускается пулом из core/sandbox.py как отдельный скрипт (без импорта core),
+заранее импортирует модули из argv и затем выполняет присланный код по одному
+запросу за раз. Протокол: 4 байта длины (big-endian) + JSON в обе стороны.
+Настоящие fd 0/1 забираются под протокол, чтобы код скрипта не мог их испортить;
+на время запуска fd 1/2 указывают в каналы, так что вывод os.system, subprocess
+и C-расширений попадает туда же, куда print.
+
+stdout/stderr скрипта не копятся целиком: хранятся только начало и конец, а
+при превышении жесткого лимита скрипт останавливается исключением на
+следующей печати (вывод дочерних процессов дальше просто выбрасывается). Полный
+вывод по желанию пишется в файл (spill_path).
+"""
+import codecs
+import importlib
+import io
+import json
+import os
+import select
+import struct
+import sys
+import threading
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+
+
+def _read_exact(stream, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            return b""
+        data += chunk
+    return data
+
+
+def _send(stream, payload: dict):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    stream.write(struct.pack(">I", len(body)) + body)
+    stream.flush()
+
+
+class OutputLimitExceeded(BaseException):
+    """BaseException, чтобы `except Exception` в самом скрипте его не проглотил."""
+
+
+class _Output:
+    """Общий счетчик вывода скрипта и файл для полного вывода."""
+
+    def __init__(self, max_bytes: int, spill_path):
+        self.max_bytes = max_bytes
+        self.total = 0
+        self.killed = False
+        # В capture пишут и код скрипта, и поток, читающий fd 1/2
+        self.lock = threading.Lock()
+        self.spill = None
+        if spill_path:
+            try:
+                self.spill = open(spill_path, "w", encoding="utf-8", errors="replace")
+            except OSError as e:
+                print(f"sandbox worker: не удалось открыть {spill_path}: {e}", file=sys.__stderr__)
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+
+
+class _BoundedCapture:
+    """Вывод одного fd (stdout или stderr): хранит первые head_bytes и последние tail_bytes байт."""
+
+    def __init__(self, output: _Output, head_bytes: int, tail_bytes: int):
+        self.output = output
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def feed(self, data: bytes):
+        """Добавляет прочитанный с fd вывод; после превышения лимита данные выбрасываются."""
+        output = self.output
+        if output.killed:
+            return
+        text = self._decoder.decode(data)
+        with output.lock:
+            self.total += len(data)
+            output.total += len(data)
+            if output.spill is not None:
+                output.spill.write(text)
+            room = self.head_bytes - len(self.head)
+            if room > 0:
+                self.head += data[:room]
+                data = data[room:]
+            if data:
+                self.tail += data
+                if len(self.tail) > self.tail_bytes:
+                    del self.tail[:len(self.tail) - self.tail_bytes]
+            if output.total > output.max_bytes:
+                output.killed = True
+
+    def summary(self) -> str:
+        head = self.head.decode("utf-8", errors="ignore")
+        if self.total <= len(self.head) + len(self.tail):
+            return head + self.tail.decode("utf-8", errors="ignore")
+        skipped = self.total - len(self.head) - len(self.tail)
+        tail = self.tail.decode("utf-8", errors="ignore")
+        return f"{head}\n... [пропущено {skipped} байт] ...\n{tail}"
+
+
+class _FdWriter(io.TextIOBase):
+    """
+    sys.stdout/sys.stderr скрипта: пишет прямо в fd без буфера, чтобы print и
+    вывод дочерних процессов шли в одном порядке. После превышения лимита
+    останавливает скрипт.
+    """
+
+    def __init__(self, fd: int, output: _Output):
+        self.fd = fd
+        self.output = output
+
+    def writable(self) -> bool:
+        return True
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def write(self, text: str) -> int:
+        if self.output.killed:
+            raise OutputLimitExceeded
+        data = text.encode("utf-8", errors="replace")
+        while data:
+            data = data[os.write(self.fd, data):]
+        return len(text)
+
+
+class _FdCapture:
+    """
+    На время запуска направляет fd 1/2 в каналы и разбирает их в фоновом
+    потоке в те же _BoundedCapture. Поток читает и после превышения лимита
+    (выбрасывая данные), чтобы дочерний процесс не повис на полном канале;
+    такой скрипт останавливает таймаут пула.
+    """
+
+    def __init__(self, captures: dict):
+        self.captures = captures
+        self._readers = {}
+        self._saved = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, capture in self.captures.items():
+            read_fd, write_fd = os.pipe()
+            self._saved[fd] = os.dup(fd)
+            os.dup2(write_fd, fd)
+            os.close(write_fd)
+            self._readers[read_fd] = capture
+        self._thread = threading.Thread(target=self._drain, name="sandbox-fd-capture", daemon=True)
+        self._thread.start()
+        return self
+
+    def _drain(self):
+        readers = dict(self._readers)
+        while readers:
+            ready, _, _ = select.select(list(readers), [], [], 0.05)
+            if not ready and self._stop.is_set():
+                break
+            for read_fd in ready:
+                data = os.read(read_fd, 65536)
+                if data:
+                    readers[read_fd].feed(data)
+                else:
+                    del readers[read_fd]
+
+    def __exit__(self, *exc):
+        try:
+            # Буфер printf самого процесса (C-расширения) иначе пропадет
+            import ctypes
+
+            ctypes.CDLL(None).fflush(None)
+        except Exception:
+            pass
+        for fd, saved in self._saved.items():
+            os.dup2(saved, fd)
+            os.close(saved)
+        self._stop.set()
+        self._thread.join()
+        for read_fd in self._readers:
+            os.close(read_fd)
+        return False
+
+
+def _run(code: str, limits: dict) -> dict:
+    output = _Output(limits.get("max_bytes", 1 << 20), limits.get("spill_path"))
+    stdout = _BoundedCapture(output, limits.get("head_bytes", 4096), limits.get("tail_bytes", 2048))
+    stderr = _BoundedCapture(output, limits.get("head_bytes", 4096), limits.get("tail_bytes", 2048))
+    returncode = 0
+    sys.stdin = io.StringIO("")
+    with _FdCapture({1: stdout, 2: stderr}), redirect_stdout(_FdWriter(1, output)), redirect_stderr(_FdWriter(2, output)):
+        try:
+            try:
+                exec(compile(code, "<string>", "exec"), {"__name__": "__main__", "__builtins__": __builtins__})
+            except OutputLimitExceeded:
+                raise
+            except SystemExit as e:
+                if e.code is None:
+                    returncode = 0
+                elif isinstance(e.code, int):
+                    returncode = e.code
+                else:
+                    print(e.code, file=sys.stderr)
+                    returncode = 1
+            except BaseException as e:
+                # Пропускаем кадр самого исполнителя - трейсбек как у `python -c`
+                traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+                returncode = 1
+        except OutputLimitExceeded:
+            # Лимит мог сработать и на печати трейсбека
+            returncode = 1
+    output.close()
+    return {
+        "returncode": returncode,
+        "stdout": stdout.summary(),
+        "stderr": stderr.summary(),
+        "stdout_bytes": stdout.total,
+        "stderr_bytes": stderr.total,
+        "killed": output.killed,
+        "truncated": output.killed or any(s.total > len(s.head) + len(s.tail) for s in (stdout, stderr)),
+    }
+
+
+def main():
+    proto_in = os.fdopen(os.dup(0), "rb")
+    proto_out = os.fdopen(os.dup(1), "wb")
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+
+    for name in sys.argv[1:]:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print(f"sandbox worker: не удалось импортировать {name}: {e}", file=sys.stderr)
+
+    _send(proto_out, {"ready": True})
+    while True:
+        header = _read_exact(proto_in, 4)
+        if not header:
+            break
+        (size,) = struct.unpack(">I", header)
+        request = json.loads(_read_exact(proto_in, size).decode("utf-8"))
+        _send(proto_out, _run(request["code"], request.get("limits") or {}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from .config import settings
+from .metrics import QUEUE_WAIT, record_span
+
+logger = logging.getLogger(__name__)
+
+# Чем меньше число, тем раньше запрос получит слот LLM
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+TokenCallback = Callable[[str], None]
+TurnHandler = Callable[..., Awaitable[str]]
+
+
+class SchedulerBusyError(RuntimeError):
+    """Очередь переполнена, запрос отклонен без ожидания."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _percentiles(samples: "deque[float]") -> dict:
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None}
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 1)
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99)}
+
+
+class _Turn:
+    """Один ход диалога в очереди пользователя (возможно, из нескольких склеенных сообщений)."""
+
+    def __init__(self, user_id: str, text: str, handler: TurnHandler, on_token: Optional[TokenCallback], priority: int,
+                 prompt_variant: Optional[str], on_start: Optional[Callable[[], None]]):
+        self.user_id = user_id
+        self.texts = [text]
+        self.handler = handler
+        self.on_tokens: List[TokenCallback] = [on_token] if on_token else []
+        self.on_starts: List[Callable[[], None]] = [on_start] if on_start else []
+        self.priority = priority
+        self.prompt_variant = prompt_variant
+        self.enqueued_at = time.perf_counter()
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.waiters = 0
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def started(self) -> bool:
+        return self.task is not None
+
+    @property
+    def text(self) -> str:
+        return "\n".join(self.texts)
+
+    def can_merge(self, priority: int, prompt_variant: Optional[str]) -> bool:
+        return not self.started and self.priority == priority and self.prompt_variant == prompt_variant
+
+    def emit(self, delta: str):
+        for on_token in self.on_tokens:
+            on_token(delta)
+
+    def mark_started(self):
+        for on_start in self.on_starts:
+            try:
+                on_start()
+            except Exception as e:
+                logger.error(f"Ошибка в обработчике начала хода {self.user_id}: {e}")
+
+
+class _Lane:
+    def __init__(self):
+        self.pending: "deque[_Turn]" = deque()
+        self.worker: Optional[asyncio.Task] = None
+
+
+class TurnScheduler:
+    """
+    Планировщик ходов перед agent_graph.
+
+    Ходы одного user_id выполняются строго по очереди - два быстрых сообщения
+    больше не гоняются за одну и ту же ConversationBufferWindowMemory. Число
+    одновременных прогонов LLM ограничено глобально (llm_slot); ожидающие слота
+    выстраиваются по приоритету, интерактивные запросы идут раньше фоновых.
+    Если ходов в работе и в очереди больше лимита, новый запрос сразу
+    отклоняется (SchedulerBusyError -> HTTP 429), а не копится до таймаута бота.
+
+    При merge_window > 0 сообщения, пришедшие от пользователя, пока его
+    предыдущий ход еще не начался, склеиваются в один ход, а новый ход ждет
+    merge_window секунд на случай продолжения. Склеиваются только ходы с
+    тем же приоритетом и вариантом промпта; on_token и on_start вызываются
+    для каждого из склеенных сообщений.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, merge_window: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.merge_window = merge_window
+
+        self._lanes: Dict[str, _Lane] = {}
+        self._in_flight = 0
+        self._active = 0
+        self._slot_waiters: List[tuple] = []
+        self._seq = itertools.count()
+
+        self.completed = 0
+        self.rejected = 0
+        self.merged = 0
+        self.cancelled = 0
+        self._lane_wait_ms: "deque[float]" = deque(maxlen=1000)
+        self._llm_wait_ms: "deque[float]" = deque(maxlen=1000)
+
+    # --- Глобальный лимит на LLM ---
+
+    @asynccontextmanager
+    async def llm_slot(self, priority: int = PRIORITY_INTERACTIVE):
+        """Занимает один из max_concurrency слотов LLM на время прогона графа."""
+        started = time.perf_counter()
+        if self._active < self.max_concurrency and not self._slot_waiters:
+            self._active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._slot_waiters, (priority, next(self._seq), future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # Слот уже был передан нам - возвращаем его следующему
+                    self._release_slot()
+                raise
+        self._llm_wait_ms.append((time.perf_counter() - started) * 1000)
+        QUEUE_WAIT.labels(stage="llm").observe(time.perf_counter() - started)
+        record_span("queue.llm", started, priority=priority)
+        try:
+            yield
+        finally:
+            self._release_slot()
+
+    def _release_slot(self):
+        while self._slot_waiters:
+            _, _, future = heapq.heappop(self._slot_waiters)
+            if not future.done():
+                # Слот переходит следующему ожидающему, счетчик не меняется
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    # --- Очереди пользователей ---
+
+    def submit(
+        self,
+        user_id: str,
+        text: str,
+        handler: TurnHandler,
+        on_token: Optional[TokenCallback] = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        prompt_variant: Optional[str] = None,
+        on_start: Optional[Callable[[], None]] = None,
+    ) -> Awaitable[str]:
+        """
+        Ставит ход в очередь пользователя и возвращает awaitable с ответом.
+        handler(user_id, text, on_token=..., priority=..., prompt_variant=...) выполняет сам ход,
+        on_start вызывается, когда ход начал выполняться.
+        Переполнение очереди проверяется сразу, до первого await.
+        """
+        lane = self._lanes.get(user_id)
+        if self.merge_window > 0 and lane and lane.pending and lane.pending[-1].can_merge(priority, prompt_variant):
+            turn = lane.pending[-1]
+            turn.texts.append(text)
+            if on_token:
+                turn.on_tokens.append(on_token)
+            if on_start:
+                turn.on_starts.append(on_start)
+            turn.waiters += 1
+            self.merged += 1
+            logger.info(f"Сообщение пользователя {user_id} присоединено к ожидающему ходу.")
+            return self._wait(turn)
+
+        if self._in_flight >= self.max_concurrency + self.max_queue:
+            self.rejected += 1
+            raise SchedulerBusyError(
+                f"Очередь переполнена: {self._in_flight} запросов в работе.",
+                retry_after=max(1.0, self._estimate_wait_s()),
+            )
+
+        turn = _Turn(user_id, text, handler, on_token, priority, prompt_variant, on_start)
+        self._in_flight += 1
+        if lane is None:
+            lane = self._lanes[user_id] = _Lane()
+        lane.pending.append(turn)
+        if lane.worker is None:
+            lane.worker = asyncio.create_task(self._drain(user_id, lane))
+        turn.waiters += 1
+        return self._wait(turn)
+
+    async def _wait(self, turn: _Turn) -> str:
+        try:
+            return await asyncio.shield(turn.future)
+        except asyncio.CancelledError:
+            turn.waiters -= 1
+            if turn.waiters == 0 and not turn.future.done():
+                # Ответ больше никому не нужен - ход можно не выполнять
+                self.cancelled += 1
+                if turn.task is not None:
+                    turn.task.cancel()
+                else:
+                    turn.future.cancel()
+            raise
+
+    async def _drain(self, user_id: str, lane: _Lane):
+        try:
+            while lane.pending:
+                turn = lane.pending[0]
+                if self.merge_window > 0:
+                    await asyncio.sleep(self.merge_window)
+                if not turn.future.done():
+                    await self._execute(turn)
+                lane.pending.popleft()
+                self._in_flight -= 1
+        finally:
+            lane.worker = None
+            if self._lanes.get(user_id) is lane and not lane.pending:
+                del self._lanes[user_id]
+
+    async def _execute(self, turn: _Turn):
+        self._lane_wait_ms.append((time.perf_counter() - turn.enqueued_at) * 1000)
+        QUEUE_WAIT.labels(stage="lane").observe(time.perf_counter() - turn.enqueued_at)
+        on_token = turn.emit if turn.on_tokens else None
+        turn.mark_started()
+        turn.task = asyncio.create_task(
+            turn.handler(turn.user_id, turn.text, on_token=on_token, priority=turn.priority, prompt_variant=turn.prompt_variant)
+        )
+        try:
+            result = await turn.task
+        except asyncio.CancelledError:
+            if not turn.future.done():
+                turn.future.cancel()
+            return
+        except Exception as e:
+            if not turn.future.done():
+                turn.future.set_exception(e)
+            return
+        self.completed += 1
+        if not turn.future.done():
+            turn.future.set_result(result)
+
+    def _estimate_wait_s(self) -> float:
+        recent = list(self._lane_wait_ms)[-50:]
+        return (sum(recent) / len(recent) / 1000) if recent else 1.0
+
+    def active_users(self) -> List[str]:
+        """Пользователи, у которых есть ход в очереди или в работе."""
+        return list(self._lanes)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self._in_flight,
+            "llm_active": self._active,
+            "llm_waiting": len(self._slot_waiters),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "users_queued": len(self._lanes),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "merged": self.merged,
+            "cancelled": self.cancelled,
+            "queue_wait_ms": _percentiles(self._lane_wait_ms),
+            "llm_wait_ms": _percentiles(self._llm_wait_ms),
+        }
+
+
+turn_scheduler = TurnScheduler(
+    max_concurrency=settings.per_worker(
+        settings.scheduler_max_concurrency or len(settings.ollama_urls) * settings.ollama_backend_max_concurrency
+    ),
+    max_queue=settings.scheduler_max_queue,
+    merge_window=settings.scheduler_merge_window,
+)
@@ -0,0 +1,302 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+from langchain_core.messages import SystemMessage, messages_from_dict, messages_to_dict
+
+from .config import settings
+from .memory import HistorySummarizer, TokenBudgetMemory, get_short_term_memory, history_summarizer
+from .state_backend import StateBackend, state_backend
+
+logger = logging.getLogger(__name__)
+
+
+class _Session:
+    __slots__ = ("memory", "last_access", "size_bytes")
+
+    def __init__(self, memory: TokenBudgetMemory):
+        self.memory = memory
+        self.last_access = time.monotonic()
+        self.size_bytes = 0
+
+
+def _message_bytes(memory: TokenBudgetMemory) -> int:
+    """Грубая оценка памяти, занятой историей (по длине текста сообщений и сводки)."""
+    return len(memory.summary.encode("utf-8")) + sum(len(str(m.content).encode("utf-8")) for m in memory.chat_memory.messages)
+
+
+def _serialize(memory: TokenBudgetMemory) -> str:
+    # Сводка хранится первым системным сообщением, чтобы не менять схему таблицы
+    messages = memory.chat_memory.messages
+    if memory.summary:
+        messages = [SystemMessage(content=memory.summary), *messages]
+    return json.dumps(messages_to_dict(messages), ensure_ascii=False)
+
+
+def _deserialize(memory: TokenBudgetMemory, data: str):
+    messages = messages_from_dict(json.loads(data))
+    if messages and isinstance(messages[0], SystemMessage):
+        memory.summary = messages[0].content
+        messages = messages[1:]
+    memory.chat_memory.messages = messages
+
+
+class SessionStore:
+    """
+    Хранилище краткосрочной памяти пользователей вместо глобального словаря.
+
+    В памяти процесса держится ограниченное число сессий (LRU + вытеснение по
+    простою и по суммарному объему). Изменения пишутся в фоне в общее хранилище
+    (StateBackend: SQLite или Redis), вытесненная сессия подгружается оттуда при
+    следующем сообщении. Сообщения, вышедшие за окно или бюджет токенов, уходят
+    summarizer'у.
+    """
+
+    def __init__(
+        self,
+        backend: StateBackend,
+        max_sessions: int = 1000,
+        max_bytes: int = 64 * 1024 * 1024,
+        idle_ttl: float = 3600.0,
+        flush_interval: float = 2.0,
+        memory_factory: Callable[[], TokenBudgetMemory] = get_short_term_memory,
+        summarizer: Optional[HistorySummarizer] = history_summarizer,
+    ):
+        self.backend = backend
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.flush_interval = flush_interval
+        self.memory_factory = memory_factory
+        self.summarizer = summarizer
+
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self._total_bytes = 0
+        self._dirty: set = set()
+        # Снимки, которые еще не записаны на диск: user_id -> JSON
+        self._pending: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        # flush зовут и поток записи, и Cluster перед сдачей партиций - вернуться
+        # он должен, только когда записано все, включая пачку соседнего вызова
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._writer: Optional[threading.Thread] = None
+        # Обслуживает ли этот воркер пользователя (см. Cluster.owns); без кластера - всех
+        self._owns: Callable[[str], bool] = lambda user_id: True
+
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions_lru = 0
+        self.evictions_idle = 0
+        self.evictions_bytes = 0
+        self.evictions_released = 0
+        self.writes = 0
+
+    def _load(self, user_id: str) -> Optional[str]:
+        with self._lock:
+            pending = self._pending.get(user_id)
+        if pending is not None:
+            return pending
+        return self.backend.load_session(user_id)
+
+    # --- Публичный интерфейс ---
+
+    def get(self, user_id: str) -> TokenBudgetMemory:
+        """Возвращает память пользователя, при необходимости подгружая ее с диска."""
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is not None:
+                self.hits += 1
+                session.last_access = time.monotonic()
+                self._sessions.move_to_end(user_id)
+                return session.memory
+            self.misses += 1
+
+        memory = self.memory_factory()
+        try:
+            stored = self._load(user_id)
+            if stored:
+                _deserialize(memory, stored)
+                self.loads += 1
+        except Exception as e:
+            logger.error(f"Не удалось загрузить сессию user_id={user_id} из хранилища ({self.backend.name}): {e}")
+
+        with self._lock:
+            # Пока читали с диска, сессию мог создать параллельный запрос
+            existing = self._sessions.get(user_id)
+            if existing is not None:
+                return existing.memory
+            session = _Session(memory)
+            session.size_bytes = _message_bytes(memory)
+            self._sessions[user_id] = session
+            self._total_bytes += session.size_bytes
+            self._evict_locked()
+        return memory
+
+    def save(self, user_id: str, memory: TokenBudgetMemory):
+        """Отмечает сессию измененной: обрезает ее до окна и бюджета и ставит в очередь на запись."""
+        with self._lock:
+            session = self._sessions.get(user_id)
+            evicted = memory.trim()
+            if session is None and not self._owns(user_id):
+                # Партицию отдали другому воркеру посреди хода: дописываем ход в хранилище,
+                # но копию не держим - иначе при возврате партиции отдадим устаревшую
+                self._pending[user_id] = _serialize(memory)
+            else:
+                if session is None or session.memory is not memory:
+                    # Сессию вытеснили, пока шел ход диалога - возвращаем актуальную версию
+                    if session is not None:
+                        self._total_bytes -= session.size_bytes
+                    session = _Session(memory)
+                    self._sessions[user_id] = session
+                self._sessions.move_to_end(user_id)
+                new_size = _message_bytes(memory)
+                self._total_bytes += new_size - session.size_bytes
+                session.size_bytes = new_size
+                session.last_access = time.monotonic()
+                self._dirty.add(user_id)
+                self._evict_locked()
+        self._wake.set()
+        if evicted and self.summarizer is not None:
+            self.summarizer.schedule(user_id, memory, evicted, on_updated=self._summary_updated)
+
+    def _summary_updated(self, user_id: str, memory: TokenBudgetMemory):
+        """Сводка обновилась в фоне - сессию надо переписать на диск."""
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is None and not self._owns(user_id):
+                # Партиция уже у другого воркера, он мог дописать диалог - старый снимок не пишем
+                return
+            if session is None:
+                # Сессию уже вытеснили из памяти - пишем снимок напрямую
+                self._pending[user_id] = _serialize(memory)
+            else:
+                if session.memory is not memory:
+                    # Пока шло сжатие, сессию перечитали с диска
+                    session.memory.summary = memory.summary
+                new_size = _message_bytes(session.memory)
+                self._total_bytes += new_size - session.size_bytes
+                session.size_bytes = new_size
+                self._dirty.add(user_id)
+        self._wake.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "bytes": self._total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "loaded_from_disk": self.loads,
+                "evictions_lru": self.evictions_lru,
+                "evictions_idle": self.evictions_idle,
+                "evictions_bytes": self.evictions_bytes,
+                "evictions_released": self.evictions_released,
+                "pending_writes": len(self._dirty) + len(self._pending),
+                "writes": self.writes,
+            }
+
+    # --- Вытеснение ---
+
+    def _snapshot_locked(self, user_id: str, session: _Session):
+        self._pending[user_id] = _serialize(session.memory)
+        self._dirty.discard(user_id)
+
+    def _drop_locked(self, user_id: str):
+        session = self._sessions.pop(user_id)
+        self._total_bytes -= session.size_bytes
+        if user_id in self._dirty:
+            self._snapshot_locked(user_id, session)
+
+    def _evict_locked(self):
+        now = time.monotonic()
+        # Сессии упорядочены по последнему обращению - самые старые в начале
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if now - session.last_access <= self.idle_ttl:
+                break
+            self._drop_locked(user_id)
+            self.evictions_idle += 1
+        while len(self._sessions) > self.max_sessions:
+            self._drop_locked(next(iter(self._sessions)))
+            self.evictions_lru += 1
+        while self._total_bytes > self.max_bytes and len(self._sessions) > 1:
+            self._drop_locked(next(iter(self._sessions)))
+            self.evictions_bytes += 1
+
+    def release(self, should_release: Callable[[str], bool]) -> int:
+        """
+        Выгружает из памяти сессии, которые теперь обслуживает другой воркер,
+        и сразу записывает их изменения: новый владелец прочитает их из хранилища.
+        """
+        with self._lock:
+            user_ids = [user_id for user_id in self._sessions if should_release(user_id)]
+            for user_id in user_ids:
+                self._drop_locked(user_id)
+            self.evictions_released += len(user_ids)
+        if user_ids:
+            self._wake.set()
+        return len(user_ids)
+
+    # --- Фоновая запись ---
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                for user_id in list(self._dirty):
+                    self._snapshot_locked(user_id, self._sessions[user_id])
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            try:
+                self.backend.save_sessions(batch)
+                self.writes += len(batch)
+            except Exception as e:
+                logger.error(f"Ошибка записи сессий ({self.backend.name}): {e}")
+                with self._lock:
+                    # Возвращаем в очередь то, что не успели перезаписать более свежим снимком
+                    for user_id, data in batch.items():
+                        self._pending.setdefault(user_id, data)
+
+    def _writer_loop(self):
+        while not self._stopping:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            # Даем накопиться изменениям, чтобы писать пачками
+            time.sleep(min(0.05, self.flush_interval))
+            with self._lock:
+                self._evict_locked()
+            self.flush()
+        self.flush()
+
+    def start(self, owns: Optional[Callable[[str], bool]] = None):
+        if owns is not None:
+            self._owns = owns
+        if self._writer is not None:
+            return
+        self._stopping = False
+        self._writer = threading.Thread(target=self._writer_loop, name="session-writer", daemon=True)
+        self._writer.start()
+        logger.info(f"Хранилище сессий запущено ({self.backend.name}).")
+
+    def stop(self):
+        if self._writer is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        self._writer.join()
+        self._writer = None
+        logger.info("Хранилище сессий остановлено, все изменения записаны.")
+
+
+session_store = SessionStore(
+    backend=state_backend,
+    max_sessions=settings.sessions_max_count,
+    max_bytes=settings.sessions_max_bytes,
+    idle_ttl=settings.sessions_idle_ttl,
+)
@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _Stage:
+    __slots__ = ("name", "required", "status", "detail", "started_at", "duration")
+
+    def __init__(self, name: str, required: bool):
+        self.name = name
+        self.required = required
+        self.status = "pending"
+        self.detail: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.duration: Optional[float] = None
+
+    def to_dict(self, origin: float) -> dict:
+        return {
+            "name": self.name,
+            "status": self.status,
+            "required": self.required,
+            "detail": self.detail,
+            "start_ms": round((self.started_at - origin) * 1000, 1) if self.started_at is not None else None,
+            "duration_ms": round(self.duration * 1000, 1) if self.duration is not None else None,
+        }
+
+
+class StartupTracker:
+    """
+    Ход запуска nox-core.
+
+    API начинает принимать соединения сразу, а тяжелые этапы (импорт
+    langchain/langgraph, скачивание и прогрев модели, эмбеддинги, LanceDB)
+    идут в фоне. Каждый этап отмечается здесь со статусом и длительностью:
+    /ready отвечает 503 с прогрессом, пока не пройдены обязательные этапы,
+    /startup отдает весь профиль запуска.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self._stages: Dict[str, _Stage] = {}
+        # Этапы отмечаются и из потоков (импорт модулей, эмбеддинги)
+        self._lock = threading.Lock()
+        self.ready_at: Optional[float] = None
+
+    def declare(self, name: str, required: bool = True):
+        """Заводит этап заранее, чтобы /ready показывал его как pending."""
+        with self._lock:
+            if name not in self._stages:
+                self._stages[name] = _Stage(name, required)
+
+    def progress(self, name: str, detail: str):
+        self.declare(name)
+        self._stages[name].detail = detail
+
+    def record(self, name: str, started_at: float, required: bool = False, detail: Optional[str] = None):
+        """Этап, уже прошедший к моменту вызова (например, импорт модулей)."""
+        self.declare(name, required)
+        stage = self._stages[name]
+        stage.status = "done"
+        stage.started_at = started_at
+        stage.duration = time.perf_counter() - started_at
+        stage.detail = detail or stage.detail
+        self._check_ready()
+
+    @contextmanager
+    def stage(self, name: str, required: bool = True):
+        self.declare(name, required)
+        stage = self._stages[name]
+        stage.status = "running"
+        stage.started_at = time.perf_counter()
+        try:
+            yield stage
+        except Exception as e:
+            stage.status = "failed"
+            stage.detail = str(e)[:200]
+            raise
+        else:
+            stage.status = "done"
+        finally:
+            stage.duration = time.perf_counter() - stage.started_at
+            logger.info(f"Этап запуска '{name}': {stage.status} за {stage.duration * 1000:.0f} мс")
+            self._check_ready()
+
+    def _check_ready(self):
+        with self._lock:
+            if self.ready_at is not None or not self._all_done():
+                return
+            self.ready_at = time.perf_counter()
+        logger.info(f"Нокс готов к работе через {(self.ready_at - self.started_at):.2f} с после старта.")
+
+    def _all_done(self) -> bool:
+        return all(stage.status == "done" for stage in self._stages.values() if stage.required)
+
+    @property
+    def ready(self) -> bool:
+        with self._lock:
+            return self._all_done()
+
+    def pending(self) -> List[str]:
+        with self._lock:
+            return [stage.name for stage in self._stages.values() if stage.required and stage.status != "done"]
+
+    def report(self) -> dict:
+        pending = self.pending()
+        with self._lock:
+            stages = [stage.to_dict(self.started_at) for stage in self._stages.values()]
+        return {
+            "ready": not pending,
+            "ready_after_ms": round((self.ready_at - self.started_at) * 1000, 1) if self.ready_at else None,
+            "uptime_s": round(time.perf_counter() - self.started_at, 1),
+            "pending": pending,
+            "stages": stages,
+        }
+
+
+startup = StartupTracker()
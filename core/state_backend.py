@@ -0,0 +1,338 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class StateBackend:
+    """
+    Общее состояние воркеров nox-core.
+
+    Через него несколько процессов (uvicorn --workers) или реплик делят
+    краткосрочную память пользователей, очереди ходов, записи задач, список
+    живых воркеров и аренды партиций. Все методы синхронные и потокобезопасные: сессии пишет
+    фоновый поток SessionStore, очереди читает поток Cluster.
+    """
+
+    name = ""
+
+    # Краткосрочная память: user_id -> JSON сообщений
+    def load_session(self, user_id: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def save_sessions(self, batch: Dict[str, str]):
+        raise NotImplementedError
+
+    # Значения с временем жизни (записи задач)
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None):
+        raise NotImplementedError
+
+    # Очереди FIFO
+    def push(self, queue: str, value: str):
+        raise NotImplementedError
+
+    def pop(self, queues: Sequence[str], timeout: float) -> Optional[Tuple[str, str]]:
+        """Забирает первый элемент из первой непустой очереди, ожидая до timeout секунд."""
+        raise NotImplementedError
+
+    # Живые воркеры
+    def heartbeat(self, member: str, ttl: float) -> List[str]:
+        """Отмечает воркер живым и возвращает всех, кто отмечался за последние ttl секунд."""
+        raise NotImplementedError
+
+    def leave(self, member: str):
+        raise NotImplementedError
+
+    # Аренда партиций: ходы партиции выполняет только держатель аренды
+    def acquire_leases(self, names: Sequence[str], owner: str, ttl: float) -> List[str]:
+        """Берет свободные или просроченные аренды и продлевает свои; возвращает те, что теперь за owner."""
+        raise NotImplementedError
+
+    def release_leases(self, names: Sequence[str], owner: str):
+        """Снимает аренды, которые держит owner; чужие не трогает."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend(StateBackend):
+    """
+    Общий файл SQLite (WAL) для воркеров на одной машине.
+
+    Таблица sessions та же, что раньше была у SessionStore, так что
+    существующие сессии подхватываются без миграции. Ожидание в pop - это
+    опрос таблицы очереди с шагом poll_interval.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, db_path: str, poll_interval: float = 0.02):
+        self.db_path = db_path
+        self.poll_interval = poll_interval
+        # По соединению на поток: sqlite3 не любит одно соединение из нескольких потоков
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=10.0, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id TEXT PRIMARY KEY, messages TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, value TEXT NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS queue_name ON queue (name, id)")
+        conn.execute("CREATE TABLE IF NOT EXISTS members (member TEXT PRIMARY KEY, seen_at REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self._local.conn = conn
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def load_session(self, user_id: str) -> Optional[str]:
+        row = self._connect().execute("SELECT messages FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def save_sessions(self, batch: Dict[str, str]):
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT INTO sessions (user_id, messages, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET messages = excluded.messages, updated_at = excluded.updated_at",
+                [(user_id, data, now) for user_id, data in batch.items()],
+            )
+
+    def get(self, key: str) -> Optional[str]:
+        row = self._connect().execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None):
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute(
+                "INSERT INTO kv (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+                (key, value, now + ttl if ttl else None),
+            )
+            # Заодно подчищаем просроченное, отдельного фонового потока для этого нет
+            conn.execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+
+    def push(self, queue: str, value: str):
+        self._connect().execute("INSERT INTO queue (name, value) VALUES (?, ?)", (queue, value))
+
+    def _try_pop(self, conn: sqlite3.Connection, queues: Sequence[str]) -> Optional[Tuple[str, str]]:
+        with conn:
+            # IMMEDIATE сразу берет блокировку записи: два воркера не заберут один элемент
+            conn.execute("BEGIN IMMEDIATE")
+            for queue in queues:
+                row = conn.execute("SELECT id, value FROM queue WHERE name = ? ORDER BY id LIMIT 1", (queue,)).fetchone()
+                if row is not None:
+                    conn.execute("DELETE FROM queue WHERE id = ?", (row[0],))
+                    return queue, row[1]
+        return None
+
+    def pop(self, queues: Sequence[str], timeout: float) -> Optional[Tuple[str, str]]:
+        conn = self._connect()
+        placeholders = ",".join("?" * len(queues))
+        deadline = time.monotonic() + timeout
+        while True:
+            # Дешевая проверка без блокировки записи, пока очереди пусты
+            if conn.execute(f"SELECT 1 FROM queue WHERE name IN ({placeholders}) LIMIT 1", tuple(queues)).fetchone():
+                item = self._try_pop(conn, queues)
+                if item is not None:
+                    return item
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def heartbeat(self, member: str, ttl: float) -> List[str]:
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute(
+                "INSERT INTO members (member, seen_at) VALUES (?, ?) "
+                "ON CONFLICT(member) DO UPDATE SET seen_at = excluded.seen_at",
+                (member, now),
+            )
+            conn.execute("DELETE FROM members WHERE seen_at < ?", (now - ttl,))
+        return [row[0] for row in conn.execute("SELECT member FROM members ORDER BY member")]
+
+    def leave(self, member: str):
+        self._connect().execute("DELETE FROM members WHERE member = ?", (member,))
+
+    def acquire_leases(self, names: Sequence[str], owner: str, ttl: float) -> List[str]:
+        if not names:
+            return []
+        now = time.time()
+        placeholders = ",".join("?" * len(names))
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at <= ?",
+                [(name, owner, now + ttl, now) for name in names],
+            )
+            rows = conn.execute(
+                f"SELECT name FROM leases WHERE owner = ? AND name IN ({placeholders})", (owner, *names)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def release_leases(self, names: Sequence[str], owner: str):
+        if not names:
+            return
+        placeholders = ",".join("?" * len(names))
+        self._connect().execute(f"DELETE FROM leases WHERE owner = ? AND name IN ({placeholders})", (owner, *names))
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+
+class RedisBackend(StateBackend):
+    """
+    Redis (или любой сервер с тем же протоколом) для нескольких машин.
+
+    Сессии, записи задач и аренды партиций - строки, очереди - списки с BLPOP,
+    живые воркеры - хэш member -> время последнего heartbeat. Для тестов подходит
+    fakes/fake_redis.py.
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str, prefix: str = "nox:"):
+        self.url = url
+        self.prefix = prefix
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # redis нужен только этому бэкенду - импортируем при первом обращении
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import redis
+
+                    self._client = redis.Redis.from_url(self.url, decode_responses=True, health_check_interval=30)
+        return self._client
+
+    def _key(self, *parts: str) -> str:
+        return self.prefix + ":".join(parts)
+
+    def load_session(self, user_id: str) -> Optional[str]:
+        return self.client.get(self._key("session", user_id))
+
+    def save_sessions(self, batch: Dict[str, str]):
+        pipeline = self.client.pipeline(transaction=False)
+        for user_id, data in batch.items():
+            pipeline.set(self._key("session", user_id), data)
+        pipeline.execute()
+
+    def get(self, key: str) -> Optional[str]:
+        return self.client.get(self._key("kv", key))
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None):
+        self.client.set(self._key("kv", key), value, px=int(ttl * 1000) if ttl else None)
+
+    def push(self, queue: str, value: str):
+        self.client.rpush(self._key("queue", queue), value)
+
+    def pop(self, queues: Sequence[str], timeout: float) -> Optional[Tuple[str, str]]:
+        keys = [self._key("queue", queue) for queue in queues]
+        item = self.client.blpop(keys, timeout=timeout)
+        if item is None:
+            return None
+        key, value = item
+        return key[len(self._key("queue", "")):], value
+
+    def heartbeat(self, member: str, ttl: float) -> List[str]:
+        key = self._key("members")
+        now = time.time()
+        self.client.hset(key, member, now)
+        alive, stale = [], []
+        for name, seen_at in self.client.hgetall(key).items():
+            (alive if now - float(seen_at) <= ttl else stale).append(name)
+        if stale:
+            self.client.hdel(key, *stale)
+        return sorted(alive)
+
+    def leave(self, member: str):
+        self.client.hdel(self._key("members"), member)
+
+    def acquire_leases(self, names: Sequence[str], owner: str, ttl: float) -> List[str]:
+        keys = [self._key("lease", name) for name in names]
+        px = int(ttl * 1000)
+        pipeline = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.set(key, owner, nx=True, px=px)
+        created = pipeline.execute()
+        taken = [i for i, ok in enumerate(created) if not ok]
+        pipeline = self.client.pipeline(transaction=False)
+        for i in taken:
+            pipeline.get(keys[i])
+        # Свою аренду продлеваем; между GET и SET она может истечь, только если
+        # воркер не продлевал ее дольше ttl - тогда ее и так забирают
+        renew = [i for i, holder in zip(taken, pipeline.execute()) if holder == owner]
+        pipeline = self.client.pipeline(transaction=False)
+        for i in renew:
+            pipeline.set(keys[i], owner, px=px)
+        pipeline.execute()
+        held = {i for i, ok in enumerate(created) if ok} | set(renew)
+        return [name for i, name in enumerate(names) if i in held]
+
+    def release_leases(self, names: Sequence[str], owner: str):
+        keys = [self._key("lease", name) for name in names]
+        pipeline = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.get(key)
+        mine = [key for key, holder in zip(keys, pipeline.execute()) if holder == owner]
+        if mine:
+            self.client.delete(*mine)
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+def create_backend(kind: str) -> StateBackend:
+    if kind == "redis":
+        return RedisBackend(settings.state_redis_url)
+    return SQLiteBackend(settings.sessions_db_path)
+
+
+state_backend = create_backend(settings.state_backend)
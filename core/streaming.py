@@ -0,0 +1,289 @@
+import json
+import random
+import re
+from typing import List, Optional
+
+# --- Потоковое извлечение ответа пользователю из сырого вывода модели ---
+
+_RESPOND_ACTION_RE = re.compile(r'"action"\s*:\s*"respond_to_user"')
+_RESPONSE_FIELD_RE = re.compile(r'"response"\s*:\s*"')
+
+_SIMPLE_ESCAPES = {
+    '"': '"',
+    "\\": "\\",
+    "/": "/",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+}
+
+
+class ResponseStreamExtractor:
+    """
+    Принимает куски текста от модели по мере генерации и выдает текст поля
+    action_input.response, как только модель начала вызывать respond_to_user.
+    Все остальное (Thought, вызовы других инструментов) пользователю не показывается.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self._value_start: Optional[int] = None
+        self._pos = 0
+        self._closed = False
+
+    def feed(self, delta: str) -> str:
+        """Добавляет кусок сырого вывода и возвращает новый декодированный текст ответа."""
+        self.buffer += delta
+        if self._closed:
+            return ""
+
+        if self._value_start is None:
+            action_idx = self.buffer.rfind("Action:")
+            if action_idx == -1:
+                return ""
+            tail = self.buffer[action_idx:]
+            # В списке параллельных действий respond_to_user не выполняется (см. call_tool)
+            if tail[len("Action:"):].lstrip().startswith("["):
+                return ""
+            if not _RESPOND_ACTION_RE.search(tail):
+                return ""
+            field = _RESPONSE_FIELD_RE.search(tail)
+            if not field:
+                return ""
+            self._value_start = action_idx + field.end()
+            self._pos = self._value_start
+
+        return self._decode_available()
+
+    def _decode_available(self) -> str:
+        """Декодирует JSON-строку до конца буфера, не трогая незавершенные escape-последовательности."""
+        out = []
+        buf = self.buffer
+        i = self._pos
+        while i < len(buf):
+            ch = buf[i]
+            if ch == '"':
+                self._closed = True
+                i += 1
+                break
+            if ch != "\\":
+                out.append(ch)
+                i += 1
+                continue
+            if i + 1 >= len(buf):
+                break
+            esc = buf[i + 1]
+            if esc == "u":
+                if i + 6 > len(buf):
+                    break
+                width = 6
+                # Суррогатная пара (эмодзи) декодируется только целиком
+                if buf[i + 2:i + 4].lower() in ("d8", "d9", "da", "db"):
+                    if i + 12 > len(buf):
+                        break
+                    if buf[i + 6:i + 8] == "\\u":
+                        width = 12
+                try:
+                    out.append(json.loads(f'"{buf[i:i + width]}"'))
+                except ValueError:
+                    out.append(buf[i:i + width])
+                i += width
+                continue
+            out.append(_SIMPLE_ESCAPES.get(esc, esc))
+            i += 2
+        self._pos = i
+        return "".join(out)
+
+
+# --- Инкрементальный парсер Action с ранней остановкой генерации ---
+
+def _is_action(value) -> bool:
+    return isinstance(value, dict) and bool(value.get("action")) and "action_input" in value
+
+
+class ActionStreamParser:
+    """
+    Читает сырой вывод модели по кускам, находит маркер 'Action:' и следит за
+    балансом скобок. Как только объект закрылся и это валидный
+    {"action": ..., "action_input": ...}, парсер считается завершенным -
+    дальнейшую генерацию можно обрывать. После маркера может идти и список
+    таких объектов - независимые действия, которые выполняются параллельно.
+    """
+
+    MARKER = "Action:"
+
+    def __init__(self):
+        self.buffer = ""
+        self.action: Optional[dict] = None
+        self.actions: Optional[List[dict]] = None
+        self.end: Optional[int] = None
+        self.tokens = 0
+        self.tokens_after_action = 0
+        self._search_from = 0
+        self._start: Optional[int] = None
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    @property
+    def complete(self) -> bool:
+        return self.actions is not None
+
+    @property
+    def text(self) -> str:
+        """Вывод модели, обрезанный сразу после JSON действия."""
+        return self.buffer[:self.end] if self.complete else self.buffer
+
+    def feed(self, delta: str) -> bool:
+        """Добавляет кусок вывода. Возвращает True, когда действие полностью получено."""
+        if delta:
+            self.tokens += 1
+        if self.complete:
+            if delta:
+                self.tokens_after_action += 1
+            return True
+        self.buffer += delta
+        self._scan()
+        return self.complete
+
+    def _scan(self):
+        buf = self.buffer
+        while not self.complete:
+            if self._start is None:
+                marker_idx = buf.find(self.MARKER, self._search_from)
+                if marker_idx == -1:
+                    # Маркер мог прийти разрезанным между кусками
+                    self._search_from = max(0, len(buf) - len(self.MARKER) + 1)
+                    return
+                payload_idx = marker_idx + len(self.MARKER)
+                while payload_idx < len(buf) and buf[payload_idx].isspace():
+                    payload_idx += 1
+                if payload_idx == len(buf):
+                    self._search_from = marker_idx
+                    return
+                brace_idx = payload_idx if buf[payload_idx] == "[" else buf.find("{", payload_idx)
+                if brace_idx == -1:
+                    self._search_from = marker_idx
+                    return
+                self._start = brace_idx
+                self._pos = brace_idx
+                self._depth = 0
+                self._in_string = False
+                self._escape = False
+
+            while self._pos < len(buf):
+                ch = buf[self._pos]
+                self._pos += 1
+                if self._in_string:
+                    if self._escape:
+                        self._escape = False
+                    elif ch == "\\":
+                        self._escape = True
+                    elif ch == '"':
+                        self._in_string = False
+                    continue
+                if ch == '"':
+                    self._in_string = True
+                elif ch in "{[":
+                    self._depth += 1
+                elif ch in "}]":
+                    self._depth -= 1
+                    if self._depth == 0:
+                        break
+            else:
+                return
+
+            candidate = buf[self._start:self._pos]
+            try:
+                parsed = json.loads(candidate)
+            except ValueError:
+                parsed = None
+            if _is_action(parsed):
+                self.action = parsed
+                self.actions = [parsed]
+                self.end = self._pos
+                return
+            if isinstance(parsed, list) and parsed and all(_is_action(item) for item in parsed):
+                self.action = parsed[0] if len(parsed) == 1 else None
+                self.actions = parsed
+                self.end = self._pos
+                return
+            # Объект закрылся, но это не действие - ищем следующий маркер
+            self._search_from = self._pos
+            self._start = None
+
+
+def parse_actions(raw_response: str) -> List[dict]:
+    """Достает JSON действия (или список действий) из полного ответа модели, игнорируя текст после него."""
+    parser = ActionStreamParser()
+    parser.feed(raw_response)
+    if not parser.complete:
+        raise ValueError("В ответе модели не найден корректный JSON после 'Action:'")
+    return parser.actions
+
+
+def parse_action(raw_response: str) -> dict:
+    """Как parse_actions, но ответ должен содержать ровно одно действие."""
+    actions = parse_actions(raw_response)
+    if len(actions) != 1:
+        raise ValueError(f"Ожидалось одно действие, а модель вернула {len(actions)}")
+    return actions[0]
+
+
+class EarlyStopStats:
+    """
+    Счетчики ранней остановки генерации. Сэкономленные токены - оценка:
+    среднее число токенов, которые модель дописывает после JSON, измеряется
+    на шагах, где генерация дошла до конца сама (при выключенном
+    react_early_stop или на контрольной выборке, см. should_calibrate),
+    и умножается на число оборванных шагов.
+    """
+
+    def __init__(self):
+        self.steps = 0
+        self.early_stops = 0
+        self.tokens_generated = 0
+        self.tokens_discarded = 0
+        self._tail_samples = 0
+        self._tail_tokens = 0
+
+    def record(self, parser: ActionStreamParser, stopped_early: bool):
+        self.steps += 1
+        self.tokens_generated += parser.tokens
+        self.tokens_discarded += parser.tokens_after_action
+        if stopped_early:
+            self.early_stops += 1
+        elif parser.complete:
+            self._tail_samples += 1
+            self._tail_tokens += parser.tokens_after_action
+
+    def should_calibrate(self, sample_rate: float) -> bool:
+        """
+        Нужно ли дать этому шагу догенерироваться до конца, несмотря на
+        react_early_stop. Первый шаг - всегда, иначе среднего хвоста не будет
+        совсем, дальше - доля sample_rate шагов.
+        """
+        return not self._tail_samples or random.random() < sample_rate
+
+    @property
+    def avg_tail_tokens(self) -> Optional[float]:
+        if not self._tail_samples:
+            return None
+        return self._tail_tokens / self._tail_samples
+
+    def snapshot(self) -> dict:
+        avg_tail = self.avg_tail_tokens
+        return {
+            "steps": self.steps,
+            "early_stops": self.early_stops,
+            "tokens_generated": self.tokens_generated,
+            "tokens_discarded": self.tokens_discarded,
+            "avg_tail_tokens": avg_tail,
+            "tokens_saved_estimate": round(self.early_stops * avg_tail) if avg_tail is not None else None,
+        }
+
+
+early_stop_stats = EarlyStopStats()
@@ -0,0 +1,120 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(value: Any) -> Any:
+    """Приводит action_input к каноническому виду: модель по-разному расставляет пробелы и переводы строк."""
+    if isinstance(value, str):
+        lines = [line.rstrip() for line in value.replace("\r\n", "\n").split("\n")]
+        return "\n".join(lines).strip("\n")
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+class ToolResultCache:
+    """
+    Кэш результатов идемпотентных вызовов инструментов (LRU с TTL).
+
+    Инструмент подключается к кэшу объявлением в tool.metadata:
+      cache_ttl - сколько секунд результат считается свежим;
+      cache_if(tool_input, result) - можно ли кэшировать этот вызов (например,
+      только скрипты, признанные read-only, и только успешные результаты).
+    Ключ - имя инструмента и нормализованный action_input. Вызовы с побочными
+    эффектами сбрасывают кэш целиком (invalidate), чтобы чтение после записи
+    не вернуло устаревшее состояние.
+    """
+
+    def __init__(self, max_entries: int, enabled: bool = True):
+        self.max_entries = max_entries
+        self.enabled = enabled
+        # ключ -> (результат, время записи, срок жизни)
+        self._entries: "OrderedDict[str, Tuple[str, float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(tool_name: str, tool_input: Any) -> str:
+        return tool_name + "\x00" + json.dumps(_normalize(tool_input), sort_keys=True, ensure_ascii=False, default=str)
+
+    @staticmethod
+    def _ttl(tool) -> Optional[float]:
+        ttl = (getattr(tool, "metadata", None) or {}).get("cache_ttl")
+        return ttl if ttl and ttl > 0 else None
+
+    def lookup(self, tool, tool_input: Any) -> Optional[Tuple[str, float]]:
+        """Возвращает (результат, возраст в секундах) или None."""
+        if not self.enabled or self._ttl(tool) is None:
+            return None
+        key = self.make_key(tool.name, tool_input)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            result, stored_at, ttl = entry
+            if now - stored_at > ttl:
+                del self._entries[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return result, now - stored_at
+
+    def store(self, tool, tool_input: Any, result: Any):
+        ttl = self._ttl(tool)
+        if not self.enabled or ttl is None:
+            return
+        cache_if = tool.metadata.get("cache_if")
+        if cache_if is not None and not cache_if(tool_input, result):
+            return
+        key = self.make_key(tool.name, tool_input)
+        with self._lock:
+            self._entries[key] = (str(result), time.monotonic(), ttl)
+            self._entries.move_to_end(key)
+            self.stores += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        with self._lock:
+            if self._entries:
+                self.invalidations += 1
+                self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "stores": self.stores,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+tool_cache = ToolResultCache(max_entries=settings.tool_cache_max_entries, enabled=settings.tool_cache_enabled)
@@ -1,10 +1,12 @@
 import logging
-import subprocess
-import sys
-from typing import Literal, Optional, Dict, Any
+import re
+from typing import Literal, Optional, Dict, Any, List, Union
 from langchain_core.tools import tool
 from pydantic import BaseModel, Field
 from .config import settings
+from .sandbox import sandbox_pool
+from .home_assistant import ha_client
+from .tool_cache import tool_cache
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +28,25 @@ class PythonExecutorInput(BaseModel):
     """Схема для выполнения кода Python."""
     code: str = Field(description="Строка, содержащая полный и самодостаточный код на Python для выполнения.")
 
+# Признаки того, что скрипт что-то меняет или его вывод не повторяется от запуска к запуску.
+# Классификация консервативная: любое совпадение - и скрипт не кэшируется.
+_SCRIPT_SIDE_EFFECTS_RE = re.compile(
+    r"\.(post|put|patch|delete)\s*\("
+    r"|/api/services/|call_service|\bmethod\s*=\s*['\"](POST|PUT|PATCH|DELETE)"
+    r"|\bopen\s*\([^)]*,\s*(mode\s*=\s*)?['\"][rbt]*[wax+]|\.write(_text|_bytes)?\s*\("
+    r"|\bos\.(remove|unlink|rename|replace|mkdir|makedirs|rmdir|system|kill|chmod|chown)\b"
+    r"|\b(shutil|subprocess|socket|smtplib|sqlite3)\b"
+    r"|\b(random|uuid|secrets)\b|\btime\.time\b|\b(now|today|utcnow)\s*\(",
+    re.IGNORECASE,
+)
+
+def is_read_only_script(code: str) -> bool:
+    """Скрипт только читает данные (состояния, погоду и т.п.) и при повторе вернет то же самое."""
+    return not _SCRIPT_SIDE_EFFECTS_RE.search(code)
+
+def _cacheable_script_run(tool_input: dict, result: str) -> bool:
+    return str(result).startswith("Успешно выполнено") and is_read_only_script(tool_input.get("code", ""))
+
 @tool(args_schema=PythonExecutorInput)
 def python_script_executor(code: str) -> str:
     """
@@ -37,23 +58,109 @@ def python_script_executor(code: str) -> str:
     """
     logger.info(f"TOOL CALLED: python_script_executor with code:\n---\n{code[:300]}...\n---")
     try:
-        # Мы используем тот же интерпретатор Python, в котором запущен сам Nox
-        process = subprocess.run(
-            [sys.executable, "-c", code],
-            capture_output=True,
-            text=True,
-            timeout=30  # Ограничение по времени на выполнение
-        )
-        if process.returncode == 0:
-            logger.info(f"Script executed successfully. Output:\n{process.stdout}")
-            return f"Успешно выполнено. Вывод:\n{process.stdout}"
+        # Код выполняется в одном из заранее запущенных интерпретаторов пула
+        # (тот же Python, что и у самого Nox), таймаут - settings.sandbox_timeout
+        returncode, stdout, stderr = sandbox_pool.run(code)
+        if not is_read_only_script(code):
+            # Скрипт мог поменять то, что читают закэшированные скрипты
+            tool_cache.invalidate()
+        if returncode == 0:
+            logger.info(f"Script executed successfully. Output:\n{stdout}")
+            return f"Успешно выполнено. Вывод:\n{stdout}"
         else:
-            logger.error(f"Script failed. Stderr:\n{process.stderr}")
-            return f"Ошибка выполнения скрипта:\n{process.stderr}"
+            logger.error(f"Script failed. Stderr:\n{stderr}")
+            if stdout.strip():
+                return f"Ошибка выполнения скрипта:\n{stderr}\nВывод до ошибки:\n{stdout}"
+            return f"Ошибка выполнения скрипта:\n{stderr}"
     except Exception as e:
         logger.error(f"Failed to execute subprocess: {e}")
         return f"Критическая ошибка при запуске процесса: {e}"
 
+# --- ИНСТРУМЕНТ HOME ASSISTANT (состояния из памяти, сервисы по websocket) ---
+class HomeAssistantInput(BaseModel):
+    """Схема для работы с Home Assistant."""
+    operation: Literal["get_state", "list_entities", "call_service"] = Field(
+        description="get_state - состояние сущности, list_entities - список сущностей (можно по domain), call_service - вызвать сервис."
+    )
+    entity_id: Optional[Union[str, List[str]]] = Field(default=None, description="ID сущности (например, light.kitchen) или список ID.")
+    domain: Optional[str] = Field(default=None, description="Домен: light, switch, sensor, climate и т.д.")
+    service: Optional[str] = Field(default=None, description="Сервис для call_service: turn_on, turn_off, toggle и т.д.")
+    data: Optional[Dict[str, Any]] = Field(default=None, description="Дополнительные параметры сервиса (например, brightness).")
+
+_HA_HIDDEN_ATTRIBUTES = {"friendly_name", "icon", "supported_features", "supported_color_modes", "entity_picture"}
+
+def _format_ha_state(entity_id: str, state: Optional[dict]) -> str:
+    if state is None:
+        return f"{entity_id}: сущность не найдена"
+    attributes = state.get("attributes") or {}
+    name = attributes.get("friendly_name")
+    unit = attributes.get("unit_of_measurement", "")
+    line = f"{entity_id}{f' ({name})' if name else ''}: {state.get('state')}{f' {unit}' if unit else ''}"
+    extra = [f"{k}={v}" for k, v in attributes.items() if k not in _HA_HIDDEN_ATTRIBUTES and k != "unit_of_measurement"]
+    if extra:
+        line += f" [{', '.join(extra[:8])}]"
+    return line
+
+@tool(args_schema=HomeAssistantInput)
+def home_assistant(
+    operation: str,
+    entity_id: Optional[Union[str, List[str]]] = None,
+    domain: Optional[str] = None,
+    service: Optional[str] = None,
+    data: Optional[Dict[str, Any]] = None,
+) -> str:
+    """
+    Работа с умным домом через Home Assistant без написания скриптов.
+    Состояния сущностей отвечаются мгновенно из памяти. Используй его вместо
+    python_script_executor для проверки состояния устройств и для их включения/выключения.
+    operation: get_state (нужен entity_id), list_entities (можно указать domain),
+    call_service (нужны service и entity_id или domain, параметры - в data).
+    """
+    logger.info(f"TOOL CALLED: home_assistant {operation} entity_id={entity_id} domain={domain} service={service}")
+    entity_ids = [entity_id] if isinstance(entity_id, str) else list(entity_id or [])
+    try:
+        if operation == "get_state":
+            if not entity_ids:
+                return "Ошибка: для get_state нужен entity_id."
+            return "\n".join(_format_ha_state(eid, ha_client.get_state(eid)) for eid in entity_ids)
+
+        if operation == "list_entities":
+            states = ha_client.list_states(domain)
+            if not states:
+                return "Сущности не найдены."
+            lines = [_format_ha_state(s["entity_id"], s) for s in states[:100]]
+            if len(states) > 100:
+                lines.append(f"... и еще {len(states) - 100}")
+            return "\n".join(lines)
+
+        if operation == "call_service":
+            if not service:
+                return "Ошибка: для call_service нужен service."
+            if not domain:
+                if not entity_ids:
+                    return "Ошибка: для call_service нужен domain или entity_id."
+                domain = entity_ids[0].split(".", 1)[0]
+            previous = {eid: ha_client.get_state(eid) for eid in entity_ids} if ha_client.connected else {}
+            ha_client.call_service(domain, service, entity_id or None, data)
+            tool_cache.invalidate()
+            result = f"Сервис {domain}.{service} выполнен."
+            if entity_ids:
+                # Новое состояние приходит событием state_changed сразу после вызова
+                current = ha_client.wait_for_update(entity_ids, previous, timeout=0.5)
+                result += "\n" + "\n".join(_format_ha_state(eid, current.get(eid) or ha_client.get_state(eid)) for eid in entity_ids)
+            return result
+
+        return f"Ошибка: неизвестная операция '{operation}'."
+    except Exception as e:
+        logger.error(f"Ошибка Home Assistant: {e}")
+        return f"Ошибка при обращении к Home Assistant: {e}"
+
+# --- КЭШ РЕЗУЛЬТАТОВ ---
+# Скрипты только на чтение (состояния датчиков, погода) повторяются постоянно - их
+# результат переиспользуется до истечения TTL. home_assistant не кэшируется: его
+# состояния и так отдаются из памяти, а call_service имеет побочные эффекты.
+python_script_executor.metadata = {"cache_ttl": settings.tool_cache_script_ttl, "cache_if": _cacheable_script_run}
+
 # --- ОБНОВЛЕННЫЙ СПИСОК ИНСТРУМЕНТОВ ---
 # Мы убираем ha_control_tool и добавляем python_script_executor
-nox_tools = [python_script_executor, respond_to_user]
\ No newline at end of file
+nox_tools = [home_assistant, python_script_executor, respond_to_user]
\ No newline at end of file
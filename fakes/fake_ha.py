@@ -0,0 +1,226 @@
+"""
+Локальная заглушка Home Assistant для тестов и бенчмарков.
+
+Поддерживает то, чем пользуется core/home_assistant.py: REST (/api/states,
+/api/services/<domain>/<service>) и websocket (/api/websocket) с авторизацией,
+get_states, subscribe_events и call_service. Вызов сервиса меняет состояние и
+рассылает state_changed подписчикам.
+
+Запуск отдельно: python -m fakes.fake_ha --port 8123 --token test-token
+"""
+import argparse
+import asyncio
+import copy
+import threading
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from aiohttp import WSMsgType, web
+
+DEFAULT_STATES: List[dict] = [
+    {"entity_id": "light.kitchen", "state": "off", "attributes": {"friendly_name": "Свет на кухне"}},
+    {"entity_id": "light.living_room", "state": "on", "attributes": {"friendly_name": "Свет в гостиной", "brightness": 180}},
+    {"entity_id": "light.bedroom", "state": "off", "attributes": {"friendly_name": "Свет в спальне"}},
+    {"entity_id": "switch.kettle", "state": "off", "attributes": {"friendly_name": "Чайник"}},
+    {"entity_id": "sensor.temperature", "state": "22.5", "attributes": {"friendly_name": "Температура в квартире", "unit_of_measurement": "°C"}},
+    {"entity_id": "sensor.humidity", "state": "41", "attributes": {"friendly_name": "Влажность", "unit_of_measurement": "%"}},
+    {"entity_id": "sensor.outside_temperature", "state": "-3.0", "attributes": {"friendly_name": "Температура на улице", "unit_of_measurement": "°C"}},
+]
+
+_TOGGLE_DOMAINS = {"light", "switch", "fan", "input_boolean"}
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FakeHomeAssistant:
+    def __init__(self, token: str = "test-token", states: Optional[List[dict]] = None, latency: float = 0.0):
+        self.token = token
+        self.latency = latency
+        self.states: Dict[str, dict] = {}
+        for state in copy.deepcopy(states or DEFAULT_STATES):
+            state.setdefault("last_changed", _now())
+            state.setdefault("last_updated", state["last_changed"])
+            self.states[state["entity_id"]] = state
+        self.service_calls: List[dict] = []
+        self._subscribers: List[tuple] = []
+        self._runner: Optional[web.AppRunner] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self.url = ""
+
+    # --- Логика ---
+
+    def _authorized(self, request: web.Request) -> bool:
+        return request.headers.get("Authorization") == f"Bearer {self.token}"
+
+    async def _set_state(self, entity_id: str, new_value: str, attributes: Optional[dict] = None) -> dict:
+        old_state = copy.deepcopy(self.states.get(entity_id))
+        state = self.states.setdefault(entity_id, {"entity_id": entity_id, "attributes": {}})
+        state["state"] = new_value
+        state["attributes"].update(attributes or {})
+        state["last_changed"] = state["last_updated"] = _now()
+        event = {
+            "event_type": "state_changed",
+            "data": {"entity_id": entity_id, "old_state": old_state, "new_state": copy.deepcopy(state)},
+            "origin": "LOCAL",
+            "time_fired": _now(),
+        }
+        for ws, subscription_id in list(self._subscribers):
+            try:
+                await ws.send_json({"id": subscription_id, "type": "event", "event": event})
+            except ConnectionError:
+                self._subscribers.remove((ws, subscription_id))
+        return state
+
+    async def call_service(self, domain: str, service: str, service_data: dict, target: Optional[dict] = None) -> List[dict]:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        data = dict(service_data or {})
+        entity_ids = (target or {}).get("entity_id") or data.pop("entity_id", None) or []
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+        self.service_calls.append({"domain": domain, "service": service, "entity_id": entity_ids, "data": data})
+        changed = []
+        for entity_id in entity_ids:
+            current = self.states.get(entity_id, {}).get("state")
+            if domain in _TOGGLE_DOMAINS or domain == "homeassistant":
+                if service == "turn_on":
+                    new_value = "on"
+                elif service == "turn_off":
+                    new_value = "off"
+                elif service == "toggle":
+                    new_value = "off" if current == "on" else "on"
+                else:
+                    continue
+            else:
+                continue
+            if new_value != current or data:
+                changed.append(await self._set_state(entity_id, new_value, data))
+        return changed
+
+    # --- REST ---
+
+    async def _api_root(self, request: web.Request):
+        if not self._authorized(request):
+            return web.json_response({"message": "Unauthorized"}, status=401)
+        return web.json_response({"message": "API running."})
+
+    async def _api_states(self, request: web.Request):
+        if not self._authorized(request):
+            return web.json_response({"message": "Unauthorized"}, status=401)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response(list(self.states.values()))
+
+    async def _api_state(self, request: web.Request):
+        if not self._authorized(request):
+            return web.json_response({"message": "Unauthorized"}, status=401)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        state = self.states.get(request.match_info["entity_id"])
+        if state is None:
+            return web.json_response({"message": "Entity not found."}, status=404)
+        return web.json_response(state)
+
+    async def _api_service(self, request: web.Request):
+        if not self._authorized(request):
+            return web.json_response({"message": "Unauthorized"}, status=401)
+        body = await request.json() if request.can_read_body else {}
+        changed = await self.call_service(request.match_info["domain"], request.match_info["service"], body)
+        return web.json_response(changed)
+
+    # --- Websocket ---
+
+    async def _websocket(self, request: web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json({"type": "auth_required", "ha_version": "2024.6.0"})
+        auth = await ws.receive_json()
+        if auth.get("access_token") != self.token:
+            await ws.send_json({"type": "auth_invalid", "message": "Invalid access token"})
+            await ws.close()
+            return ws
+        await ws.send_json({"type": "auth_ok", "ha_version": "2024.6.0"})
+
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                message = msg.json()
+                msg_id, msg_type = message.get("id"), message.get("type")
+                if msg_type == "get_states":
+                    await ws.send_json({"id": msg_id, "type": "result", "success": True, "result": list(self.states.values())})
+                elif msg_type == "subscribe_events":
+                    self._subscribers.append((ws, msg_id))
+                    await ws.send_json({"id": msg_id, "type": "result", "success": True, "result": None})
+                elif msg_type == "call_service":
+                    await self.call_service(message.get("domain"), message.get("service"), message.get("service_data"), message.get("target"))
+                    await ws.send_json({"id": msg_id, "type": "result", "success": True, "result": {"context": {"id": f"fake-{msg_id}"}}})
+                elif msg_type == "ping":
+                    await ws.send_json({"id": msg_id, "type": "pong"})
+                else:
+                    await ws.send_json({"id": msg_id, "type": "result", "success": False,
+                                        "error": {"code": "unknown_command", "message": f"Unknown command: {msg_type}"}})
+        finally:
+            self._subscribers = [(s, i) for s, i in self._subscribers if s is not ws]
+        return ws
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/api/", self._api_root)
+        app.router.add_get("/api/states", self._api_states)
+        app.router.add_get("/api/states/{entity_id}", self._api_state)
+        app.router.add_post("/api/services/{domain}/{service}", self._api_service)
+        app.router.add_get("/api/websocket", self._websocket)
+        return app
+
+    # --- Запуск в фоновом потоке ---
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запускает сервер в отдельном потоке и возвращает его базовый URL."""
+        ready = threading.Event()
+
+        async def _serve():
+            self._runner = web.AppRunner(self.make_app())
+            await self._runner.setup()
+            site = web.TCPSite(self._runner, host, port)
+            await site.start()
+            bound_port = site._server.sockets[0].getsockname()[1]
+            self.url = f"http://{host}:{bound_port}"
+            ready.set()
+
+        def _thread_main():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(_serve())
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=_thread_main, name="fake-ha", daemon=True)
+        self._thread.start()
+        ready.wait(10)
+        return self.url
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result(10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(10)
+        self._loop = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Home Assistant")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8123)
+    parser.add_argument("--token", default="test-token")
+    parser.add_argument("--latency", type=float, default=0.0, help="Искусственная задержка ответа, с")
+    args = parser.parse_args()
+    fake = FakeHomeAssistant(token=args.token, latency=args.latency)
+    web.run_app(fake.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
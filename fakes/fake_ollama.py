@@ -0,0 +1,238 @@
+"""
+Локальная заглушка Ollama для тестов и бенчмарков.
+
+Отдает то, чем пользуются core/llm_client.py и main.py: /api/tags, /api/pull,
+/api/chat и /api/generate (потоково, NDJSON). Вместо модели - сценарий
+ReAct: на вопрос пользователя "модель" запрашивает home_assistant, а получив
+результат инструмента, отвечает через respond_to_user. Токены выдаются с
+заданной скоростью после задержки первого токена; стоп-последовательности из
+options.stop соблюдаются, как в настоящей Ollama.
+
+Запуск отдельно: python -m fakes.fake_ollama --port 11434 --token-rate 50
+"""
+import argparse
+import asyncio
+import json
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, List, Optional
+
+from aiohttp import web
+
+DEFAULT_MODEL = "gemma3n:e4b"
+
+_TOOL_RESULT_MARKER = "РЕЗУЛЬТАТ ВЫПОЛНЕНИЯ ИНСТРУМЕНТА:"
+_TOKEN_RE = re.compile(r"\s*\S{1,4}|\s+")
+
+Script = Callable[[str], str]
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _action(thought: str, action: str, action_input: dict) -> str:
+    payload = json.dumps({"action": action, "action_input": action_input}, ensure_ascii=False)
+    # Хвост после JSON имитирует болтливую модель - его должна отрезать ранняя остановка
+    return f"Thought: {thought}\nAction: {payload}\nObservation: жду результат"
+
+
+def react_script(prompt: str) -> str:
+    """Сценарий по умолчанию: один вызов home_assistant, затем ответ пользователю."""
+    turn = prompt[prompt.rfind("<start_of_turn>user\n"):]
+    if _TOOL_RESULT_MARKER in turn:
+        observation = turn[turn.rfind(_TOOL_RESULT_MARKER) + len(_TOOL_RESULT_MARKER):]
+        observation = observation.split("<end_of_turn>", 1)[0].strip()
+        return _action(
+            "Данные получены, можно отвечать.",
+            "respond_to_user",
+            {"response": f"Готово. {observation[:200]}"},
+        )
+    return _action(
+        "Нужно узнать текущее состояние датчика.",
+        "home_assistant",
+        {"operation": "get_state", "entity_id": "sensor.temperature"},
+    )
+
+
+def _truncate_at_stop(text: str, stop: Optional[List[str]]) -> str:
+    cut = len(text)
+    for sequence in stop or []:
+        index = text.find(sequence)
+        if index != -1:
+            cut = min(cut, index)
+    return text[:cut]
+
+
+class FakeOllama:
+    def __init__(
+        self,
+        model: str = DEFAULT_MODEL,
+        script: Optional[Script] = None,
+        token_rate: float = 0.0,
+        first_token_latency: float = 0.0,
+        installed: bool = True,
+    ):
+        self.model = model
+        self.script = script or react_script
+        # Токенов в секунду; 0 - без задержек между токенами
+        self.token_rate = token_rate
+        self.first_token_latency = first_token_latency
+        self.models: List[str] = [model] if installed else []
+        # Выключенная заглушка отвечает 503, как упавший узел
+        self.healthy = True
+
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0
+        self.cancelled = 0
+        self.prompts: List[str] = []
+
+        self._runner: Optional[web.AppRunner] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self.url = ""
+
+    # --- REST ---
+
+    def _unavailable(self) -> web.Response:
+        return web.json_response({"error": "service unavailable"}, status=503)
+
+    async def _api_tags(self, request: web.Request):
+        if not self.healthy:
+            return self._unavailable()
+        return web.json_response({"models": [{"name": name, "model": name, "modified_at": _now()} for name in self.models]})
+
+    async def _api_pull(self, request: web.Request):
+        body = await request.json()
+        name = body.get("name") or body.get("model")
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        for status in ("pulling manifest", "verifying sha256 digest", "writing manifest", "success"):
+            await response.write((json.dumps({"status": status}) + "\n").encode("utf-8"))
+        if name not in self.models:
+            self.models.append(name)
+        await response.write_eof()
+        return response
+
+    async def _stream(self, request: web.Request, prompt: str, body: dict, chat: bool):
+        if not self.healthy:
+            return self._unavailable()
+        if body.get("model") not in self.models:
+            return web.json_response({"error": f"model '{body.get('model')}' not found"}, status=404)
+
+        self.requests += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        self.prompts.append(prompt)
+        started = time.perf_counter()
+        completion = _truncate_at_stop(self.script(prompt), (body.get("options") or {}).get("stop"))
+        tokens = _TOKEN_RE.findall(completion)
+
+        def frame(content: str, done: bool, **extra) -> bytes:
+            payload = {"model": body["model"], "created_at": _now(), "done": done, **extra}
+            if chat:
+                payload["message"] = {"role": "assistant", "content": content}
+            else:
+                payload["response"] = content
+            return (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        try:
+            await response.prepare(request)
+            if self.first_token_latency:
+                await asyncio.sleep(self.first_token_latency)
+            prompt_eval_ns = int((time.perf_counter() - started) * 1e9)
+            for token in tokens:
+                await response.write(frame(token, False))
+                if self.token_rate:
+                    await asyncio.sleep(1.0 / self.token_rate)
+            total_ns = int((time.perf_counter() - started) * 1e9)
+            await response.write(frame(
+                "", True,
+                done_reason="stop",
+                total_duration=total_ns,
+                prompt_eval_count=len(prompt) // 4,
+                prompt_eval_duration=prompt_eval_ns,
+                eval_count=len(tokens),
+                eval_duration=total_ns - prompt_eval_ns,
+            ))
+            await response.write_eof()
+        except ConnectionResetError:
+            # Клиент оборвал поток (ранняя остановка или отмена запроса)
+            self.cancelled += 1
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            self.active -= 1
+        return response
+
+    async def _api_chat(self, request: web.Request):
+        body = await request.json()
+        prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+        return await self._stream(request, prompt, body, chat=True)
+
+    async def _api_generate(self, request: web.Request):
+        body = await request.json()
+        return await self._stream(request, body.get("prompt", ""), body, chat=False)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/api/tags", self._api_tags)
+        app.router.add_post("/api/pull", self._api_pull)
+        app.router.add_post("/api/chat", self._api_chat)
+        app.router.add_post("/api/generate", self._api_generate)
+        return app
+
+    # --- Запуск в фоновом потоке ---
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запускает сервер в отдельном потоке и возвращает его базовый URL."""
+        ready = threading.Event()
+
+        async def _serve():
+            self._runner = web.AppRunner(self.make_app())
+            await self._runner.setup()
+            site = web.TCPSite(self._runner, host, port)
+            await site.start()
+            bound_port = site._server.sockets[0].getsockname()[1]
+            self.url = f"http://{host}:{bound_port}"
+            ready.set()
+
+        def _thread_main():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(_serve())
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=_thread_main, name="fake-ollama", daemon=True)
+        self._thread.start()
+        ready.wait(10)
+        return self.url
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result(10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(10)
+        self._loop = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Ollama")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--token-rate", type=float, default=0.0, help="Токенов в секунду, 0 - без задержки")
+    parser.add_argument("--first-token-latency", type=float, default=0.0, help="Задержка первого токена, с")
+    args = parser.parse_args()
+    fake = FakeOllama(model=args.model, token_rate=args.token_rate, first_token_latency=args.first_token_latency)
+    web.run_app(fake.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
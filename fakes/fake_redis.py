@@ -0,0 +1,276 @@
+"""
+Локальная заглушка Redis для тестов и бенчмарков.
+
+Говорит на RESP2 и поддерживает то, чем пользуется core/state_backend.py:
+строки с истечением (GET/SET EX/PX/NX, DEL), списки с блокирующим чтением
+(RPUSH, LPOP, BLPOP, LLEN), хэши (HSET, HGETALL, HDEL), а также PING,
+SELECT, CLIENT, FLUSHALL и DBSIZE. Все данные живут в памяти одного процесса.
+
+Запуск отдельно: python -m fakes.fake_redis --port 6379
+"""
+import argparse
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+
+class _Error(Exception):
+    pass
+
+
+class FakeRedis:
+    def __init__(self):
+        self._strings: Dict[bytes, Tuple[bytes, Optional[float]]] = {}
+        self._lists: Dict[bytes, Deque[bytes]] = {}
+        self._hashes: Dict[bytes, Dict[bytes, bytes]] = {}
+        # Ключ списка -> ожидающие BLPOP (в порядке прихода)
+        self._waiters: Dict[bytes, Deque[asyncio.Future]] = {}
+        self.commands = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._writers: set = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self.url = ""
+
+    # --- Данные ---
+
+    def _get_string(self, key: bytes) -> Optional[bytes]:
+        entry = self._strings.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._strings[key]
+            return None
+        return value
+
+    def _exists(self, key: bytes) -> bool:
+        return self._get_string(key) is not None or key in self._lists or key in self._hashes
+
+    def _delete(self, key: bytes) -> int:
+        found = self._exists(key)
+        self._strings.pop(key, None)
+        self._lists.pop(key, None)
+        self._hashes.pop(key, None)
+        return int(found)
+
+    def _push(self, key: bytes, values: List[bytes]) -> int:
+        items = self._lists.setdefault(key, deque())
+        items.extend(values)
+        length = len(items)
+        # Отдаем элементы тем, кто уже ждет в BLPOP
+        waiters = self._waiters.get(key)
+        while waiters and items:
+            future = waiters.popleft()
+            if not future.done():
+                future.set_result((key, items.popleft()))
+        if not items:
+            del self._lists[key]
+        return length
+
+    def _pop(self, key: bytes) -> Optional[bytes]:
+        items = self._lists.get(key)
+        if not items:
+            return None
+        value = items.popleft()
+        if not items:
+            del self._lists[key]
+        return value
+
+    # --- Команды ---
+
+    async def _execute(self, args: List[bytes]):
+        self.commands += 1
+        name = args[0].upper().decode()
+        if name == "PING":
+            return ("+", b"PONG") if len(args) == 1 else args[1]
+        if name in ("SELECT", "CLIENT"):
+            return ("+", b"OK")
+        if name == "FLUSHALL":
+            self._strings.clear(), self._lists.clear(), self._hashes.clear()
+            return ("+", b"OK")
+        if name == "DBSIZE":
+            return len({k for k in self._strings if self._get_string(k) is not None} | set(self._lists) | set(self._hashes))
+        if name == "GET":
+            return self._get_string(args[1])
+        if name == "SET":
+            key, value, options = args[1], args[2], [a.upper() for a in args[3:]]
+            expires_at = None
+            for option, raw in zip(options, args[4:] + [b""]):
+                if option == b"EX":
+                    expires_at = time.monotonic() + float(raw)
+                elif option == b"PX":
+                    expires_at = time.monotonic() + float(raw) / 1000
+            if b"NX" in options and self._exists(key):
+                return None
+            self._lists.pop(key, None)
+            self._hashes.pop(key, None)
+            self._strings[key] = (value, expires_at)
+            return ("+", b"OK")
+        if name == "DEL":
+            return sum(self._delete(key) for key in args[1:])
+        if name == "RPUSH":
+            return self._push(args[1], list(args[2:]))
+        if name == "LPOP":
+            return self._pop(args[1])
+        if name == "LLEN":
+            return len(self._lists.get(args[1], ()))
+        if name == "BLPOP":
+            keys, timeout = args[1:-1], float(args[-1])
+            for key in keys:
+                value = self._pop(key)
+                if value is not None:
+                    return [key, value]
+            future = asyncio.get_running_loop().create_future()
+            for key in keys:
+                self._waiters.setdefault(key, deque()).append(future)
+            try:
+                key, value = await asyncio.wait_for(future, timeout) if timeout > 0 else await future
+                return [key, value]
+            except asyncio.TimeoutError:
+                return ("*", None)
+            finally:
+                for key in keys:
+                    waiters = self._waiters.get(key)
+                    if waiters is not None:
+                        try:
+                            waiters.remove(future)
+                        except ValueError:
+                            pass
+                        if not waiters:
+                            del self._waiters[key]
+        if name == "HSET":
+            fields = self._hashes.setdefault(args[1], {})
+            added = 0
+            for field, value in zip(args[2::2], args[3::2]):
+                added += field not in fields
+                fields[field] = value
+            return added
+        if name == "HGETALL":
+            result = []
+            for field, value in self._hashes.get(args[1], {}).items():
+                result += [field, value]
+            return result
+        if name == "HDEL":
+            fields = self._hashes.get(args[1], {})
+            removed = sum(fields.pop(field, None) is not None for field in args[2:])
+            if not fields:
+                self._hashes.pop(args[1], None)
+            return removed
+        raise _Error(f"ERR unknown command '{name}'")
+
+    # --- RESP ---
+
+    @staticmethod
+    def _encode(value) -> bytes:
+        if isinstance(value, tuple):
+            kind, payload = value
+            if kind == "*":
+                return b"*-1\r\n"
+            return b"+" + payload + b"\r\n"
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, bytes):
+            return b"$%d\r\n%s\r\n" % (len(value), value)
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(FakeRedis._encode(item) for item in value)
+        raise TypeError(type(value))
+
+    @staticmethod
+    async def _read_command(reader: asyncio.StreamReader) -> Optional[List[bytes]]:
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # Inline-команда (например, из redis-cli или telnet)
+            return line.strip().split()
+        args = []
+        for _ in range(int(line[1:])):
+            header = await reader.readline()
+            size = int(header[1:])
+            args.append((await reader.readexactly(size + 2))[:-2])
+        return args
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            while True:
+                args = await self._read_command(reader)
+                if args is None:
+                    break
+                if not args:
+                    continue
+                try:
+                    reply = self._encode(await self._execute(args))
+                except (_Error, IndexError, ValueError) as e:
+                    message = str(e) if isinstance(e, _Error) else "ERR syntax error"
+                    reply = b"-" + message.encode() + b"\r\n"
+                writer.write(reply)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    # --- Запуск в фоновом потоке ---
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запускает сервер в отдельном потоке и возвращает его URL (redis://...)."""
+        ready = threading.Event()
+
+        async def _serve():
+            self._server = await asyncio.start_server(self._handle, host, port)
+            bound_port = self._server.sockets[0].getsockname()[1]
+            self.url = f"redis://{host}:{bound_port}/0"
+            ready.set()
+
+        def _thread_main():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(_serve())
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=_thread_main, name="fake-redis", daemon=True)
+        self._thread.start()
+        ready.wait(10)
+        return self.url
+
+    def stop(self):
+        if self._loop is None:
+            return
+
+        async def _close():
+            self._server.close()
+            # Клиенты, висящие в BLPOP, иначе не дадут серверу закрыться
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(_close(), self._loop).result(10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(10)
+        self._loop = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Redis")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+    fake = FakeRedis()
+
+    async def _serve():
+        server = await asyncio.start_server(fake._handle, args.host, args.port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(_serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,12 @@
+import json
 import logging
 import os
+import time
+from typing import Optional
+
 import httpx
-from telegram import Update
+from telegram import Message, Update
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
 # Настройка логирования
@@ -10,13 +15,107 @@ logger = logging.getLogger(__name__)
 
 # --- Загрузка конфигурации из переменных окружения ---
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-NOX_CORE_URL = os.getenv("NOX_CORE_URL", "http://nox-core:8000/command/telegram")
+NOX_CORE_URL = os.getenv("NOX_CORE_URL", "http://nox-core:8000").rstrip("/")
+# Раньше в NOX_CORE_URL лежал полный адрес эндпоинта - старые .env продолжают работать
+LEGACY_ENDPOINT = "/command/telegram"
+if NOX_CORE_URL.endswith(LEGACY_ENDPOINT):
+    NOX_CORE_URL = NOX_CORE_URL[:-len(LEGACY_ENDPOINT)]
+    logger.warning(f"NOX_CORE_URL должен быть базовым адресом nox-core, использую {NOX_CORE_URL} (путь {LEGACY_ENDPOINT} отброшен).")
 ALLOWED_USER_IDS = [int(uid.strip()) for uid in os.getenv("TELEGRAM_ALLOWED_IDS", "").split(',') if uid]
+# Telegram ограничивает частоту правок сообщения, поэтому обновляем "Думаю..." не чаще раза в интервал
+EDIT_INTERVAL = float(os.getenv("TELEGRAM_EDIT_INTERVAL", "1.0"))
+JOB_TIMEOUT = float(os.getenv("NOX_JOB_TIMEOUT", "300"))
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Один пул соединений к nox-core на весь процесс бота
+http_client: Optional[httpx.AsyncClient] = None
+
+async def post_init(application: Application) -> None:
+    global http_client
+    http_client = httpx.AsyncClient(
+        base_url=NOX_CORE_URL,
+        timeout=httpx.Timeout(10.0, read=JOB_TIMEOUT),
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=200),
+    )
+
+async def post_shutdown(application: Application) -> None:
+    if http_client is not None:
+        await http_client.aclose()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /start."""
     await update.message.reply_text('Нокс v3.0 "Маленький Тигр" на связи. Жду команд.')
 
+class MessageUpdater:
+    """Правит сообщение "Думаю..." по мере прихода ответа, не чаще EDIT_INTERVAL."""
+
+    def __init__(self, message: Message):
+        self.message = message
+        self.shown = message.text
+        self.edited_at = 0.0
+
+    async def show(self, text: str, force: bool = False) -> None:
+        text = text[:TELEGRAM_MESSAGE_LIMIT]
+        if not text.strip() or text == self.shown:
+            return
+        if not force and time.monotonic() - self.edited_at < EDIT_INTERVAL:
+            return
+        try:
+            await self.message.edit_text(text)
+            self.shown = text
+        except RetryAfter as e:
+            logger.warning(f"Telegram просит подождать {e.retry_after} с перед правкой сообщения.")
+        except BadRequest as e:
+            # "Message is not modified" и подобное - не повод ронять доставку
+            logger.debug(f"Не удалось отредактировать сообщение: {e}")
+        self.edited_at = time.monotonic()
+
+    async def finish(self, text: str) -> None:
+        await self.show(text, force=True)
+        # Длинный ответ не влезает в одно сообщение - досылаем остаток
+        for offset in range(TELEGRAM_MESSAGE_LIMIT, len(text), TELEGRAM_MESSAGE_LIMIT):
+            await self.message.reply_text(text[offset:offset + TELEGRAM_MESSAGE_LIMIT])
+
+async def follow_job(job_id: str, updater: MessageUpdater) -> None:
+    """Читает события задачи из nox-core и переносит их в сообщение Telegram."""
+    partial = ""
+    try:
+        async with http_client.stream("GET", f"/jobs/{job_id}/events") as response:
+            response.raise_for_status()
+            event = None
+            async for line in response.aiter_lines():
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                    continue
+                if not line.startswith("data:"):
+                    continue
+                data = json.loads(line[len("data:"):])
+                if event == "token":
+                    partial += data.get("delta", "")
+                    await updater.show(partial)
+                elif event == "done":
+                    await updater.finish(data.get("response") or "Получен пустой ответ.")
+                    return
+                elif event == "error":
+                    logger.error(f"nox-core не смог выполнить задачу {job_id}: {data.get('detail')}")
+                    await updater.finish("Простите, что-то пошло не так. Попробуйте еще раз.")
+                    return
+    except httpx.HTTPError as e:
+        logger.warning(f"Поток событий задачи {job_id} оборвался: {e}")
+
+    # Поток оборвался раньше времени - забираем итог одним запросом
+    try:
+        response = await http_client.get(f"/jobs/{job_id}")
+        response.raise_for_status()
+        job = response.json()
+        if job.get("status") == "done":
+            await updater.finish(job.get("response") or "Получен пустой ответ.")
+            return
+    except httpx.HTTPError as e:
+        logger.error(f"Не удалось получить результат задачи {job_id}: {e}")
+    await updater.finish("Простите, не могу связаться со своим ядром. Попробуйте позже.")
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает текстовые сообщения."""
     user = update.effective_user
@@ -30,7 +129,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     message_text = update.message.text
     logger.info(f"Получено сообщение от user_id={user_id}: '{message_text}'")
-    await update.message.reply_text("Думаю...") # Предварительный ответ
+    thinking = await update.message.reply_text("Думаю...") # Предварительный ответ
+    updater = MessageUpdater(thinking)
 
     payload = {
         "user_id": str(user_id),
@@ -38,15 +138,25 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     }
 
     try:
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(NOX_CORE_URL, json=payload)
-            response.raise_for_status()
-            nox_response = response.json().get("response", "Получен пустой ответ.")
-    except httpx.RequestError as e:
+        response = await http_client.post("/jobs", json=payload)
+        if response.status_code == 429:
+            await updater.finish("Я сейчас очень занят. Напишите мне через минутку.")
+            return
+        response.raise_for_status()
+        job_id = response.json()["job_id"]
+    except httpx.HTTPError as e:
         logger.error(f"Ошибка подключения к nox-core: {e}")
-        nox_response = "Простите, не могу связаться со своим ядром. Попробуйте позже."
-    
-    await update.message.reply_text(nox_response)
+        await updater.finish("Простите, не могу связаться со своим ядром. Попробуйте позже.")
+        return
+
+    # Ответ дочитывается в фоне, обработчик сразу освобождается для других чатов
+    context.application.create_task(follow_job(job_id, updater), update=update)
+
+async def handle_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if isinstance(context.error, TelegramError):
+        logger.warning(f"Ошибка Telegram: {context.error}")
+    else:
+        logger.error(f"Необработанная ошибка бота: {context.error}")
 
 def main() -> None:
     """Основная функция запуска бота."""
@@ -55,12 +165,20 @@ def main() -> None:
         return
 
     logger.info("Запуск Telegram-бота...")
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_error_handler(handle_error)
 
     application.run_polling()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
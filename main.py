@@ -1,101 +1,485 @@
+# Первым делом: отсюда отсчитывается профиль запуска
+from core.startup import startup
+
+import asyncio
 import logging
 import uvicorn
+from contextlib import asynccontextmanager
 import httpx
 import json
-from fastapi import FastAPI
+import time
+from typing import Callable, Optional
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.messages import HumanMessage, AIMessage, ToolMessage
 
 from core.config import settings
-from core.memory import get_short_term_memory, format_history_for_gemma3n
-from core.agent import agent_graph
-from core.agent import agent_graph, prompt_components
+from core.memory import get_embeddings, history_render_cache, history_summarizer, long_term_memory, format_memories_for_gemma3n, format_summary_for_gemma3n
+from core.sessions import session_store
+from core.sandbox import sandbox_pool
+from core.home_assistant import ha_client
+from core.llm_client import llm_pool
+from core.scheduler import turn_scheduler, SchedulerBusyError, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from core.jobs import job_manager
+from core.cluster import cluster
+from core.state_backend import state_backend
+from core.tool_cache import tool_cache
+from core.streaming import early_stop_stats
+from core.metrics import METRICS_CONTENT_TYPE, REACT_STEPS, REQUESTS, mark_process_dead, record_span, render_metrics, slow_trace_sampler, trace_request
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
-app = FastAPI(title="Nox v3.0 'Little Tiger' API")
+
+# Граф агента, быстрый путь и кэш ответов тянут langchain tools, langgraph и
+# lancedb - они импортируются в фоне после старта (см. _load_components)
+agent_graph = node_timings = prompt_registry = fast_router = response_cache = None
+_components_task: Optional[asyncio.Task] = None
+_HEAVY_MODULES = ("core.agent", "core.router", "core.response_cache")
+
+def _import_components():
+    global agent_graph, node_timings, prompt_registry, fast_router, response_cache
+    with startup.stage("import:core.agent"):
+        from core.agent import agent_graph, node_timings, prompt_registry
+    with startup.stage("import:core.router"):
+        from core.router import fast_router
+    with startup.stage("import:core.response_cache"):
+        from core.response_cache import response_cache
+
+async def _load_components():
+    await asyncio.to_thread(_import_components)
+    prompt_registry.start()
+    if settings.startup_warmup:
+        _spawn_background(asyncio.to_thread(_warm_up_storage))
+
+async def _ensure_components():
+    """Дожидается фоновой загрузки компонентов (без lifespan грузит их сразу)."""
+    if _components_task is not None:
+        await asyncio.shield(_components_task)
+    elif agent_graph is None:
+        _import_components()
+
+def _warm_up_storage():
+    """Заранее загружает модель эмбеддингов и открывает таблицы LanceDB, чтобы их не ждал первый запрос."""
+    if (settings.router_enabled and settings.router_use_embeddings) or settings.response_cache_enabled or settings.ltm_enabled:
+        try:
+            with startup.stage("embeddings", required=False):
+                get_embeddings().embed_query("прогрев")
+        except Exception as e:
+            logger.error(f"Не удалось загрузить модель эмбеддингов: {e}")
+    if settings.ltm_enabled or settings.response_cache_enabled:
+        try:
+            with startup.stage("lancedb", required=False):
+                if settings.ltm_enabled:
+                    long_term_memory.warm_up()
+                if settings.response_cache_enabled:
+                    response_cache.warm_up()
+        except Exception as e:
+            logger.error(f"Не удалось открыть LanceDB: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _components_task
+    session_store.start(owns=cluster.owns)
+    await cluster.start(_local_submit, on_partitions_lost=_release_sessions, active_users=turn_scheduler.active_users)
+    sandbox_pool.start()
+    ha_client.start()
+    long_term_memory.start()
+    llm_pool.start()
+    _components_task = asyncio.create_task(_load_components())
+    ollama_task = asyncio.create_task(_prepare_ollama())
+    yield
+    ollama_task.cancel()
+    if prompt_registry is not None:
+        await prompt_registry.stop()
+    await llm_pool.stop()
+    await job_manager.stop()
+    await long_term_memory.stop()
+    ha_client.stop()
+    sandbox_pool.stop()
+    await cluster.stop()
+    session_store.stop()
+    state_backend.close()
+    mark_process_dead()
+
+app = FastAPI(title="Nox v3.0 'Little Tiger' API", lifespan=lifespan)
 
 logger.info("==============================================")
 logger.info("=== Запуск архитектуры 'Маленький Тигр' v3.0 ===")
 logger.info("==============================================")
 
-def ensure_model_is_available():
-    # ... (код этой функции не меняется)
+async def ensure_model_is_available(client: httpx.AsyncClient, base_url: str):
+    """Проверяет, что модель есть на узле Ollama, и при необходимости скачивает ее, сообщая прогресс в /ready."""
     model_name = settings.ollama_model
-    logger.info(f"Проверка доступности модели: {model_name}...")
-    try:
-        with httpx.Client(base_url=settings.ollama_base_url) as client:
-            response = client.get("/api/tags")
-            response.raise_for_status()
-            models = response.json().get("models", [])
-            if any(m['name'] == model_name for m in models):
-                logger.info(f"Модель {model_name} уже доступна в Ollama.")
-            else:
-                logger.warning(f"Модель {model_name} не найдена. Начинаю скачивание...")
-                pull_response = client.post("/api/pull", json={"name": model_name}, timeout=None)
-                for line in pull_response.iter_lines():
-                    if line:
-                        status = json.loads(line).get("status")
-                        logger.info(f"Ollama pull: {status}")
-                logger.info(f"Модель {model_name} успешно скачана.")
-    except httpx.ConnectError:
-        logger.error(f"Не удалось подключиться к Ollama по адресу {settings.ollama_base_url} для проверки модели.")
-    except Exception as e:
-        logger.error(f"Произошла ошибка при проверке/скачивании модели: {e}")
+    logger.info(f"Проверка доступности модели {model_name} на {base_url}...")
+    response = await client.get(f"{base_url}/api/tags")
+    response.raise_for_status()
+    models = response.json().get("models", [])
+    if any(m['name'] == model_name for m in models):
+        logger.info(f"Модель {model_name} уже доступна в Ollama ({base_url}).")
+        return
+    logger.warning(f"Модель {model_name} не найдена на {base_url}. Начинаю скачивание...")
+    async with client.stream("POST", f"{base_url}/api/pull", json={"name": model_name}) as pull_response:
+        pull_response.raise_for_status()
+        async for line in pull_response.aiter_lines():
+            if not line:
+                continue
+            data = json.loads(line)
+            if data.get("error"):
+                raise RuntimeError(data["error"])
+            status = data.get("status", "")
+            if data.get("total"):
+                status = f"{status} {100 * data.get('completed', 0) / data['total']:.0f}%"
+            startup.progress("ollama", f"{base_url}: {status}")
+    logger.info(f"Модель {model_name} успешно скачана на {base_url}.")
 
-ensure_model_is_available()
+async def warm_up_model(client: httpx.AsyncClient, base_url: str):
+    """
+    Пустой запрос к /api/generate загружает модель в память Ollama и
+    держит ее там keep_alive - первый запрос пользователя не ждет холодной загрузки.
+    """
+    started = time.perf_counter()
+    payload = {"model": settings.ollama_model, "prompt": "", "keep_alive": settings.ollama_keep_alive}
+    async with client.stream("POST", f"{base_url}/api/generate", json=payload) as response:
+        response.raise_for_status()
+        async for _ in response.aiter_bytes():
+            pass
+    logger.info(f"Модель прогрета на {base_url} за {(time.perf_counter() - started):.1f} с.")
 
-logger.info(f"Ollama URL: {settings.ollama_base_url}")
+async def _prepare_backend(client: httpx.AsyncClient, base_url: str):
+    await ensure_model_is_available(client, base_url)
+    if settings.startup_warmup:
+        await warm_up_model(client, base_url)
+
+async def _prepare_ollama():
+    """Скачивает и прогревает модель на всех узлах; пока Ollama недоступна, повторяет попытки."""
+    urls = settings.ollama_urls
+    delay = 2.0
+    with startup.stage("ollama"):
+        while True:
+            async with httpx.AsyncClient(timeout=httpx.Timeout(10.0, read=None)) as client:
+                results = await asyncio.gather(*(_prepare_backend(client, url) for url in urls), return_exceptions=True)
+            for url, result in zip(urls, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Не удалось подготовить модель на {url}: {result!r}")
+            ready = sum(1 for result in results if not isinstance(result, Exception))
+            if ready:
+                startup.progress("ollama", f"модель готова на {ready} из {len(urls)} узлов")
+                return
+            startup.progress("ollama", f"Ollama недоступна, повтор через {delay:.0f} с")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+logger.info(f"Ollama URL: {', '.join(settings.ollama_urls)}")
 logger.info(f"Home Assistant URL: {settings.ha_url}")
 
-user_conversations = {}
-logger.info("Все компоненты успешно инициализированы. Нокс готов к работе.")
+# Этапы заводятся заранее, чтобы /ready сразу показывал, чего ждем
+for module in _HEAVY_MODULES:
+    startup.declare(f"import:{module}")
+startup.declare("ollama")
+startup.record("imports", startup.started_at)
+logger.info("API готов принимать запросы, модель и тяжелые компоненты загружаются в фоне (см. /ready).")
 
 class CommandRequest(BaseModel):
     user_id: str
     text: str
+    # Именованный вариант промпта из llm_instructions.yaml (prompt_variants)
+    prompt_variant: Optional[str] = None
+
+class JobRequest(CommandRequest):
+    # Сюда POST-ом придет результат задачи (тот же JSON, что отдает GET /jobs/{id})
+    callback_url: Optional[str] = None
+    # Фоновые задачи пропускают интерактивные запросы вперед в очереди к LLM
+    background: bool = False
 
 @app.get("/", summary="Проверка статуса API")
 def read_root():
     return {"status": "Nox 'Little Tiger' is alive and hunting."}
 
+@app.get("/ready", summary="Готовность к работе и прогресс запуска")
+def read_ready():
+    return JSONResponse(startup.report(), status_code=200 if startup.ready else 503)
+
+@app.get("/startup", summary="Профиль запуска: длительность каждого этапа")
+def read_startup():
+    return startup.report()
+
+@app.get("/stats", summary="Счетчики производительности агента (только принявшего запрос воркера)")
+async def read_stats():
+    await _ensure_components()
+    return {
+        # При NOX_WORKERS > 1 каждый воркер отвечает своими счетчиками; общие - в /metrics
+        "worker_id": cluster.worker_id,
+        "early_stop": early_stop_stats.snapshot(),
+        "prompts": prompt_registry.stats(),
+        "tool_cache": tool_cache.stats(),
+        "nodes": node_timings.snapshot(),
+        "llm": llm_pool.stats(),
+        "scheduler": turn_scheduler.stats(),
+        "jobs": job_manager.stats(),
+        "cluster": cluster.stats(),
+        "sessions": session_store.stats(),
+        "summarizer": history_summarizer.stats(),
+        "sandbox": sandbox_pool.stats(),
+        "home_assistant": ha_client.stats(),
+        "router": fast_router.stats(),
+        "response_cache": response_cache.stats(),
+        "long_term_memory": long_term_memory.stats(),
+    }
+
+@app.get("/metrics", summary="Метрики в формате Prometheus")
+def read_metrics():
+    return Response(render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+@app.get("/traces/slow", summary="Полные трассы последних медленных ходов")
+def read_slow_traces():
+    return {"threshold_s": slow_trace_sampler.threshold, "sampled": slow_trace_sampler.sampled, "traces": slow_trace_sampler.recent()}
+
+@app.delete("/cache/responses", summary="Сбрасывает семантический кэш ответов")
+async def invalidate_response_cache(entity_id: Optional[str] = None):
+    """Без параметров сбрасывает весь кэш, с entity_id - только ответы, зависящие от этой сущности."""
+    await _ensure_components()
+    try:
+        await asyncio.to_thread(response_cache.invalidate, [entity_id] if entity_id else None)
+    except Exception as e:
+        logger.error(f"Ошибка сброса кэша ответов: {e}")
+        raise HTTPException(status_code=500, detail=f"Не удалось сбросить кэш ответов: {e}")
+    return {"status": "success"}
+
 # НОВЫЙ ЭНДПОИНТ ДЛЯ ПЕРЕЗАГРУЗКИ
 @app.post("/reload_instructions", summary="Перезагружает LLM инструкции из файла")
-def reload_instructions():
+async def reload_instructions():
     """
-    Заставляет агента перечитать файл llm_instructions.yaml на лету.
+    Заставляет агента перечитать файл llm_instructions.yaml сразу, не дожидаясь
+    проверки по mtime (PROMPT_WATCH_INTERVAL).
     """
+    await _ensure_components()
     logger.info("Получен запрос на перезагрузку инструкций...")
-    success = prompt_components.load()
+    success = await asyncio.to_thread(prompt_registry.load)
     if success:
         logger.info("Инструкции успешно перезагружены.")
-        return {"status": "success", "message": "Instructions reloaded successfully."}
+        return {"status": "success", "message": "Instructions reloaded successfully.", "prompts": prompt_registry.stats()}
     else:
         logger.error("Не удалось перезагрузить инструкции.")
         raise HTTPException(status_code=500, detail="Failed to reload instructions. Check logs for details.")
 
-@app.post("/command/telegram", summary="Обработка команды")
-async def handle_command(request: CommandRequest):
-    user_id = request.user_id
-    if user_id not in user_conversations:
-        user_conversations[user_id] = get_short_term_memory()
-    memory = user_conversations[user_id]
-    chat_history = format_history_for_gemma3n(memory.chat_memory.messages)
+_background_tasks = set()
+
+def _spawn_background(coro):
+    """Запускает корутину вне пути запроса, удерживая ссылку до ее завершения."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def _run_graph(user_id: str, text: str, memory, on_token: Optional[Callable[[str], None]],
+                     prompt_variant: Optional[str], prompt_hash: Optional[str]) -> str:
+    chat_history = history_render_cache.render(user_id, memory.chat_memory.messages)
+    if memory.summary:
+        # Сводка меняется только при сжатии, так что префикс промпта по-прежнему стабилен между ходами
+        chat_history = "\n".join(part for part in (format_summary_for_gemma3n(memory.summary), chat_history) if part)
+    if settings.ltm_enabled:
+        # Воспоминания идут после истории, чтобы не ломать кэшируемый префикс промпта
+        memories = await long_term_memory.recall(user_id, text, timeout=settings.ltm_recall_timeout)
+        if memories:
+            chat_history = "\n".join(part for part in (chat_history, format_memories_for_gemma3n(memories)) if part)
     
-    inputs = {"messages": [HumanMessage(content=request.text)], "chat_history": chat_history}
+    inputs = {"messages": [HumanMessage(content=text)], "chat_history": chat_history, "rendered_turn": "", "rendered_count": 0}
+    config = {"recursion_limit": 15, "configurable": {"on_token": on_token, "session_id": user_id, "prompt_variant": prompt_variant}}
     
+    started = time.perf_counter()
+    node_started = started
     final_output = None
-    async for output in agent_graph.astream(inputs, {"recursion_limit": 15}):
+    turn_messages = []
+    steps = 0
+    async for output in agent_graph.astream(inputs, config):
+        node_finished = time.perf_counter()
         for key, value in output.items():
             logger.info(f"--- Узел графа: {key} ---")
+            node_timings.record(key, (node_finished - node_started) * 1000)
+            record_span("graph_step", node_started, node=key)
+            if key == "agent":
+                steps += 1
             if value.get("messages"):
                 final_output = value["messages"][-1]
+                turn_messages.extend(value["messages"])
+        node_started = time.perf_counter()
+    REACT_STEPS.observe(steps)
+    fast_router.record_agent_latency((time.perf_counter() - started) * 1000)
+    if settings.router_enabled:
+        _spawn_background(fast_router.learn(text, turn_messages))
 
-    final_answer = final_output.content if final_output else "Прости, я запутался."
-    
-    memory.save_context({"input": request.text}, {"output": final_answer})
+    if not final_output:
+        return "Прости, я запутался."
+    if settings.ltm_enabled:
+        long_term_memory.remember(user_id, f"Пользователь: {text}\nНокс: {final_output.content}")
+    if settings.response_cache_enabled and isinstance(final_output, ToolMessage) and final_output.name == "respond_to_user":
+        _spawn_background(response_cache.store(user_id, text, final_output.content, turn_messages, prompt_hash))
+    return final_output.content
+
+async def run_agent(user_id: str, text: str, on_token: Optional[Callable[[str], None]] = None, priority: int = PRIORITY_INTERACTIVE,
+                    prompt_variant: Optional[str] = None) -> str:
+    """
+    Прогоняет один ход диалога через граф агента и сохраняет его в память.
+    on_token получает текст ответа пользователю по мере генерации.
+    prompt_variant выбирает именованный вариант промпта (по умолчанию - PROMPT_DEFAULT_VARIANT).
+    Частые команды умного дома отрабатывает быстрый путь без вызова LLM.
+    Вызывается только через turn_scheduler, который выстраивает ходы пользователя в очередь.
+    """
+    await _ensure_components()
+    with trace_request(user_id, text) as request_span:
+        memory = session_store.get(user_id)
+        prompt = prompt_registry.get(prompt_variant)
+        prompt_hash = prompt.hash if prompt else None
+
+        route = "fast_path"
+        final_answer = await fast_router.try_handle(text) if settings.router_enabled else None
+        if final_answer is None and settings.response_cache_enabled:
+            route = "response_cache"
+            final_answer = await response_cache.lookup(user_id, text, prompt_hash)
+        if final_answer is not None:
+            if on_token:
+                on_token(final_answer)
+        else:
+            route = "agent"
+            async with turn_scheduler.llm_slot(priority):
+                final_answer = await _run_graph(user_id, text, memory, on_token, prompt_variant, prompt_hash)
+        REQUESTS.labels(route=route).inc()
+        request_span.set(route=route)
+        
+        memory.save_context({"input": text}, {"output": final_answer})
+        session_store.save(user_id, memory)
     logger.info(f"Финальный ответ агента для user_id={user_id}: '{final_answer}'")
+    return final_answer
+
+async def _check_prompt_variant(request: CommandRequest):
+    if request.prompt_variant is None:
+        return
+    await _ensure_components()
+    if request.prompt_variant not in prompt_registry:
+        raise HTTPException(status_code=400, detail=f"Неизвестный вариант промпта '{request.prompt_variant}'.")
+
+def _local_submit(user_id: str, text: str, on_token: Optional[Callable[[str], None]] = None,
+                  priority: int = PRIORITY_INTERACTIVE, prompt_variant: Optional[str] = None,
+                  on_start: Optional[Callable[[], None]] = None):
+    """Ставит ход в очередь планировщика этого воркера (свой user_id или присланный другим воркером)."""
+    return turn_scheduler.submit(user_id, text, run_agent, on_token=on_token, priority=priority,
+                                 prompt_variant=prompt_variant, on_start=on_start)
+
+def _release_sessions(partitions):
+    released = session_store.release(lambda user_id: cluster.partition_of(user_id) in partitions)
+    # Аренду партиций кластер снимет после возврата: новый владелец должен прочитать уже записанное
+    session_store.flush()
+    logger.info(f"Партиции переехали на другие воркеры, выгружено сессий: {released}.")
+
+def _busy(user_id: str, e: SchedulerBusyError) -> HTTPException:
+    logger.warning(f"Запрос от user_id={user_id} отклонен: {e}")
+    return HTTPException(status_code=429, detail="Нокс сейчас занят, попробуй чуть позже.",
+                         headers={"Retry-After": str(int(e.retry_after + 0.5))})
+
+async def _await_turn(user_id: str, answer) -> str:
+    try:
+        return await answer
+    except SchedulerBusyError as e:
+        # Очередь воркера-владельца переполнена - узнаем об этом только из его ответа
+        raise _busy(user_id, e)
+
+def _submit(user_id: str, text: str, on_token: Optional[Callable[[str], None]] = None,
+            priority: int = PRIORITY_INTERACTIVE, prompt_variant: Optional[str] = None,
+            on_start: Optional[Callable[[], None]] = None):
+    """Ставит ход в очередь воркера, обслуживающего user_id; при переполнении сразу отвечает 429."""
+    try:
+        answer = cluster.submit(user_id, text, on_token=on_token, priority=priority,
+                                prompt_variant=prompt_variant, on_start=on_start)
+    except SchedulerBusyError as e:
+        raise _busy(user_id, e)
+    return _await_turn(user_id, answer)
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/command/telegram", summary="Обработка команды")
+async def handle_command(request: CommandRequest):
+    await _check_prompt_variant(request)
+    final_answer = await _submit(request.user_id, request.text, prompt_variant=request.prompt_variant)
     return {"response": final_answer}
 
+@app.post("/command/telegram/stream", summary="Обработка команды с потоковым ответом (SSE)")
+async def handle_command_stream(request: CommandRequest):
+    """
+    То же, что /command/telegram, но текст ответа отдается событиями 'token'
+    по мере генерации. В конце приходит событие 'done' с полным ответом.
+    """
+    await _check_prompt_variant(request)
+    queue: asyncio.Queue = asyncio.Queue()
+    answer = _submit(request.user_id, request.text, on_token=queue.put_nowait, prompt_variant=request.prompt_variant)
+
+    async def event_source():
+        task = asyncio.ensure_future(answer)
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+        try:
+            while (delta := await queue.get()) is not None:
+                yield _sse("token", {"delta": delta})
+            try:
+                final_answer = await task
+            except Exception as e:
+                logger.error(f"Ошибка при потоковой обработке команды: {e}")
+                yield _sse("error", {"detail": str(e)})
+                return
+            yield _sse("done", {"response": final_answer})
+        finally:
+            # Клиент отключился раньше времени - не держим генерацию впустую
+            if not task.done():
+                task.cancel()
+
+    return StreamingResponse(event_source(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.post("/jobs", status_code=202, summary="Принимает команду в работу и сразу возвращает job_id")
+async def create_job(request: JobRequest):
+    """
+    Результат можно получить через GET /jobs/{job_id}, поток событий
+    GET /jobs/{job_id}/events (SSE: token/done/error) или callback_url.
+    """
+    await _check_prompt_variant(request)
+    job = job_manager.create(request.user_id, request.text, request.callback_url)
+    priority = PRIORITY_BACKGROUND if request.background else PRIORITY_INTERACTIVE
+    try:
+        answer = _submit(request.user_id, request.text, on_token=job.push_token, priority=priority,
+                         prompt_variant=request.prompt_variant, on_start=job.mark_running)
+    except HTTPException:
+        job_manager.discard(job.id)
+        raise
+    # Запись должна быть в общем хранилище до 202: следующий GET может прийти на другой воркер
+    await job_manager.share(job)
+    _spawn_background(job_manager.complete(job, answer))
+    return {"job_id": job.id, "status": job.status}
+
+@app.get("/jobs/{job_id}", summary="Статус и результат задачи")
+async def read_job(job_id: str):
+    data = await job_manager.fetch(job_id)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена.")
+    return data
+
+@app.get("/jobs/{job_id}/events", summary="Поток событий задачи (SSE)")
+async def stream_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is not None:
+        events = job.events()
+    elif await job_manager.fetch(job_id) is not None:
+        # Задачу принял другой воркер - токенов не будет, только итог
+        events = job_manager.remote_events(job_id)
+    else:
+        raise HTTPException(status_code=404, detail="Задача не найдена.")
+
+    async def event_source():
+        async for event, data in events:
+            yield _sse(event, data)
+
+    return StreamingResponse(event_source(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    if settings.nox_workers > 1:
+        # Несколько процессов uvicorn умеет запускать только по строке импорта
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=settings.nox_workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
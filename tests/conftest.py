@@ -0,0 +1,9 @@
+import os
+import sys
+
+# core.config требует эти переменные; тесты не ходят ни в Ollama, ни в Home Assistant
+os.environ.setdefault("OLLAMA_BASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("HA_URL", "http://127.0.0.1:9")
+os.environ.setdefault("HA_TOK", "test-token")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
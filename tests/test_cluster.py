@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from core.cluster import Cluster
+from core.state_backend import SQLiteBackend
+
+
+@pytest.fixture
+def backend(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "state.db"), poll_interval=0.01)
+    yield backend
+    backend.close()
+
+
+def _cluster(backend) -> Cluster:
+    return Cluster(backend, partitions=8, heartbeat_interval=0.05, member_ttl=1.0, request_timeout=5.0, enabled=True)
+
+
+async def _echo(user_id, text, on_token=None, priority=0, prompt_variant=None, on_start=None):
+    if on_start:
+        on_start()
+    if on_token:
+        on_token(text)
+    return f"{user_id}:{text}"
+
+
+def test_without_cluster_all_partitions_are_local(backend):
+    cluster = Cluster(backend, partitions=8, heartbeat_interval=1, member_ttl=1, request_timeout=1, enabled=False)
+    assert all(cluster.owns(f"u{i}") for i in range(20))
+
+
+def test_turns_are_forwarded_to_the_partition_owner(backend):
+    async def main():
+        first, second = _cluster(backend), _cluster(backend)
+        await first.start(_echo)
+        assert len(first._owned) == 8
+        await second.start(_echo)
+        # Новый воркер стартует без партиций и получает их только от прежнего владельца
+        assert second._owned == set()
+        await asyncio.sleep(0.5)
+        assert first._owned and second._owned
+        assert first._owned.isdisjoint(second._owned) and len(first._owned | second._owned) == 8
+
+        user_id = next(f"u{i}" for i in range(100) if second.owns(f"u{i}"))
+        tokens, started = [], []
+        answer = await first.submit(user_id, "привет", on_token=tokens.append, on_start=lambda: started.append(True))
+        assert answer == f"{user_id}:привет"
+        assert tokens == ["привет"] and started == [True]
+        assert first.forwarded == 1 and second.served_remote == 1
+        await second.stop()
+        await first.stop()
+
+    asyncio.run(main())
+
+
+def test_partition_is_handed_over_only_after_running_turns(backend):
+    async def main():
+        busy_users = set()
+        released = []
+        first, second = _cluster(backend), _cluster(backend)
+        await first.start(_echo, on_partitions_lost=released.append, active_users=lambda: list(busy_users))
+        # Ход пользователя, чья партиция переедет ко второму воркеру, еще идет
+        probe = _cluster(backend)
+        probe.members = sorted([first.worker_id, second.worker_id])
+        moving = [p for p in range(8) if probe.owner_of(p) == second.worker_id]
+        busy_user = next(f"u{i}" for i in range(200) if first.partition_of(f"u{i}") == moving[0])
+        busy_users.add(busy_user)
+
+        await second.start(_echo)
+        await asyncio.sleep(0.5)
+        assert moving[0] in first._draining and moving[0] not in second._owned
+        assert not first.owns(busy_user)
+
+        busy_users.clear()
+        await asyncio.sleep(0.5)
+        assert first._draining == set()
+        assert set(moving) == second._owned
+        # Сессии отданных партиций записаны до снятия аренды
+        assert set().union(*released) == set(moving)
+        await second.stop()
+        await first.stop()
+
+    asyncio.run(main())
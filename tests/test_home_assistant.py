@@ -0,0 +1,95 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+
+from core.home_assistant import HomeAssistantClient, HomeAssistantError
+from fakes.fake_ha import FakeHomeAssistant
+
+
+@pytest.fixture
+def fake_ha():
+    fake = FakeHomeAssistant(token="test-token")
+    fake.start()
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def client(fake_ha):
+    client = HomeAssistantClient(fake_ha.url, "test-token", call_timeout=5.0)
+    client.start()
+    assert client.wait_ready(10)
+    yield client
+    client.stop()
+
+
+def test_rest_fallback_before_the_websocket(fake_ha):
+    client = HomeAssistantClient(fake_ha.url, "test-token", call_timeout=5.0)
+    try:
+        assert not client.connected
+        assert client.get_state("light.kitchen")["state"] == "off"
+        assert client.get_state("light.missing") is None
+        assert [s["entity_id"] for s in client.list_states("switch")] == ["switch.kettle"]
+        client.call_service("light", "turn_on", "light.kitchen")
+        assert fake_ha.states["light.kitchen"]["state"] == "on"
+    finally:
+        client.stop()
+
+
+def test_states_come_from_the_websocket_cache(client, fake_ha):
+    assert client.connected
+    assert client.stats()["entities"] == len(fake_ha.states)
+    assert client.get_state("sensor.temperature")["state"] == "22.5"
+    assert client.get_state("light.missing") is None
+    assert [s["entity_id"] for s in client.list_states("light")] == ["light.bedroom", "light.kitchen", "light.living_room"]
+
+
+def test_call_service_updates_the_cache_via_state_changed(client, fake_ha):
+    changes = []
+    client.add_listener(lambda entity_id, old, new: changes.append((entity_id, old["state"], new["state"])))
+    before = {"switch.kettle": client.get_state("switch.kettle")}
+    client.call_service("switch", "turn_on", "switch.kettle", {"reason": "test"})
+    after = client.wait_for_update(["switch.kettle"], before, timeout=5)
+    assert after["switch.kettle"]["state"] == "on"
+    assert changes == [("switch.kettle", "off", "on")]
+    assert fake_ha.service_calls == [{"domain": "switch", "service": "turn_on", "entity_id": ["switch.kettle"], "data": {"reason": "test"}}]
+    stats = client.stats()
+    assert stats["service_calls"] == 1 and stats["events"] == 1
+
+
+def test_wait_for_update_times_out_without_changes(client):
+    before = {"light.bedroom": client.get_state("light.bedroom")}
+    assert client.wait_for_update(["light.bedroom"], before, timeout=0.05) == before
+
+
+def test_concurrent_calls_share_one_connection(client, fake_ha):
+    entities = ["light.kitchen", "light.bedroom", "switch.kettle"] * 5
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda entity_id: client.call_service(entity_id.split(".")[0], "toggle", entity_id), entities))
+    assert len(fake_ha.service_calls) == len(entities)
+    assert client.stats()["reconnects"] == 0
+    # Каждая сущность переключена нечетное число раз
+    for entity_id in ("light.kitchen", "light.bedroom", "switch.kettle"):
+        assert fake_ha.states[entity_id]["state"] == "on"
+
+
+def test_errors_from_ha_are_raised(client):
+    future = asyncio.run_coroutine_threadsafe(client._request({"type": "no_such_command"}), client._loop)
+    with pytest.raises(HomeAssistantError, match="Unknown command"):
+        future.result(timeout=5)
+    # Соединение после ошибки живо
+    assert client.connected
+    client.call_service("light", "turn_on", "light.bedroom")
+
+
+def test_wrong_token_never_connects(fake_ha):
+    client = HomeAssistantClient(fake_ha.url, "wrong-token", call_timeout=5.0)
+    client.start()
+    try:
+        assert not client.wait_ready(0.5)
+        with pytest.raises(httpx.HTTPStatusError):
+            client.get_state("light.kitchen")
+    finally:
+        client.stop()
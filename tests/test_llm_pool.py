@@ -0,0 +1,114 @@
+import asyncio
+
+import httpx
+import pytest
+from langchain_core.messages import HumanMessage
+
+from core.config import settings
+from core.llm_client import LLMPool, NoHealthyBackendError
+from fakes.fake_ollama import FakeOllama
+
+MESSAGES = [HumanMessage(content="привет")]
+
+
+@pytest.fixture
+def nodes():
+    fakes = [FakeOllama(model=settings.ollama_model, script=lambda prompt: "Thought: ответ узла\nObservation: лишнее")
+             for _ in range(2)]
+    for fake in fakes:
+        fake.start()
+    yield fakes
+    for fake in fakes:
+        fake.stop()
+
+
+async def _ask(pool: LLMPool, affinity=None) -> str:
+    return "".join([chunk.content async for chunk in pool.astream(MESSAGES, affinity=affinity)])
+
+
+async def _probe(pool: LLMPool):
+    async with httpx.AsyncClient() as client:
+        await asyncio.gather(*(pool.probe(client, b) for b in pool.backends))
+    pool._check_models()
+
+
+def test_streams_and_cuts_at_stop_sequences(nodes):
+    pool = LLMPool([nodes[0].url], max_concurrency=2, health_interval=60)
+    assert asyncio.run(_ask(pool)) == "Thought: ответ узла\n"
+    assert pool.backends[0].requests == 1
+    assert pool.backends[0].outstanding == 0
+    assert pool.backends[0].first_token_ms is not None
+
+
+def test_fails_over_to_a_healthy_node(nodes):
+    nodes[0].healthy = False
+    pool = LLMPool([n.url for n in nodes], max_concurrency=2, health_interval=60)
+    # Сессия "закреплена" за упавшим узлом, но запрос все равно проходит
+    affinity = next(a for a in map(str, range(100)) if pool._pick(a, set()) is pool.backends[0])
+    assert asyncio.run(_ask(pool, affinity)) == "Thought: ответ узла\n"
+    assert pool.failovers == 1
+    assert not pool.backends[0].healthy
+    assert nodes[1].requests == 1
+
+
+def test_no_healthy_nodes(nodes):
+    for node in nodes:
+        node.healthy = False
+    pool = LLMPool([n.url for n in nodes], max_concurrency=2, health_interval=60)
+    with pytest.raises(NoHealthyBackendError):
+        asyncio.run(_ask(pool))
+
+
+def test_per_node_concurrency_cap(nodes):
+    for node in nodes:
+        node.token_rate = 200
+    pool = LLMPool([n.url for n in nodes], max_concurrency=1, health_interval=60)
+
+    async def main():
+        await asyncio.gather(*(_ask(pool) for _ in range(6)))
+
+    asyncio.run(main())
+    assert [n.max_active for n in nodes] == [1, 1]
+    assert nodes[0].requests + nodes[1].requests == 6
+
+
+def test_affinity_keeps_a_session_on_its_node(nodes):
+    pool = LLMPool([n.url for n in nodes], max_concurrency=2, health_interval=60)
+
+    async def main():
+        for _ in range(3):
+            await _ask(pool, affinity="u1")
+
+    asyncio.run(main())
+    assert sorted(n.requests for n in nodes) == [0, 3]
+
+
+def test_probe_returns_a_recovered_node(nodes):
+    pool = LLMPool([n.url for n in nodes], max_concurrency=2, health_interval=60)
+    nodes[0].healthy = False
+    asyncio.run(_probe(pool))
+    assert not pool.backends[0].healthy and pool.backends[0].model_missing is None
+    nodes[0].healthy = True
+    asyncio.run(_probe(pool))
+    assert pool.backends[0].healthy and pool.backends[0].model_missing is False
+
+
+def test_node_without_the_model_is_dropped_only_if_another_serves_it(nodes):
+    nodes[0].models = [settings.ollama_model.split(":")[0] + ":other"]
+    pool = LLMPool([n.url for n in nodes], max_concurrency=2, health_interval=60)
+    asyncio.run(_probe(pool))
+    assert pool.backends[0].model_missing is True and not pool.backends[0].healthy
+    assert pool.backends[1].healthy
+
+    # Второй узел упал - узел без модели лучше, чем ни одного
+    nodes[1].healthy = False
+    asyncio.run(_probe(pool))
+    assert pool.backends[0].healthy and not pool.backends[1].healthy
+
+
+def test_model_name_without_tag_matches_latest(nodes, monkeypatch):
+    monkeypatch.setattr(settings, "ollama_model", "gemma3n")
+    nodes[0].models = ["gemma3n:latest"]
+    pool = LLMPool([nodes[0].url], max_concurrency=2, health_interval=60)
+    asyncio.run(_probe(pool))
+    assert pool.backends[0].model_missing is False and pool.backends[0].healthy
@@ -0,0 +1,55 @@
+from langchain_core.messages import AIMessage, HumanMessage
+
+from core.memory import TokenBudgetMemory, estimate_history_tokens, estimate_tokens
+
+
+def _memory(turns: int, k: int = 5, max_tokens: int = 1500, words: int = 1) -> TokenBudgetMemory:
+    memory = TokenBudgetMemory(k=k, max_tokens=max_tokens)
+    for i in range(turns):
+        memory.save_context({"input": f"вопрос{i} " + "слово " * words}, {"output": f"ответ{i} " + "слово " * words})
+    return memory
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcd") == 1
+    assert estimate_tokens("abcde") == 2
+    assert estimate_tokens("кот") == 1
+    assert estimate_tokens("привет, мир!") == 2 + 1 + 1 + 1
+
+
+def test_estimate_history_tokens_sums_message_segments():
+    history = "<start_of_turn>user\nпривет<end_of_turn>\n<start_of_turn>model\nhello<end_of_turn>"
+    segments = history.split("\n<start_of_turn>model")
+    assert estimate_history_tokens(history) == estimate_tokens(segments[0]) + estimate_tokens("<start_of_turn>model" + segments[1])
+    assert estimate_history_tokens("") == 0
+
+
+def test_trim_keeps_the_window():
+    memory = _memory(7, k=3)
+    evicted = memory.trim()
+    assert len(evicted) == 8
+    assert evicted[0].content.startswith("вопрос0")
+    assert [type(m) for m in memory.chat_memory.messages] == [HumanMessage, AIMessage] * 3
+    assert memory.chat_memory.messages[0].content.startswith("вопрос4")
+    assert memory.trim() == []
+
+
+def test_trim_enforces_the_token_budget_with_the_summary():
+    memory = _memory(4, k=10, max_tokens=100, words=10)
+    evicted = memory.trim()
+    kept = memory.chat_memory.messages
+    assert evicted and len(evicted) + len(kept) == 8
+    assert len(kept) > 2
+    assert sum(estimate_tokens(m.content) for m in kept) <= 100
+    # Сводка занимает тот же бюджет, что и история
+    memory.summary = "сводка " * 40
+    assert memory.trim()
+    assert len(memory.chat_memory.messages) == 2
+
+
+def test_trim_always_keeps_the_last_exchange():
+    memory = _memory(2, max_tokens=1, words=50)
+    evicted = memory.trim()
+    assert len(evicted) == 2
+    assert memory.chat_memory.messages[0].content.startswith("вопрос1")
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import zlib
+from typing import List, Optional
+
+import numpy as np
+import pytest
+from langchain_core.messages import AIMessage, ToolMessage
+
+from core import router as router_module
+from core.router import FastPathRouter, normalize_command
+
+STATES = [
+    {"entity_id": "light.kitchen", "state": "off", "attributes": {"friendly_name": "Свет на кухне"}},
+    {"entity_id": "light.bedroom", "state": "on", "attributes": {"friendly_name": "Свет в спальне"}},
+    {"entity_id": "light.hall_1", "state": "off", "attributes": {"friendly_name": "Коридор 1"}},
+    {"entity_id": "light.hall_2", "state": "off", "attributes": {"friendly_name": "Коридор 2"}},
+    {"entity_id": "switch.garland", "state": "off", "attributes": {"friendly_name": "Гирлянда"}},
+    {"entity_id": "sensor.indoor_temp", "state": "22.5",
+     "attributes": {"friendly_name": "Температура в гостиной", "device_class": "temperature", "unit_of_measurement": "°C"}},
+    {"entity_id": "sensor.outside_temp", "state": "-3",
+     "attributes": {"friendly_name": "Температура на улице", "device_class": "temperature", "unit_of_measurement": "°C"}},
+]
+
+
+class _StubHA:
+    """Состояния из памяти, как у HomeAssistantClient с поднятым websocket."""
+
+    def __init__(self, states: List[dict]):
+        self.connected = True
+        self.states = {s["entity_id"]: s for s in states}
+
+    def list_states(self, domain: Optional[str] = None) -> List[dict]:
+        return [s for eid, s in sorted(self.states.items()) if not domain or eid.startswith(f"{domain}.")]
+
+    def get_state(self, entity_id: str) -> Optional[dict]:
+        return self.states.get(entity_id)
+
+
+class _HashEmbeddings:
+    """Мешок слов: близкие по словам команды дают близкие векторы."""
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = np.zeros(64, dtype=np.float32)
+        for word in text.split():
+            vector[zlib.crc32(word[:4].encode("utf-8")) % 64] += 1.0
+        return vector.tolist()
+
+
+@pytest.fixture
+def ha(monkeypatch) -> _StubHA:
+    stub = _StubHA(STATES)
+    monkeypatch.setattr(router_module, "ha_client", stub)
+    monkeypatch.setattr(router_module, "get_embeddings", lambda: _HashEmbeddings())
+    return stub
+
+
+@pytest.fixture
+def calls(monkeypatch) -> list:
+    calls = []
+
+    class _Tool:
+        @staticmethod
+        def invoke(tool_input: dict) -> str:
+            calls.append(tool_input)
+            return "Успешно"
+
+    monkeypatch.setattr(router_module, "home_assistant", _Tool)
+    return calls
+
+
+def _router(use_embeddings: bool = False, nn_threshold: float = 0.9) -> FastPathRouter:
+    return FastPathRouter(min_confidence=0.8, nn_threshold=nn_threshold, max_exemplars=10, use_embeddings=use_embeddings)
+
+
+def test_normalize_command():
+    assert normalize_command("Нокс, включи свет на кухне, пожалуйста!") == "включи свет на кухне"
+    assert normalize_command("  Горит ли   свет в спальне? ") == "горит ли свет в спальне"
+
+
+def test_turn_on_rule(ha):
+    match = _router()._match("Нокс, включи свет на кухне!")
+    assert match.source == "rule"
+    assert match.tool_input == {"operation": "call_service", "entity_id": "light.kitchen", "service": "turn_on"}
+    assert match.confidence == 1.0
+
+
+def test_turn_off_and_state_rules(ha):
+    router = _router()
+    assert router._match("погаси гирлянду").tool_input == {
+        "operation": "call_service", "entity_id": "switch.garland", "service": "turn_off"}
+    assert router._match("горит ли свет в спальне").tool_input == {"operation": "get_state", "entity_id": "light.bedroom"}
+
+
+def test_temperature_rule_tells_inside_from_outside(ha):
+    router = _router()
+    assert router._match("какая температура на улице").tool_input["entity_id"] == "sensor.outside_temp"
+    assert router._match("какая сейчас температура в гостиной").tool_input["entity_id"] == "sensor.indoor_temp"
+
+
+def test_ambiguous_entity_has_low_confidence(ha):
+    match = _router()._match("включи коридор")
+    assert match is not None and match.confidence < 0.8
+
+
+def test_unknown_commands_and_offline_ha_fall_back(ha):
+    router = _router()
+    assert router._match("расскажи анекдот") is None
+    assert router._match("включи телевизор") is None
+    ha.connected = False
+    assert router._match("включи свет на кухне") is None
+
+
+def test_try_handle_executes_the_rule_and_renders_the_state(ha, calls):
+    router = _router()
+    answer = asyncio.run(router.try_handle("горит ли свет в спальне?"))
+    assert answer == "Свет в спальне: включено."
+    assert calls == [{"operation": "get_state", "entity_id": "light.bedroom"}]
+    assert router.stats()["hits"]["rule"] == 1
+
+
+def test_try_handle_falls_back_to_the_agent(ha, calls):
+    router = _router()
+    assert asyncio.run(router.try_handle("включи коридор")) is None
+    assert asyncio.run(router.try_handle("как дела?")) is None
+    assert calls == []
+    stats = router.stats()
+    assert stats["misses"] == 2 and stats["low_confidence"] == 1
+
+
+def _agent_turn(tool_input: dict, result: str = "Успешно") -> list:
+    action = {"action": "home_assistant", "action_input": tool_input}
+    return [
+        AIMessage(content=f"Thought: x\nAction: {json.dumps(action, ensure_ascii=False)}"),
+        ToolMessage(content=result, name="home_assistant", tool_call_id="1"),
+    ]
+
+
+def test_nearest_replays_learned_commands(ha):
+    router = _router(use_embeddings=True)
+    tool_input = {"operation": "call_service", "entity_id": "switch.garland", "service": "turn_on"}
+    asyncio.run(router.learn("зажги елочную гирлянду", _agent_turn(tool_input)))
+    assert router.learned == 1
+    match = router._nearest("зажги елочную гирлянду пожалуйста")
+    assert match.source == "nearest" and match.tool_input == tool_input
+    # Противоположное действие не повторяется, как бы ни были похожи векторы
+    assert router._nearest("погаси елочную гирлянду") is None
+
+
+def test_nearest_does_not_replay_call_service_for_another_entity(ha):
+    # Порог низкий, чтобы "кухня" и "спальня" проходили по сходству и решал _same_target
+    router = _router(use_embeddings=True, nn_threshold=0.5)
+    tool_input = {"operation": "call_service", "entity_id": "light.kitchen", "service": "turn_on"}
+    asyncio.run(router.learn("включи лампу кухня", _agent_turn(tool_input)))
+    assert router._nearest("включи лампу кухня") is not None
+    assert router._nearest("включи лампу спальня") is None
+    get_state = {"operation": "get_state", "entity_id": "light.kitchen"}
+    asyncio.run(router.learn("статус лампа кухня", _agent_turn(get_state)))
+    assert router._nearest("статус лампа спальня").tool_input == get_state
+
+
+def test_learn_skips_failed_or_multi_step_turns(ha):
+    router = _router(use_embeddings=True)
+    tool_input = {"operation": "get_state", "entity_id": "light.kitchen"}
+    asyncio.run(router.learn("свет на кухне", _agent_turn(tool_input, "Ошибка: нет связи")))
+    asyncio.run(router.learn("свет на кухне", _agent_turn(tool_input) + _agent_turn(tool_input)))
+    assert router.learned == 0
@@ -0,0 +1,164 @@
+import asyncio
+
+import pytest
+
+from core.scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, SchedulerBusyError, TurnScheduler
+
+
+class _Agent:
+    """Обработчик хода: записывает порядок вызовов и ждет, пока тест его отпустит."""
+
+    def __init__(self):
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def __call__(self, user_id, text, on_token=None, priority=PRIORITY_INTERACTIVE, prompt_variant=None):
+        self.calls.append((user_id, text, priority, prompt_variant))
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            if on_token:
+                on_token(f"<{text}>")
+            await self.gate.wait()
+            await asyncio.sleep(0.01)
+            return f"{user_id}:{text}"
+        finally:
+            self.running -= 1
+
+
+def test_turns_of_one_user_run_in_order():
+    async def main():
+        scheduler = TurnScheduler(max_concurrency=4, max_queue=10, merge_window=0)
+        agent = _Agent()
+        answers = await asyncio.gather(*(scheduler.submit("u1", str(i), agent) for i in range(5)))
+        assert answers == [f"u1:{i}" for i in range(5)]
+        assert [text for _, text, _, _ in agent.calls] == [str(i) for i in range(5)]
+        assert agent.max_running == 1
+        assert scheduler.active_users() == []
+
+    asyncio.run(main())
+
+
+def test_different_users_run_in_parallel():
+    async def main():
+        scheduler = TurnScheduler(max_concurrency=4, max_queue=10, merge_window=0)
+        agent = _Agent()
+        agent.gate.clear()
+        answers = [scheduler.submit(f"u{i}", "x", agent) for i in range(3)]
+        tasks = [asyncio.ensure_future(a) for a in answers]
+        await asyncio.sleep(0.02)
+        assert agent.running == 3
+        assert sorted(scheduler.active_users()) == ["u0", "u1", "u2"]
+        agent.gate.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+
+
+def test_llm_slots_are_capped_and_given_by_priority():
+    async def main():
+        scheduler = TurnScheduler(max_concurrency=1, max_queue=10, merge_window=0)
+        order = []
+        release = asyncio.Event()
+
+        async def hold():
+            async with scheduler.llm_slot():
+                await release.wait()
+
+        async def wait_slot(name, priority):
+            async with scheduler.llm_slot(priority):
+                order.append(name)
+
+        holder = asyncio.ensure_future(hold())
+        await asyncio.sleep(0)
+        waiters = [
+            asyncio.ensure_future(wait_slot("background", PRIORITY_BACKGROUND)),
+            asyncio.ensure_future(wait_slot("interactive", PRIORITY_INTERACTIVE)),
+        ]
+        await asyncio.sleep(0.01)
+        assert order == [] and scheduler.stats()["llm_waiting"] == 2
+        release.set()
+        await asyncio.gather(holder, *waiters)
+        assert order == ["interactive", "background"]
+        assert scheduler.stats()["llm_active"] == 0
+
+    asyncio.run(main())
+
+
+def test_overflow_is_rejected_immediately():
+    async def main():
+        scheduler = TurnScheduler(max_concurrency=1, max_queue=1, merge_window=0)
+        agent = _Agent()
+        agent.gate.clear()
+        accepted = [asyncio.ensure_future(scheduler.submit(f"u{i}", "x", agent)) for i in range(2)]
+        with pytest.raises(SchedulerBusyError) as busy:
+            scheduler.submit("u9", "x", agent)
+        assert busy.value.retry_after >= 1.0
+        assert scheduler.stats()["rejected"] == 1
+        agent.gate.set()
+        await asyncio.gather(*accepted)
+        # Очередь освободилась - снова принимаем
+        assert await scheduler.submit("u9", "x", agent) == "u9:x"
+
+    asyncio.run(main())
+
+
+def test_messages_within_the_window_are_merged():
+    async def main():
+        scheduler = TurnScheduler(max_concurrency=2, max_queue=10, merge_window=0.05)
+        agent = _Agent()
+        started, tokens = [], []
+        answers = [
+            scheduler.submit("u1", text, agent, on_token=tokens.append, on_start=lambda text=text: started.append(text))
+            for text in ("включи свет", "и чайник")
+        ]
+        results = await asyncio.gather(*answers)
+        assert results == ["u1:включи свет\nи чайник"] * 2
+        assert len(agent.calls) == 1
+        assert sorted(started) == ["включи свет", "и чайник"]
+        assert tokens == ["<включи свет\nи чайник>"] * 2
+        assert scheduler.stats()["merged"] == 1
+
+    asyncio.run(main())
+
+
+def test_messages_with_another_priority_or_variant_are_not_merged():
+    async def main():
+        scheduler = TurnScheduler(max_concurrency=2, max_queue=10, merge_window=0.05)
+        agent = _Agent()
+        await asyncio.gather(
+            scheduler.submit("u1", "a", agent),
+            scheduler.submit("u1", "b", agent, priority=PRIORITY_BACKGROUND),
+            scheduler.submit("u1", "c", agent, priority=PRIORITY_BACKGROUND, prompt_variant="short"),
+        )
+        assert agent.calls == [
+            ("u1", "a", PRIORITY_INTERACTIVE, None),
+            ("u1", "b", PRIORITY_BACKGROUND, None),
+            ("u1", "c", PRIORITY_BACKGROUND, "short"),
+        ]
+        assert scheduler.stats()["merged"] == 0
+
+    asyncio.run(main())
+
+
+def test_turn_nobody_waits_for_is_cancelled():
+    async def main():
+        scheduler = TurnScheduler(max_concurrency=1, max_queue=10, merge_window=0)
+        agent = _Agent()
+        agent.gate.clear()
+        first = asyncio.ensure_future(scheduler.submit("u1", "a", agent))
+        second = asyncio.ensure_future(scheduler.submit("u1", "b", agent))
+        await asyncio.sleep(0.01)
+        second.cancel()
+        await asyncio.sleep(0)
+        agent.gate.set()
+        assert await first == "u1:a"
+        await asyncio.sleep(0.05)
+        assert [text for _, text, _, _ in agent.calls] == ["a"]
+        assert scheduler.stats()["cancelled"] == 1
+        assert scheduler.stats()["in_flight"] == 0
+
+    asyncio.run(main())
@@ -0,0 +1,115 @@
+import pytest
+
+from core.memory import TokenBudgetMemory
+from core.sessions import SessionStore
+from core.state_backend import SQLiteBackend
+
+
+@pytest.fixture
+def backend(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "sessions.db"))
+    yield backend
+    backend.close()
+
+
+def _store(backend, **kwargs) -> SessionStore:
+    return SessionStore(backend, memory_factory=lambda: TokenBudgetMemory(k=5), summarizer=None, **kwargs)
+
+
+def _say(store: SessionStore, user_id: str, text: str):
+    memory = store.get(user_id)
+    memory.save_context({"input": text}, {"output": f"ответ на {text}"})
+    store.save(user_id, memory)
+
+
+def _texts(memory: TokenBudgetMemory) -> list:
+    return [m.content for m in memory.chat_memory.messages]
+
+
+def test_sessions_are_written_behind_and_reloaded(backend):
+    store = _store(backend)
+    _say(store, "u1", "привет")
+    assert backend.load_session("u1") is None
+    store.flush()
+    assert backend.load_session("u1") is not None
+
+    fresh = _store(backend)
+    assert _texts(fresh.get("u1")) == ["привет", "ответ на привет"]
+    assert fresh.stats()["loaded_from_disk"] == 1
+
+
+def test_summary_survives_the_round_trip(backend):
+    store = _store(backend)
+    memory = store.get("u1")
+    memory.summary = "пользователь любит теплый свет"
+    _say(store, "u1", "привет")
+    store.flush()
+    assert _store(backend).get("u1").summary == "пользователь любит теплый свет"
+
+
+def test_lru_eviction_keeps_changes(backend):
+    store = _store(backend, max_sessions=2)
+    for user_id in ("u1", "u2", "u3"):
+        _say(store, user_id, user_id)
+    stats = store.stats()
+    assert stats["sessions"] == 2 and stats["evictions_lru"] == 1
+    # Вытесненную сессию еще не записали на диск - она берется из очереди записи
+    assert _texts(store.get("u1"))[0] == "u1"
+    store.flush()
+    assert backend.load_session("u2") is not None
+
+
+def test_idle_and_byte_limits(backend):
+    store = _store(backend, idle_ttl=0.0)
+    _say(store, "u1", "раз")
+    _say(store, "u2", "два")
+    assert store.stats()["evictions_idle"] >= 1
+
+    store = _store(backend, max_bytes=100)
+    _say(store, "u3", "x" * 80)
+    _say(store, "u4", "y" * 80)
+    stats = store.stats()
+    assert stats["sessions"] == 1 and stats["evictions_bytes"] == 1
+    assert stats["bytes"] <= 200
+
+
+def test_hits_and_misses(backend):
+    store = _store(backend)
+    store.get("u1")
+    store.get("u1")
+    stats = store.stats()
+    assert stats["misses"] == 1 and stats["hits"] == 1
+
+
+def test_release_drops_sessions_and_persists_them(backend):
+    store = _store(backend)
+    for user_id in ("a1", "a2", "b1"):
+        _say(store, user_id, user_id)
+    assert store.release(lambda user_id: user_id.startswith("a")) == 2
+    store.flush()
+    assert store.stats()["sessions"] == 1
+    assert backend.load_session("a1") is not None and backend.load_session("a2") is not None
+
+    # Другой воркер дописал диалог, этот читает уже его версию
+    other = _store(backend)
+    _say(other, "a1", "с другого воркера")
+    other.flush()
+    assert _texts(store.get("a1"))[-2:] == ["с другого воркера", "ответ на с другого воркера"]
+
+
+def test_save_after_release_is_persisted_but_not_cached(backend):
+    owned = {"u1": True}
+    store = _store(backend)
+    store.start(owns=lambda user_id: owned.get(user_id, False))
+    try:
+        memory = store.get("u1")
+        owned["u1"] = False
+        store.release(lambda user_id: True)
+        # Ход закончился уже после того, как партиция переехала
+        memory.save_context({"input": "поздний"}, {"output": "ответ"})
+        store.save("u1", memory)
+        assert store.stats()["sessions"] == 0
+        store.flush()
+        assert "поздний" in backend.load_session("u1")
+    finally:
+        store.stop()
@@ -0,0 +1,105 @@
+import threading
+import time
+
+import pytest
+
+from core.state_backend import RedisBackend, SQLiteBackend
+from fakes.fake_redis import FakeRedis
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def backend(request, tmp_path):
+    if request.param == "sqlite":
+        backend = SQLiteBackend(str(tmp_path / "state.db"), poll_interval=0.01)
+        yield backend
+        backend.close()
+    else:
+        server = FakeRedis()
+        backend = RedisBackend(server.start())
+        yield backend
+        backend.close()
+        server.stop()
+
+
+def test_sessions_round_trip(backend):
+    assert backend.load_session("u1") is None
+    backend.save_sessions({"u1": '[{"type": "human"}]', "u2": "[]"})
+    backend.save_sessions({"u1": "[]"})
+    assert backend.load_session("u1") == "[]"
+    assert backend.load_session("u2") == "[]"
+
+
+def test_kv_with_ttl(backend):
+    backend.set("job:1", "running")
+    backend.set("job:2", "done", ttl=0.1)
+    assert backend.get("job:1") == "running"
+    assert backend.get("job:2") == "done"
+    assert backend.get("job:3") is None
+    time.sleep(0.15)
+    assert backend.get("job:2") is None
+    assert backend.get("job:1") == "running"
+
+
+def test_queues_are_fifo_and_checked_in_order(backend):
+    for value in ("a", "b"):
+        backend.push("partition:1", value)
+    backend.push("reply:w1", "r")
+    assert backend.pop(["reply:w1", "partition:1"], timeout=1) == ("reply:w1", "r")
+    assert backend.pop(["reply:w1", "partition:1"], timeout=1) == ("partition:1", "a")
+    assert backend.pop(["partition:1"], timeout=1) == ("partition:1", "b")
+    started = time.monotonic()
+    assert backend.pop(["partition:1"], timeout=0.1) is None
+    assert time.monotonic() - started >= 0.09
+
+
+def test_pop_wakes_up_on_push_from_another_thread(backend):
+    threading.Timer(0.05, backend.push, ("partition:2", "late")).start()
+    assert backend.pop(["partition:2"], timeout=2) == ("partition:2", "late")
+
+
+def test_each_item_is_popped_once(backend):
+    for i in range(40):
+        backend.push("partition:3", str(i))
+    popped, lock = [], threading.Lock()
+
+    def consume():
+        while True:
+            item = backend.pop(["partition:3"], timeout=0.1)
+            if item is None:
+                return
+            with lock:
+                popped.append(item[1])
+
+    threads = [threading.Thread(target=consume) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(popped, key=int) == [str(i) for i in range(40)]
+
+
+def test_heartbeat_and_leave(backend):
+    assert backend.heartbeat("w1", ttl=0.2) == ["w1"]
+    assert backend.heartbeat("w2", ttl=0.2) == ["w1", "w2"]
+    time.sleep(0.25)
+    assert backend.heartbeat("w2", ttl=0.2) == ["w2"]
+    backend.heartbeat("w3", ttl=5)
+    backend.leave("w3")
+    assert backend.heartbeat("w2", ttl=5) == ["w2"]
+
+
+def test_leases(backend):
+    names = ["partition:0", "partition:1"]
+    assert sorted(backend.acquire_leases(names, "w1", ttl=0.3)) == names
+    assert backend.acquire_leases(names, "w2", ttl=0.3) == []
+    # Свою аренду можно продлевать, чужую не снять
+    time.sleep(0.2)
+    assert sorted(backend.acquire_leases(names, "w1", ttl=0.3)) == names
+    time.sleep(0.2)
+    backend.release_leases(names, "w2")
+    assert backend.acquire_leases(names, "w2", ttl=0.3) == []
+    backend.release_leases(["partition:0"], "w1")
+    assert backend.acquire_leases(names, "w2", ttl=0.3) == ["partition:0"]
+    # Просроченная аренда достается следующему
+    time.sleep(0.35)
+    assert sorted(backend.acquire_leases(names, "w2", ttl=0.3)) == names
@@ -0,0 +1,116 @@
+import json
+
+import pytest
+
+from core.streaming import ActionStreamParser, ResponseStreamExtractor, parse_action, parse_actions
+
+
+def _stream(text: str, chunk: int = 1) -> str:
+    extractor = ResponseStreamExtractor()
+    return "".join(extractor.feed(text[i:i + chunk]) for i in range(0, len(text), chunk))
+
+
+def _respond(response: str) -> str:
+    action = {"action": "respond_to_user", "action_input": {"response": response}}
+    return f"Thought: отвечаю\nAction: {json.dumps(action)}\nObservation: лишнее"
+
+
+def test_extractor_streams_only_the_response():
+    assert _stream(_respond("Свет включен.")) == "Свет включен."
+
+
+def test_extractor_ignores_other_tools():
+    text = 'Thought: x\nAction: {"action": "home_assistant", "action_input": {"response": "нет"}}'
+    assert _stream(text) == ""
+
+
+def test_extractor_ignores_action_lists():
+    text = 'Action: [{"action": "respond_to_user", "action_input": {"response": "нет"}}]'
+    assert _stream(text) == ""
+
+
+def test_extractor_decodes_escapes_split_between_chunks():
+    response = 'кавычки "да", слэш \\ и\nперенос\tтаб'
+    for chunk in (1, 2, 3, 7):
+        assert _stream(_respond(response), chunk) == response
+
+
+def test_extractor_decodes_surrogate_pairs_split_between_chunks():
+    # json.dumps с ensure_ascii пишет эмодзи как 💡
+    response = "лампа 💡 готова"
+    assert "\\ud83d\\udca1" in _respond(response)
+    for chunk in range(1, 13):
+        assert _stream(_respond(response), chunk) == response
+
+
+def test_extractor_stops_at_closing_quote():
+    extractor = ResponseStreamExtractor()
+    out = extractor.feed(_respond("готово"))
+    assert out == "готово"
+    assert extractor.feed(' и еще "текст"') == ""
+
+
+def _feed(text: str, chunk: int = 1) -> ActionStreamParser:
+    parser = ActionStreamParser()
+    for i in range(0, len(text), chunk):
+        parser.feed(text[i:i + chunk])
+    return parser
+
+
+@pytest.mark.parametrize("chunk", [1, 2, 3, 5, 1000])
+def test_parser_finds_action_with_marker_split_between_chunks(chunk):
+    parser = _feed(_respond("ок"), chunk)
+    assert parser.complete
+    assert parser.action == {"action": "respond_to_user", "action_input": {"response": "ок"}}
+    assert parser.text.endswith("}")
+    assert "Observation" not in parser.text
+
+
+def test_parser_counts_tokens_after_the_action():
+    parser = ActionStreamParser()
+    assert not parser.feed('Action: {"action": "x", "action_input": {}}'[:-1])
+    assert parser.feed("}")
+    parser.feed("\nObservation")
+    parser.feed(": ...")
+    assert parser.tokens_after_action == 2
+
+
+def test_parser_skips_objects_that_are_not_actions():
+    text = 'Thought: пример Action: {"note": "не действие"}\nAction: {"action": "a", "action_input": {"k": "}"}}'
+    parser = _feed(text)
+    assert parser.action == {"action": "a", "action_input": {"k": "}"}}
+
+
+def test_parser_waits_for_an_unfinished_object():
+    parser = _feed('Action: {"action": "a", "action_input": {"text": "скобка { в строке')
+    assert not parser.complete
+    assert parser.text.startswith("Action:")
+
+
+def test_parse_action_rejects_text_without_action():
+    with pytest.raises(ValueError):
+        parse_action("Thought: думаю, но ничего не делаю")
+
+
+def test_parse_actions_reads_a_list_of_actions():
+    actions = [
+        {"action": "home_assistant", "action_input": {"entity_id": "light.kitchen"}},
+        {"action": "home_assistant", "action_input": {"entity_id": "light.hall"}},
+    ]
+    raw = f"Thought: оба сразу\nAction: {json.dumps(actions)}\nObservation: ..."
+    assert parse_actions(raw) == actions
+    parser = _feed(raw, 4)
+    assert parser.actions == actions
+    assert parser.action is None
+    with pytest.raises(ValueError):
+        parse_action(raw)
+
+
+def test_parse_actions_single_item_list_is_a_single_action():
+    action = {"action": "a", "action_input": {}}
+    assert parse_action(f"Action: [{json.dumps(action)}]") == action
+
+
+def test_parse_actions_skips_lists_of_non_actions():
+    raw = 'Action: [1, {"action": "a"}]\nAction: {"action": "b", "action_input": {}}'
+    assert parse_actions(raw) == [{"action": "b", "action_input": {}}]
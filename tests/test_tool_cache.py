@@ -0,0 +1,115 @@
+from types import SimpleNamespace
+
+import pytest
+
+from core import tool_cache as tool_cache_module
+from core.tool_cache import ToolResultCache
+from core.tools import is_read_only_script
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> _Clock:
+    clock = _Clock()
+    monkeypatch.setattr(tool_cache_module.time, "monotonic", clock)
+    return clock
+
+
+def _tool(name: str = "script", ttl=60.0, cache_if=None):
+    metadata = {"cache_ttl": ttl}
+    if cache_if is not None:
+        metadata["cache_if"] = cache_if
+    return SimpleNamespace(name=name, metadata=metadata)
+
+
+def test_hit_ignores_whitespace_differences(clock):
+    cache = ToolResultCache(max_entries=8)
+    tool = _tool()
+    cache.store(tool, {"code": "print(1)\n"}, "1")
+    clock.now += 5
+    assert cache.lookup(tool, {"code": "print(1)   \r\n\n"}) == ("1", 5.0)
+    assert cache.lookup(_tool("other"), {"code": "print(1)"}) is None
+    assert cache.stats()["hits"] == 1
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = ToolResultCache(max_entries=8)
+    tool = _tool(ttl=10)
+    cache.store(tool, "x", "old")
+    clock.now += 10
+    assert cache.lookup(tool, "x") is not None
+    clock.now += 0.1
+    assert cache.lookup(tool, "x") is None
+    assert cache.stats()["expired"] == 1
+
+
+def test_tools_without_ttl_are_not_cached(clock):
+    cache = ToolResultCache(max_entries=8)
+    for tool in (_tool(ttl=None), _tool(ttl=0), SimpleNamespace(name="plain", metadata=None)):
+        cache.store(tool, "x", "y")
+        assert cache.lookup(tool, "x") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_cache_if_filters_results(clock):
+    cache = ToolResultCache(max_entries=8)
+    tool = _tool(cache_if=lambda tool_input, result: result.startswith("ok"))
+    cache.store(tool, "a", "error")
+    cache.store(tool, "b", "ok")
+    assert cache.lookup(tool, "a") is None
+    assert cache.lookup(tool, "b")[0] == "ok"
+
+
+def test_lru_eviction_and_invalidation(clock):
+    cache = ToolResultCache(max_entries=2)
+    tool = _tool()
+    cache.store(tool, "a", "1")
+    cache.store(tool, "b", "2")
+    cache.lookup(tool, "a")
+    cache.store(tool, "c", "3")
+    assert cache.lookup(tool, "b") is None
+    assert cache.lookup(tool, "a") is not None
+    assert cache.stats()["evictions"] == 1
+    cache.invalidate()
+    assert cache.lookup(tool, "a") is None
+    assert cache.lookup(tool, "c") is None
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_disabled_cache_stores_nothing(clock):
+    cache = ToolResultCache(max_entries=8, enabled=False)
+    cache.store(_tool(), "a", "1")
+    assert cache.lookup(_tool(), "a") is None
+
+
+@pytest.mark.parametrize("code", [
+    "import httpx, os\nr = httpx.get(os.getenv('HA_URL') + '/api/states/sensor.t')\nprint(r.json()['state'])",
+    "print(sum(range(10)))",
+    "with open('/etc/hostname') as f:\n    print(f.read())",
+    "import json\nprint(json.dumps({'a': 1}))",
+])
+def test_read_only_scripts(code):
+    assert is_read_only_script(code)
+
+
+@pytest.mark.parametrize("code", [
+    "httpx.post(url + '/api/services/light/turn_on', json={})",
+    "requests.request(url, method='DELETE')",
+    "open('out.txt', 'w').write('x')",
+    "open('log.txt', mode='a')",
+    "from pathlib import Path\nPath('x').write_text('y')",
+    "import os\nos.remove('x')",
+    "import subprocess\nsubprocess.run(['ls'])",
+    "import random\nprint(random.random())",
+    "import time\nprint(time.time())",
+    "from datetime import datetime\nprint(datetime.now())",
+])
+def test_scripts_with_side_effects_or_unstable_output(code):
+    assert not is_read_only_script(code)